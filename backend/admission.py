@@ -0,0 +1,317 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import Config
+from metrics import (ADMISSION_ACTIVE, ADMISSION_QUEUE_SECONDS, ADMISSION_QUEUED, ADMISSION_REJECTED,
+                     RATE_LIMIT_TOKENS, RATE_LIMIT_WAIT_SECONDS)
+
+LimiterKey = Tuple[str, str]  # (kind, name)，kind 为 model 或 mcp
+
+
+REJECT_MESSAGES = {
+    "queue_full": "排队已满",
+    "queue_timeout": "排队超时",
+    "rate_limited": "超出速率限制"
+}
+
+
+class AdmissionRejected(Exception):
+    """排队已满或超出速率限制（429），排队超时（503）"""
+
+    def __init__(self, kind: str, name: str, reason: str, retry_after: float):
+        self.kind = kind
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = 503 if reason == "queue_timeout" else 429
+        super().__init__(f"{kind} {name} 请求过多（{REJECT_MESSAGES.get(reason, reason)}），请稍后重试")
+
+
+class Lease:
+    """一次并发名额申请：acquire() 等待名额（排队已满或超时抛出 AdmissionRejected），release() 可重复调用
+
+    创建时不占用名额也不计入排队，应在即将调用上游前创建，queued / position 为此刻是否需要排队和排队位置。
+    """
+
+    def __init__(self, limiter: "ConcurrencyLimiter"):
+        self.limiter = limiter
+        self.acquired = False
+
+    @property
+    def queued(self) -> bool:
+        return self.limiter.is_busy()
+
+    @property
+    def position(self) -> int:
+        return self.limiter.waiting + 1 if self.queued else 0
+
+    async def acquire(self, timeout: float):
+        if self.acquired:
+            return
+        limiter = self.limiter
+        started = time.perf_counter()
+        if not limiter.is_busy():
+            # 有空闲名额时立即取得，不经过等待队列
+            await limiter._semaphore.acquire()
+        else:
+            if limiter.waiting >= limiter.max_queue:
+                limiter._reject("queue_full")
+            limiter._enter_queue()
+            try:
+                await asyncio.wait_for(limiter._semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                limiter._reject("queue_timeout")
+            finally:
+                limiter._leave_queue()
+        self.acquired = True
+        limiter._activate(time.perf_counter() - started)
+
+    def release(self):
+        if self.acquired:
+            self.acquired = False
+            self.limiter._release()
+
+
+class ConcurrencyLimiter:
+    """某个模型或 MCP 的并发上限和有界等待队列"""
+
+    def __init__(self, kind: str, name: str, max_concurrency: int, max_queue: int):
+        self.key = (kind, name)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0  # 正在等待名额的请求数
+        self.rejected = 0
+
+    def is_busy(self) -> bool:
+        """名额已占满或已有请求在排队，新请求需要排队"""
+        return self.waiting > 0 or self._semaphore.locked()
+
+    def is_full(self) -> bool:
+        """名额和等待队列都已占满"""
+        return self.active + self.waiting >= self.max_concurrency + self.max_queue
+
+    def _enter_queue(self):
+        self.waiting += 1
+        ADMISSION_QUEUED.set(self.waiting, kind=self.key[0], name=self.key[1])
+
+    def _leave_queue(self):
+        self.waiting -= 1
+        ADMISSION_QUEUED.set(self.waiting, kind=self.key[0], name=self.key[1])
+
+    def _activate(self, waited: float):
+        self.active += 1
+        ADMISSION_ACTIVE.set(self.active, kind=self.key[0], name=self.key[1])
+        ADMISSION_QUEUE_SECONDS.observe(waited, kind=self.key[0], name=self.key[1])
+
+    def _release(self):
+        self.active -= 1
+        self._semaphore.release()
+        ADMISSION_ACTIVE.set(self.active, kind=self.key[0], name=self.key[1])
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(kind=self.key[0], name=self.key[1], reason=reason)
+        raise AdmissionRejected(self.key[0], self.key[1], reason, retry_after=1.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected
+        }
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多存 capacity 个
+
+    reserve() 立即扣除全部令牌（余额可以为负），调用方按 delay() 返回的秒数等待。后到的请求要先补齐前面的欠额，
+    因此等待中的请求按到达顺序依次放行，间隔均匀，不会在令牌补满的瞬间一起发出；超过容量的请求在桶满时放行，
+    欠额由后续请求等待补齐，长期速率仍不超过 rate。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, cost: float) -> float:
+        """放行 cost 个令牌的请求需要等待的秒数；超过桶容量的请求只需等到桶满，否则永远无法放行"""
+        self._refill()
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    def reserve(self, cost: float):
+        self.tokens -= cost
+
+    def refund(self, cost: float):
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+
+class RateLimiter:
+    """某个模型或 MCP 的请求数（rpm）和 token 数（tpm）限速，两个桶都有余额时才放行"""
+
+    def __init__(self, kind: str, name: str, rpm: float, tpm: float, burst_seconds: float):
+        self.key = (kind, name)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.burst_seconds = burst_seconds
+        # 容量至少为 1 个请求，rpm 很小时仍能放行
+        self._requests = TokenBucket(rpm / 60, max(1.0, rpm / 60 * burst_seconds)) if rpm > 0 else None
+        self._tokens = TokenBucket(tpm / 60, max(1.0, tpm / 60 * burst_seconds)) if tpm > 0 else None
+        self.waiting = 0
+        self.rejected = 0
+
+    def _costs(self, tokens: int) -> List[Tuple[TokenBucket, float]]:
+        costs = []
+        if self._requests is not None:
+            costs.append((self._requests, 1))
+        if self._tokens is not None:
+            costs.append((self._tokens, tokens))
+        return costs
+
+    async def throttle(self, tokens: int, max_wait: float) -> float:
+        """等待令牌后放行，返回等待的秒数；需要等待超过 max_wait 时不扣除令牌，抛出 AdmissionRejected"""
+        kind, name = self.key
+        costs = self._costs(tokens)
+        wait = max(bucket.delay(cost) for bucket, cost in costs)
+        if wait > max_wait:
+            self.rejected += 1
+            ADMISSION_REJECTED.inc(kind=kind, name=name, reason="rate_limited")
+            raise AdmissionRejected(kind, name, "rate_limited", retry_after=wait)
+        for bucket, cost in costs:
+            bucket.reserve(cost)
+        RATE_LIMIT_TOKENS.inc(tokens, kind=kind, name=name)
+        if wait > 0:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # 等待中被取消的请求不会发出，归还预扣的令牌
+                for bucket, cost in costs:
+                    bucket.refund(cost)
+                raise
+            finally:
+                self.waiting -= 1
+        RATE_LIMIT_WAIT_SECONDS.observe(wait, kind=kind, name=name)
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {"rpm": self.rpm, "tpm": self.tpm, "waiting": self.waiting, "rejected": self.rejected}
+        if self._requests is not None:
+            self._requests._refill()
+            stats["request_tokens"] = round(self._requests.tokens, 2)
+        if self._tokens is not None:
+            self._tokens._refill()
+            stats["tokens"] = round(self._tokens.tokens, 2)
+        return stats
+
+
+class AdmissionController:
+    """按模型和 MCP 限制同时进行的上游调用数，并按令牌桶限制调用速率
+
+    上限取 ai_models / mcp_options 条目中的 max_concurrency、max_queue，未配置时取 admission 中的默认值，
+    max_concurrency 为 0 表示不限制。配置变化后新请求使用新的限制，已持有旧名额的请求在旧限制上释放。
+    速率取条目中的 rpm / tpm，未配置时取 rate_limit 中的默认值，配置变化后令牌桶重新计数。
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._limiters: Dict[LimiterKey, ConcurrencyLimiter] = {}
+        self._rate_limiters: Dict[LimiterKey, RateLimiter] = {}
+
+    def _limits(self, kind: str, name: str) -> Tuple[int, int]:
+        settings = self.config.get_admission_config()
+        entry = self._entry(kind, name)
+        max_concurrency = getattr(entry, "max_concurrency", None)
+        max_queue = getattr(entry, "max_queue", None)
+        if max_concurrency is None:
+            max_concurrency = settings.get(f"{kind}_max_concurrency", 0)
+        if max_queue is None:
+            max_queue = settings.get(f"{kind}_max_queue", 0)
+        return int(max_concurrency), int(max_queue)
+
+    def get_limiter(self, kind: str, name: str) -> Optional[ConcurrencyLimiter]:
+        """不限制并发时返回 None"""
+        max_concurrency, max_queue = self._limits(kind, name)
+        if max_concurrency <= 0:
+            self._limiters.pop((kind, name), None)
+            return None
+        limiter = self._limiters.get((kind, name))
+        if limiter is None or (limiter.max_concurrency, limiter.max_queue) != (max_concurrency, max_queue):
+            limiter = self._limiters[(kind, name)] = ConcurrencyLimiter(kind, name, max_concurrency, max_queue)
+        return limiter
+
+    def _entry(self, kind: str, name: str):
+        return self.config.get_model_config(name) if kind == "model" else self.config.get_mcp_config(name)
+
+    def get_rate_limiter(self, kind: str, name: str) -> Optional[RateLimiter]:
+        """rpm 和 tpm 都不限制时返回 None；MCP 只按 rpm 限速"""
+        settings = self.config.get_rate_limit_config()
+        entry = self._entry(kind, name)
+        rpm = getattr(entry, "rpm", None)
+        tpm = getattr(entry, "tpm", None)
+        if rpm is None:
+            rpm = settings.get(f"{kind}_rpm", 0)
+        if tpm is None:
+            tpm = settings.get(f"{kind}_tpm", 0)
+        rpm, tpm = float(rpm or 0), float(tpm or 0)
+        burst_seconds = float(settings.get("burst_seconds", 5.0))
+        if rpm <= 0 and tpm <= 0:
+            self._rate_limiters.pop((kind, name), None)
+            return None
+        limiter = self._rate_limiters.get((kind, name))
+        if limiter is None or (limiter.rpm, limiter.tpm, limiter.burst_seconds) != (rpm, tpm, burst_seconds):
+            limiter = self._rate_limiters[(kind, name)] = RateLimiter(kind, name, rpm, tpm, burst_seconds)
+        return limiter
+
+    async def throttle(self, kind: str, name: str, tokens: int = 0) -> float:
+        """在发出上游调用前等待速率配额，tokens 为预估的 token 数；等待过长时抛出 AdmissionRejected"""
+        limiter = self.get_rate_limiter(kind, name)
+        if limiter is None:
+            return 0.0
+        return await limiter.throttle(tokens, float(self.config.get_rate_limit_config().get("max_wait", 30.0)))
+
+    @property
+    def queue_timeout(self) -> float:
+        return float(self.config.get_admission_config().get("queue_timeout", 30.0))
+
+    def check(self, kind: str, name: str):
+        """快速检查：名额和队列都已占满时立即抛出 AdmissionRejected"""
+        limiter = self.get_limiter(kind, name)
+        if limiter is not None and limiter.is_full():
+            limiter._reject("queue_full")
+
+    def lease(self, kind: str, name: str) -> Optional[Lease]:
+        """创建名额申请，由调用方 acquire() / release()；不限制并发时返回 None"""
+        limiter = self.get_limiter(kind, name)
+        return Lease(limiter) if limiter is not None else None
+
+    @asynccontextmanager
+    async def slot(self, kind: str, name: str):
+        """在并发名额内执行；排队已满或超时抛出 AdmissionRejected"""
+        lease = self.lease(kind, name)
+        if lease is None:
+            yield
+            return
+        try:
+            await lease.acquire(self.queue_timeout)
+            yield
+        finally:
+            lease.release()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {f"{kind}:{name}": limiter.stats() for (kind, name), limiter in self._limiters.items()}
+        for (kind, name), limiter in self._rate_limiters.items():
+            stats.setdefault(f"{kind}:{name}", {})["rate_limit"] = limiter.stats()
+        return stats
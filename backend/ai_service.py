@@ -1,194 +1,450 @@
 import asyncio
 import json
-from typing import List, Dict, Any, AsyncGenerator, Optional
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Dict, Any, AsyncGenerator, Optional, Tuple
 from dataclasses import asdict
-import httpx
 import openai
 from anthropic import AsyncAnthropic
 
+from admission import AdmissionController, Lease
+from completion_cache import CompletionCache, completion_key
 from config import Config, AIModelConfig
+from function_call_parser import FunctionCallStreamParser, format_call_block
+from mcp_service import MCPService
+from metrics import COMPLETION_CACHE, UPSTREAM_ERRORS
+from tracing import span
+from transport import HTTPTransport
+
+logger = logging.getLogger(__name__)
+
+ANTHROPIC_API_BASE = "https://api.anthropic.com"
+
+# 支持原生工具调用（tool_calling: native）的提供商；其余提供商使用文本标记协议
+NATIVE_TOOL_PROVIDERS = ("volcengine", "anthropic")
+
+# 已渲染的 MCP 工具上下文最多缓存的组合数
+MCP_CONTEXT_CACHE_SIZE = 64
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个 token，其余字符按 4 个字符 1 个 token"""
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uf900' <= ch <= '\ufaff' or '\uff00' <= ch <= '\uffef')
+    return cjk + (len(text) - cjk + 3) // 4
+
+# 企业查询类函数：结果为 data.data_list 分页列表
+COMPANY_SEARCH_FUNCTIONS = ('search_companies', 'search_established_companies', 'search_selfemployed', 'search_established_selfemployed')
+SEARCH_SUMMARY_FIELDS = ('num_found', 'current_page', 'total_page')
+# 企业列表中每条记录展示的字段（companyName 作为标题单独展示）
+COMPANY_LIST_FIELDS = {
+    'establishDate': ('📅', '成立时间'),
+    'legalPerson': ('👤', '法定代表人'),
+    'capital': ('💰', '注册资本'),
+    'companyStatusStr': ('📈', '企业状态'),
+    'creditNo': ('🆔', '统一信用代码')
+}
+COMPANY_INFO_FIELDS = {
+    'CompanyName': ('🏢', '企业名称'),
+    'LegalPerson': ('👤', '法定代表人'),
+    'EstablishDate': ('📅', '成立时间'),
+    'Capital': ('💰', '注册资本'),
+    'CompanyType': ('🏷️', '企业类型'),
+    'CompanyStatus': ('📈', '企业状态'),
+    'CompanyAddress': ('🏠', '企业地址'),
+    'BusinessScope': ('💼', '经营范围'),
+    'CreditNo': ('🆔', '统一信用代码')
+}
+RISK_TYPES = {
+    'self_risk': ('🔴', '自我风险'),
+    'relation_risk': ('🟡', '关联风险'),
+    'self_notice': ('ℹ️', '自身重要信息'),
+    'relation_notice': ('📢', '关联重要信息')
+}
+STIE_SCORE_FIELDS = {
+    'company_name': ('🏢', '企业名称'),
+    'score': ('📊', '科创评分'),
+    'level': ('🏆', '科创等级')
+}
+STATUS_FIELDS = ('statusCode', 'statusMessage')
+
+def project_mcp_result(function_name: str, result: Any) -> Any:
+    """只保留分析需要的字段（与 _format_mcp_result 展示的字段一致）；未知函数或结构时原样返回"""
+    if not isinstance(result, dict):
+        return result
+    status = {field: result[field] for field in STATUS_FIELDS if field in result}
+    
+    if function_name in COMPANY_SEARCH_FUNCTIONS and isinstance(result.get('data'), dict):
+        data = result['data']
+        projected = {field: data[field] for field in SEARCH_SUMMARY_FIELDS if field in data}
+        if isinstance(data.get('data_list'), list):
+            fields = ('companyName', *COMPANY_LIST_FIELDS)
+            projected['data_list'] = [
+                {field: company[field] for field in fields if field in company} if isinstance(company, dict) else company
+                for company in data['data_list']
+            ]
+        return {**status, 'data': projected}
+    
+    field_sets = {
+        'get_company_info': COMPANY_INFO_FIELDS,
+        'search_company_risk': RISK_TYPES,
+        'get_stie_score': STIE_SCORE_FIELDS
+    }
+    if function_name in field_sets:
+        projected = {field: result[field] for field in field_sets[function_name] if result.get(field)}
+        if projected:
+            return {**status, **projected}
+    return result
+
+def shrink_value(value: Any, max_items: int, max_chars: int) -> Any:
+    """递归截断：列表只保留前 max_items 项并注明总数，字符串只保留前 max_chars 个字符"""
+    if isinstance(value, dict):
+        return {key: shrink_value(item, max_items, max_chars) for key, item in value.items()}
+    if isinstance(value, list):
+        items = [shrink_value(item, max_items, max_chars) for item in value[:max_items]]
+        if len(value) > max_items:
+            items.append(f"...共 {len(value)} 条，省略 {len(value) - max_items} 条")
+        return items
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}...(共 {len(value)} 字)"
+    return value
+
+def reduce_mcp_result(function_name: str, result: Any, token_budget: int,
+                      max_items: int = 10, max_chars: int = 500) -> str:
+    """投影并截断 MCP 结果，返回不超过 token_budget 的紧凑 JSON；超出预算时逐步减少列表条数和字符串长度"""
+    projected = project_mcp_result(function_name, result)
+    while True:
+        text = json.dumps(shrink_value(projected, max_items, max_chars), ensure_ascii=False,
+                          separators=(",", ":"), default=str)
+        if estimate_tokens(text) <= token_budget or (max_items <= 1 and max_chars <= 50):
+            break
+        max_items = max(1, max_items // 2)
+        max_chars = max(50, max_chars // 2)
+    if estimate_tokens(text) > token_budget:
+        # 字段本身过多时按字符截断（每个字符至少对应 1/4 个 token，截到 token_budget 个字符不会超出预算）
+        text = f"{text[:token_budget]}...(结果过长，已截断)"
+    return text
 
 class AIService:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, mcp_service: Optional[MCPService] = None,
+                 transport: Optional[HTTPTransport] = None, admission: Optional[AdmissionController] = None):
         self.config = config
+        # 与应用共享同一个 HTTP 连接池和 MCPService，连接、工具缓存和会话池在进程内复用
+        self.transport = transport or HTTPTransport(config)
+        self.mcp_service = mcp_service or MCPService(config, self.transport, admission=admission)
+        self.admission = admission or self.mcp_service.admission  # 每个模型的并发上限和等待队列
+        self.completion_cache = CompletionCache(config)  # 相同模型和消息的回复缓存，默认关闭
+        self._raw_results: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()  # 结果链接 id -> (过期时间, 完整结果)
         self._clients = {}
+        self._mcp_context_cache = OrderedDict()  # (MCP, 目录版本) 组合 -> 已渲染的工具上下文
     
     def _get_client(self, model_config: AIModelConfig):
-        """获取或创建AI客户端"""
+        """获取或创建AI客户端，底层 HTTP 连接由共享连接池提供"""
         cache_key = f"{model_config.provider}_{model_config.name}"
         
         if cache_key not in self._clients:
             if model_config.provider == "volcengine":
                 self._clients[cache_key] = openai.AsyncOpenAI(
                     api_key=model_config.api_key,
-                    base_url=model_config.api_base
+                    base_url=model_config.api_base,
+                    timeout=self.transport.get_timeout(model_config.api_base),
+                    http_client=self.transport.get_client(model_config.api_base)
                 )
             elif model_config.provider == "anthropic":
+                api_base = model_config.api_base or ANTHROPIC_API_BASE
                 self._clients[cache_key] = AsyncAnthropic(
-                    api_key=model_config.api_key
+                    api_key=model_config.api_key,
+                    base_url=api_base,
+                    timeout=self.transport.get_timeout(api_base),
+                    http_client=self.transport.get_client(api_base)
                 )
             elif model_config.provider == "ollama":
-                self._clients[cache_key] = httpx.AsyncClient(
-                    base_url=model_config.api_base or "http://localhost:11434"
-                )
+                self._clients[cache_key] = self.transport.get_client(self._ollama_url(model_config, ""))
         
         return self._clients[cache_key]
     
-    async def get_response(self, messages: List[Dict], model: str, selected_mcp: List[str] = None) -> str:
-        """获取AI响应（非流式）"""
+    def _ollama_url(self, model_config: AIModelConfig, path: str) -> str:
+        return (model_config.api_base or "http://localhost:11434").rstrip("/") + path
+    
+    async def get_response(self, messages: List[Dict], model: str, selected_mcp: List[str] = None,
+                           use_cache: bool = True) -> str:
+        """获取AI响应（非流式）；use_cache 为 False 时跳过回复缓存"""
         model_config = self.config.get_model_config(model)
-        print(111,model_config)
         if not model_config:
             raise ValueError(f"未找到模型配置: {model}")
         
         # 处理MCP上下文
-        enhanced_messages = await self._enhance_messages_with_mcp(messages, selected_mcp)
+        enhanced_messages, _, _ = await self._enhance_messages_with_mcp(messages, selected_mcp)
         
-        if model_config.provider == "volcengine":
-            return await self._get_openai_response(model_config, enhanced_messages)
-        elif model_config.provider == "anthropic":
-            return await self._get_anthropic_response(model_config, enhanced_messages)
-        elif model_config.provider == "ollama":
-            return await self._get_ollama_response(model_config, enhanced_messages)
-        else:
-            raise ValueError(f"不支持的模型提供商: {model_config.provider}")
+        cache_key = self._completion_cache_key(model_config, enhanced_messages, use_cache, "response")
+        if cache_key:
+            cached = self.completion_cache.get(cache_key)
+            COMPLETION_CACHE.inc(stage="response", result="hit" if cached is not None else "miss")
+            if cached is not None:
+                return "".join(cached)
+        
+        async with self.admission.slot("model", model_config.name):
+            await self._throttle(model_config, enhanced_messages)
+            with span("llm.response", model=model_config.name, provider=model_config.provider):
+                if model_config.provider == "volcengine":
+                    response = await self._get_openai_response(model_config, enhanced_messages)
+                elif model_config.provider == "anthropic":
+                    response = await self._get_anthropic_response(model_config, enhanced_messages)
+                elif model_config.provider == "ollama":
+                    response = await self._get_ollama_response(model_config, enhanced_messages)
+                else:
+                    raise ValueError(f"不支持的模型提供商: {model_config.provider}")
+        
+        if cache_key and response:
+            self.completion_cache.set(cache_key, [response])
+        return response
     
-    async def get_streaming_response(self, messages: List[Dict], model: str, selected_mcp: List[str] = None) -> AsyncGenerator[str, None]:
-        """获取AI流式响应"""
+    async def get_streaming_response(self, messages: List[Dict], model: str, selected_mcp: List[str] = None,
+                                     prepared_messages: Optional[List[Dict]] = None,
+                                     prepared_tools: Optional[List[Dict]] = None,
+                                     use_cache: bool = True,
+                                     stage_models: Optional[Dict[str, str]] = None,
+                                     lease: Optional[Lease] = None) -> AsyncGenerator[str, None]:
+        """获取AI流式响应；prepared_messages / prepared_tools 为 prepare_messages 已构建好的消息和原生工具定义，
+        传入时跳过MCP上下文处理，不再重新加载工具目录，
+        use_cache 为 False 时跳过回复缓存（含函数调用后的分析），
+        stage_models 用于回填各阶段（planning / analysis）实际使用的模型，
+        lease 为调用方创建的该模型并发名额申请（未传入时在这里创建），在模型流开始前等待名额，
+        模型流结束后即释放，不占用到函数调用和分析阶段"""
         model_config = self.config.get_model_config(model)
         if not model_config:
             raise ValueError(f"未找到模型配置: {model}")
+        stage_models = stage_models if stage_models is not None else {}
+        stage_models["planning"] = model_config.name
         
-        # 处理MCP上下文
-        enhanced_messages = await self._enhance_messages_with_mcp(messages, selected_mcp)
+        # 处理MCP上下文；原生工具调用模式下工具定义随请求传给提供商，系统提示中不再列出
+        native_tools = self._uses_native_tools(model_config) and bool(selected_mcp)
+        if prepared_messages is not None:
+            enhanced_messages, tools = prepared_messages, prepared_tools
+        else:
+            enhanced_messages, tools, _ = await self._enhance_messages_with_mcp(messages, selected_mcp, native_tools)
+        if not native_tools:
+            tools = None
         
-        # 收集完整响应用于函数调用检测
-        full_response = ""
+        # 增量识别函数调用（原生工具调用由提供商流转换为同样的调用块）：调用块结束时立即开始执行，标记文本不发给用户
+        parser = FunctionCallStreamParser()
+        started_calls = []
+        limiter = asyncio.Semaphore(self.config.get_function_call_concurrency())
+        try:
+            if lease is None:
+                lease = self.admission.lease("model", model_config.name)
+            if lease is not None:
+                await lease.acquire(self.admission.queue_timeout)
+            with span("llm.stream", model=model_config.name, provider=model_config.provider) as stream_span:
+                async for chunk in self._get_cached_stream(model_config, enhanced_messages, use_cache, "stream", tools):
+                    if not chunk:
+                        continue
+                    for kind, text in parser.feed(chunk):
+                        if kind == "text":
+                            yield text
+                        else:
+                            started_calls.append(self._start_function_calls(text, selected_mcp, limiter))
+                for _, text in parser.flush():
+                    yield text
+                stream_span.set_attribute("function_call_blocks", len(started_calls))
+            if lease is not None:
+                lease.release()
+            
+            # 输出函数调用结果
+            if started_calls:
+                with span("function_calls", count=sum(len(block["calls"]) for block in started_calls)):
+                    async for function_result in self._execute_function_calls(started_calls, use_cache, stage_models):
+                        yield function_result
+        finally:
+            if lease is not None:
+                lease.release()
+            # 流被提前关闭时取消尚未完成的调用
+            for block in started_calls:
+                for call in block["calls"]:
+                    call["task"].cancel()
+    
+    def _uses_native_tools(self, model_config: AIModelConfig) -> bool:
+        return model_config.tool_calling == "native" and model_config.provider in NATIVE_TOOL_PROVIDERS
+    
+    def _completion_cache_key(self, model_config: AIModelConfig, messages: List[Dict], use_cache: bool,
+                              stage: str, tools: Optional[List[Dict]] = None) -> Optional[str]:
+        """回复缓存开启且本次请求未跳过时返回缓存键"""
+        if not self.completion_cache.enabled:
+            return None
+        if not use_cache:
+            COMPLETION_CACHE.inc(stage=stage, result="bypass")
+            return None
+        return completion_key(model_config, messages, tools)
+    
+    async def _get_cached_stream(self, model_config: AIModelConfig, messages: List[Dict], use_cache: bool,
+                                 stage: str, tools: Optional[List[Dict]] = None) -> AsyncGenerator[str, None]:
+        """带回复缓存的流式响应：命中时按原片段回放，未命中时完整结束的流写入缓存"""
+        cache_key = self._completion_cache_key(model_config, messages, use_cache, stage, tools)
+        if cache_key is None:
+            async for chunk in self._get_provider_stream(model_config, messages, tools):
+                yield chunk
+            return
         
+        cached = self.completion_cache.get(cache_key)
+        COMPLETION_CACHE.inc(stage=stage, result="hit" if cached is not None else "miss")
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+        
+        chunks = []
+        async for chunk in self._get_provider_stream(model_config, messages, tools):
+            if chunk:
+                chunks.append(chunk)
+            yield chunk
+        # 只缓存正常结束的流；中途出错或被关闭时不会执行到这里
+        if chunks:
+            self.completion_cache.set(cache_key, chunks)
+    
+    async def _throttle(self, model_config: AIModelConfig, messages: List[Dict],
+                        tools: Optional[List[Dict]] = None):
+        """按模型的 rpm / tpm 等待速率配额；token 数按提示估算加 max_tokens 计算，未限速时不估算"""
+        if self.admission.get_rate_limiter("model", model_config.name) is None:
+            return
+        prompt = "".join(str(message.get("content") or "") for message in messages)
+        if tools:
+            prompt += json.dumps(tools, ensure_ascii=False)
+        await self.admission.throttle("model", model_config.name, estimate_tokens(prompt) + model_config.max_tokens)
+    
+    async def _get_provider_stream(self, model_config: AIModelConfig, messages: List[Dict],
+                                   tools: Optional[List[Dict]] = None) -> AsyncGenerator[str, None]:
+        """按提供商获取流式响应（先等待速率配额）；tools 为原生工具定义，仅 volcengine / anthropic 使用"""
         if model_config.provider == "volcengine":
-            async for chunk in self._get_openai_streaming_response(model_config, enhanced_messages):
-                if chunk:
-                    full_response += chunk
-                    yield chunk
+            stream = self._get_openai_streaming_response(model_config, messages, tools)
         elif model_config.provider == "anthropic":
-            async for chunk in self._get_anthropic_streaming_response(model_config, enhanced_messages):
-                if chunk:
-                    full_response += chunk
-                    yield chunk
+            stream = self._get_anthropic_streaming_response(model_config, messages, tools)
         elif model_config.provider == "ollama":
-            async for chunk in self._get_ollama_streaming_response(model_config, enhanced_messages):
-                if chunk:
-                    full_response += chunk
-                    yield chunk
+            stream = self._get_ollama_streaming_response(model_config, messages)
         else:
             raise ValueError(f"不支持的模型提供商: {model_config.provider}")
-        
-        # 检查并处理函数调用
-        if self._contains_function_call(full_response):
-            async for function_result in self._execute_function_calls(full_response, selected_mcp):
-                yield function_result
-    
-    def _contains_function_call(self, text: str) -> bool:
-        """检查文本是否包含函数调用"""
-        return "<|FunctionCallBegin|>" in text and "<|FunctionCallEnd|>" in text
+        try:
+            await self._throttle(model_config, messages, tools)
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
     
-    async def _execute_function_calls(self, text: str, selected_mcp: List[str]) -> AsyncGenerator[str, None]:
-        """执行函数调用并返回结果"""
-        import re
-        import json
+    def _start_function_calls(self, block: str, selected_mcp: List[str], limiter: asyncio.Semaphore) -> Dict[str, Any]:
+        """解析一个调用块并立即启动其中的MCP调用，并发数受 limiter 限制"""
+        try:
+            # 解析JSON格式的函数调用
+            function_calls = json.loads(block.strip())
+        except json.JSONDecodeError as e:
+            return {"error": f"❌ **JSON解析错误**: {str(e)}\n\n", "calls": []}
         
-        # 提取函数调用内容
-        pattern = r'<\|FunctionCallBegin\|\>(.*?)<\|FunctionCallEnd\|\>'
-        matches = re.findall(pattern, text, re.DOTALL)
+        if not isinstance(function_calls, list):
+            function_calls = [function_calls]
         
-        if not matches:
-            return
+        async def run_limited(function_name: str, parameters: dict):
+            with span("mcp.function_call", function=function_name) as call_span:
+                queued = time.perf_counter()
+                async with limiter:
+                    call_span.set_attribute("queue_ms", round((time.perf_counter() - queued) * 1000, 2))
+                    return await self._call_mcp_function(function_name, parameters, selected_mcp, self.mcp_service)
         
+        calls = []
+        try:
+            for call in function_calls:
+                function_name = call.get("name")
+                parameters = call.get("parameters", {})
+                task = asyncio.create_task(run_limited(function_name, parameters))
+                calls.append({"name": function_name, "parameters": parameters, "task": task})
+        except Exception as e:
+            return {"error": f"❌ **函数调用处理错误**: {str(e)}\n\n", "calls": calls}
+        return {"error": None, "calls": calls}
+    
+    async def _execute_function_calls(self, started_calls: List[Dict[str, Any]], use_cache: bool = True,
+                                      stage_models: Optional[Dict[str, str]] = None) -> AsyncGenerator[str, None]:
+        """按完成顺序输出已启动的函数调用结果（以调用序号标记），分析提示保持原始顺序"""
         try:
-            # 导入MCP服务
-            from mcp_service import MCPService
-            mcp_service = MCPService(self.config)
-            
             yield "\n\n---\n\n🔧 **正在执行MCP工具调用...**\n\n"
             
-            function_results = []  # 收集所有函数调用结果
+            calls = []
+            for block in started_calls:
+                if block["error"]:
+                    yield block["error"]
+                calls.extend(block["calls"])
             
-            for match in matches:
-                try:
-                    # 解析JSON格式的函数调用
-                    function_calls = json.loads(match.strip())
-                    if not isinstance(function_calls, list):
-                        function_calls = [function_calls]
-                    
-                    for call in function_calls:
-                        function_name = call.get("name")
-                        parameters = call.get("parameters", {})
-                        
-                        yield f"📞 **调用mcp**: `{function_name}`\n"
-                        yield f"📋 **参数**:\n```json\n{json.dumps(parameters, ensure_ascii=False, indent=2)}\n```\n\n"
-                        
-                        # 执行函数调用
-                        try:
-                            result = await self._call_mcp_function(
-                                function_name, parameters, selected_mcp, mcp_service
-                            )
-                            
-                            if result:
-                                # 显示格式化的结果
-                                if isinstance(result, dict):
-                                    yield f"✅ **执行成功**\n\n"
-                                    yield await self._format_mcp_result(result, function_name)
-                                elif isinstance(result, list):
-                                    yield f"✅ **执行成功** (返回 {len(result)} 条记录)\n\n"
-                                    yield await self._format_mcp_result(result, function_name)
-                                elif isinstance(result, str):
-                                    # 尝试解析字符串为 JSON
-                                    try:
-                                        parsed_result = json.loads(result)
-                                        yield f"✅ **执行成功**\n\n"
-                                        yield await self._format_mcp_result(parsed_result, function_name)
-                                        result = parsed_result  # 使用解析后的结果
-                                    except json.JSONDecodeError:
-                                        # 如果不是 JSON，直接显示文本
-                                        yield f"✅ **执行结果**:\n{result}\n\n"
-                                else:
-                                    yield f"✅ **执行结果**:\n```json\n{json.dumps(result, ensure_ascii=False, indent=2)}\n```\n\n"
-                                
-                                # 收集结果用于后续 AI 处理
-                                function_results.append({
-                                    "function_name": function_name,
-                                    "parameters": parameters,
-                                    "result": result
-                                })
-                            else:
-                                yield f"❌ **执行失败**: 未找到匹配的MCP函数\n\n"
-                        
-                        except Exception as e:
-                            yield f"❌ **执行错误**: {str(e)}\n\n"
-                
-                except json.JSONDecodeError as e:
-                    yield f"❌ **JSON解析错误**: {str(e)}\n\n"
-                except Exception as e:
-                    yield f"❌ **函数调用处理错误**: {str(e)}\n\n"
+            function_results = {}  # 调用序号 -> 函数调用结果
+            pending = {call["task"]: index for index, call in enumerate(calls, 1)}
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=pending.get):
+                    index = pending.pop(task)
+                    async for output in self._render_function_result(index, calls[index - 1], function_results):
+                        yield output
             
             # 如果有函数调用结果，让 AI 基于结果生成自然语言回答
             if function_results:
                 yield "\n\n---\n\n🤖 **AI 分析结果...**\n\n"
                 
-                # 构建包含函数调用结果的提示
-                ai_prompt = self._build_analysis_prompt(function_results)
-                
                 # 调用 AI 生成基于结果的回答
-                async for analysis_chunk in self._get_ai_analysis(ai_prompt):
+                results = [function_results[index] for index in sorted(function_results)]
+                async for analysis_chunk in self._get_ai_analysis(results, use_cache, stage_models):
                     yield analysis_chunk
         
         except Exception as e:
             yield f"❌ **函数调用系统错误**: {str(e)}\n\n"
     
-    def _build_analysis_prompt(self, function_results: list) -> str:
-        """构建用于 AI 分析的提示"""
-        import json
+    async def _render_function_result(self, index: int, call: Dict[str, Any],
+                                      function_results: Dict[int, Dict[str, Any]]) -> AsyncGenerator[str, None]:
+        """分块输出一个已完成的函数调用；成功时把用于分析的调用结果写入 function_results[index]"""
+        function_name = call["name"]
+        parameters = call["parameters"]
+        yield (
+            f"📞 **调用mcp #{index}**: `{function_name}`\n"
+            f"📋 **参数**:\n```json\n{json.dumps(parameters, ensure_ascii=False, indent=2)}\n```\n\n"
+        )
+        
+        try:
+            result = call["task"].result()
+        except Exception as e:
+            yield f"❌ **执行错误**: {str(e)}\n\n"
+            return
+        
+        if not result:
+            yield f"❌ **执行失败**: 未找到匹配的MCP函数\n\n"
+            return
+        
+        # 显示格式化的结果：摘要先输出，完整数据分块输出
+        with span("format_mcp_result", function=function_name):
+            if isinstance(result, str):
+                # 尝试解析字符串为 JSON
+                try:
+                    parsed_result = json.loads(result)
+                except json.JSONDecodeError:
+                    # 如果不是 JSON，直接显示文本
+                    yield f"✅ **执行结果**:\n{result}\n\n"
+                else:
+                    result = parsed_result  # 使用解析后的结果
+                    yield f"✅ **执行成功**\n\n"
+                    async for part in self._format_mcp_result(result, function_name):
+                        yield part
+            elif isinstance(result, dict):
+                yield f"✅ **执行成功**\n\n"
+                async for part in self._format_mcp_result(result, function_name):
+                    yield part
+            elif isinstance(result, list):
+                yield f"✅ **执行成功** (返回 {len(result)} 条记录)\n\n"
+                async for part in self._format_mcp_result(result, function_name):
+                    yield part
+            else:
+                yield f"✅ **执行结果**:\n```json\n{json.dumps(result, ensure_ascii=False, indent=2)}\n```\n\n"
         
+        # 收集结果用于后续 AI 处理
+        function_results[index] = {
+            "function_name": function_name,
+            "parameters": parameters,
+            "result": result
+        }
+    
+    def _build_analysis_prompt(self, function_results: list, model_config: Optional[AIModelConfig] = None) -> str:
+        """构建用于 AI 分析的提示；MCP 结果经投影、截断后以紧凑 JSON 放入，总量受 token 预算限制"""
         prompt = """请基于以下函数调用结果，用自然语言为用户生成一个清晰、有用的回答。请：
 
 1. 总结主要发现
@@ -201,196 +457,255 @@ class AIService:
 
 """
         
-        for i, func_result in enumerate(function_results, 1):
-            prompt += f"## 调用 {i}: {func_result['function_name']}\n"
-            prompt += f"参数: {json.dumps(func_result['parameters'], ensure_ascii=False)}\n"
-            prompt += f"结果: {json.dumps(func_result['result'], ensure_ascii=False, indent=2)}\n\n"
-        
-        prompt += """
+        closing = """
 请基于以上结果生成一个专业、有用的回答。
 """
+        headers = [
+            f"## 调用 {i}: {func_result['function_name']}\n"
+            f"参数: {json.dumps(func_result['parameters'], ensure_ascii=False)}\n"
+            for i, func_result in enumerate(function_results, 1)
+        ]
+        
+        # 结果预算：配置上限与模型剩余上下文（扣除输出和提示其余部分）中的较小者，按调用平均分配
+        settings = self.config.get_analysis_prompt_config()
+        budget = settings.get("max_result_tokens", 6000)
+        if model_config is not None:
+            overhead = estimate_tokens(prompt + closing + "".join(headers)) + 200  # 200: 系统消息等
+            budget = min(budget, model_config.context_window - model_config.max_tokens - overhead)
+        per_result = max(100, budget // max(1, len(function_results)))
+        
+        for header, func_result in zip(headers, function_results):
+            reduced = reduce_mcp_result(
+                func_result['function_name'], func_result['result'], per_result,
+                max_items=settings.get("max_list_items", 10), max_chars=settings.get("max_string_chars", 500)
+            )
+            prompt += f"{header}结果: {reduced}\n\n"
+        
+        prompt += closing
         return prompt
     
-    async def _get_ai_analysis(self, prompt: str) -> AsyncGenerator[str, None]:
-        """让 AI 分析函数调用结果并生成自然语言回答"""
-        try:
-            # 使用当前配置的默认模型
-            default_model = self.config.get_default_model()
-            model_config = self.config.get_model_config(default_model)
-            
-            if not model_config:
-                yield "⚠️ 无法获取 AI 模型配置，无法生成分析\n"
+    async def _get_ai_analysis(self, function_results: list, use_cache: bool = True,
+                               stage_models: Optional[Dict[str, str]] = None) -> AsyncGenerator[str, None]:
+        """让 AI 分析函数调用结果并生成自然语言回答
+        
+        依次尝试 analysis_model 配置、规划阶段所用模型和默认模型；某个模型在输出任何内容前失败时改用下一个。
+        """
+        stage_models = stage_models if stage_models is not None else {}
+        candidates = self.config.get_stage_models("analysis", stage_models.get("planning"))
+        if not candidates:
+            yield "⚠️ 无法获取 AI 模型配置，无法生成分析\n"
+            return
+        
+        for attempt, model_name in enumerate(candidates, 1):
+            model_config = self.config.get_model_config(model_name)
+            stage_models["analysis"] = model_config.name
+            produced = False
+            try:
+                # 构建分析消息，结果大小按分析所用模型的上下文裁剪
+                analysis_messages = [
+                    {
+                        "role": "system",
+                        "content": "你是一个专业的数据分析助手。请基于提供的函数调用结果，生成清晰、有用的自然语言回答。"
+                    },
+                    {
+                        "role": "user",
+                        "content": self._build_analysis_prompt(function_results, model_config)
+                    }
+                ]
+                
+                # 获取流式响应；名额排队已满或超时时同样改用下一个候选模型
+                async with self.admission.slot("model", model_config.name):
+                    with span("llm.analysis", model=model_config.name, provider=model_config.provider, attempt=attempt):
+                        async for chunk in self._get_cached_stream(model_config, analysis_messages, use_cache, "analysis"):
+                            if chunk:
+                                produced = True
+                                yield chunk
                 return
             
-            # 构建分析消息
-            analysis_messages = [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的数据分析助手。请基于提供的函数调用结果，生成清晰、有用的自然语言回答。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-            
-            # 获取流式响应
-            if model_config.provider == "volcengine":
-                async for chunk in self._get_openai_streaming_response(model_config, analysis_messages):
-                    if chunk:
-                        yield chunk
-            elif model_config.provider == "anthropic":
-                async for chunk in self._get_anthropic_streaming_response(model_config, analysis_messages):
-                    if chunk:
-                        yield chunk
-            elif model_config.provider == "ollama":
-                async for chunk in self._get_ollama_streaming_response(model_config, analysis_messages):
-                    if chunk:
-                        yield chunk
-        
+            except Exception as e:
+                if produced or attempt == len(candidates):
+                    yield f"⚠️ AI 分析过程中出现错误: {str(e)}\n"
+                    return
+                logger.warning("分析模型 %s 调用失败，改用 %s: %s", model_name, candidates[attempt], e)
+    
+    async def _format_mcp_result(self, result: Any, function_name: str) -> AsyncGenerator[str, None]:
+        """格式化 MCP 调用结果：先输出摘要，再按 result_format 配置分块输出、截断、省略完整数据或以链接代替"""
+        try:
+            summary = self._summarize_mcp_result(result, function_name)
+            raw_title = "🔍 **完整数据**"
         except Exception as e:
-            yield f"⚠️ AI 分析过程中出现错误: {str(e)}\n"
+            # 如果格式化失败，回退到原始 JSON 显示
+            summary = f"⚠️ **数据格式化失败**: `{str(e)}`\n\n"
+            raw_title = "📄 **原始数据**"
+        
+        if summary:
+            yield summary
+        async for part in self._stream_raw_result(result, raw_title):
+            yield part
     
-    async def _format_mcp_result(self, result: dict, function_name: str) -> str:
-        """格式化 MCP 调用结果，提供更友好的展示"""
-        import json
+    async def _stream_raw_result(self, result: Any, title: str) -> AsyncGenerator[str, None]:
+        """分块输出完整 JSON 数据，避免为大结果一次性构建整段字符串"""
+        settings = self.config.get_result_format_config()
+        raw_mode = settings.get("raw_mode", "full")
+        if raw_mode == "omit":
+            return
+        if raw_mode == "link":
+            url = await self._store_raw_result(result)
+            yield f"{title}: [{url}]({url})\n\n"
+            return
+        
+        chunk_chars = max(int(settings.get("chunk_chars", 4096)), 1)
+        max_chars = settings.get("max_raw_chars", 20000) if raw_mode == "capped" else None
+        encoder = json.JSONEncoder(ensure_ascii=False, indent=2, default=str)
+        buffer = [f"{title}:\n```json\n"]
+        buffered = len(buffer[0])
+        sent = 0
+        truncated = False
+        for piece in encoder.iterencode(result):
+            if max_chars is not None and sent + len(piece) > max_chars:
+                buffer.append(piece[:max(max_chars - sent, 0)])
+                truncated = True
+                break
+            buffer.append(piece)
+            buffered += len(piece)
+            sent += len(piece)
+            if buffered >= chunk_chars:
+                yield "".join(buffer)
+                buffer, buffered = [], 0
+                # 让出事件循环，序列化大结果时不阻塞其他请求
+                await asyncio.sleep(0)
         
+        if truncated:
+            url = await self._store_raw_result(result)
+            buffer.append(f"\n```\n\n*... 数据过长已截断，完整数据: [{url}]({url})*\n\n")
+        else:
+            buffer.append("\n```\n\n")
+        yield "".join(buffer)
+    
+    async def _store_raw_result(self, result: Any) -> str:
+        """保存完整结果供 GET /results/{id} 读取，返回访问地址"""
+        settings = self.config.get_result_format_config()
+        ttl = settings.get("link_ttl", 3600)
+        result_id = uuid.uuid4().hex
+        self._raw_results[result_id] = (time.monotonic() + ttl, result)
+        while len(self._raw_results) > settings.get("max_stored_results", 200):
+            self._raw_results.popitem(last=False)
+        store = self.mcp_service.store
+        if store is not None:
+            # 写入磁盘缓存，其他 worker 也能读取
+            await store.set(f"raw|{result_id}", result, ttl)
+        return f"{settings.get('base_url', '').rstrip('/')}/results/{result_id}"
+    
+    async def get_raw_result(self, result_id: str) -> Tuple[bool, Any]:
+        """读取保存的完整结果，返回 (是否存在, 结果)"""
+        entry = self._raw_results.get(result_id)
+        if entry is not None:
+            if time.monotonic() < entry[0]:
+                return True, entry[1]
+            del self._raw_results[result_id]
+        store = self.mcp_service.store
+        if store is not None:
+            stored = await store.get(f"raw|{result_id}")
+            if stored is not None:
+                return True, stored[0]
+        return False, None
+    
+    def _summarize_mcp_result(self, result: Any, function_name: str) -> str:
+        """生成 MCP 调用结果的摘要，提供更友好的展示"""
         formatted_output = ""
         
-        try:
-            # 对于企业查询类结果的特殊处理
-            if function_name in ['search_companies', 'search_established_companies', 'search_selfemployed', 'search_established_selfemployed']:
-                if isinstance(result, dict) and 'data' in result:
-                    data = result['data']
-                    if 'num_found' in data:
-                        formatted_output += f"📊 **查询统计**: 共找到 **{data['num_found']:,}** 条记录\n\n"
-                    
-                    if 'data_list' in data and isinstance(data['data_list'], list):
-                        formatted_output += f"📋 **企业列表** (显示前 {min(len(data['data_list']), 10)} 条):\n\n"
-                        for i, company in enumerate(data['data_list'][:10], 1):
-                            formatted_output += f"**{i}. {company.get('companyName', '未知企业')}**\n"
-                            if 'establishDate' in company:
-                                formatted_output += f"   📅 成立时间: `{company['establishDate']}`\n"
-                            if 'legalPerson' in company:
-                                formatted_output += f"   👤 法定代表人: `{company['legalPerson']}`\n"
-                            if 'capital' in company:
-                                formatted_output += f"   💰 注册资本: `{company['capital']}`\n"
-                            if 'companyStatusStr' in company:
-                                formatted_output += f"   📈 企业状态: `{company['companyStatusStr']}`\n"
-                            if 'creditNo' in company:
-                                formatted_output += f"   🆔 统一信用代码: `{company['creditNo']}`\n"
-                            formatted_output += "\n"
-                        
-                        if len(data['data_list']) > 10:
-                            formatted_output += f"*... 还有 {len(data['data_list']) - 10:,} 条记录*\n\n"
+        # 对于企业查询类结果的特殊处理
+        if function_name in COMPANY_SEARCH_FUNCTIONS:
+            if isinstance(result, dict) and 'data' in result:
+                data = result['data']
+                if 'num_found' in data:
+                    formatted_output += f"📊 **查询统计**: 共找到 **{data['num_found']:,}** 条记录\n\n"
                 
-                # 显示分页信息
-                if isinstance(result, dict) and 'data' in result:
-                    data = result['data']
-                    if 'current_page' in data and 'total_page' in data:
-                        formatted_output += f"📄 **分页信息**: 第 {data['current_page']} 页，共 {data['total_page']:,} 页\n\n"
-            
-            # 对于企业基本信息查询的特殊处理
-            elif function_name == 'get_company_info':
-                if isinstance(result, dict):
-                    formatted_output += f"🏢 **企业基本信息**:\n\n"
-                    info_fields = {
-                        'CompanyName': ('🏢', '企业名称'),
-                        'LegalPerson': ('👤', '法定代表人'),
-                        'EstablishDate': ('📅', '成立时间'),
-                        'Capital': ('💰', '注册资本'),
-                        'CompanyType': ('🏷️', '企业类型'),
-                        'CompanyStatus': ('📈', '企业状态'),
-                        'CompanyAddress': ('🏠', '企业地址'),
-                        'BusinessScope': ('💼', '经营范围'),
-                        'CreditNo': ('🆔', '统一信用代码')
-                    }
-                    
-                    for field, (emoji, label) in info_fields.items():
-                        if field in result and result[field]:
-                            value = result[field]
-                            if field == 'BusinessScope' and len(value) > 200:
-                                value = value[:200] + "..."
-                            formatted_output += f"{emoji} **{label}**: `{value}`\n"
-                    formatted_output += "\n"
-            
-            # 对于风险查询的特殊处理
-            elif function_name == 'search_company_risk':
-                if isinstance(result, dict):
-                    formatted_output += f"⚠️ **企业风险信息**:\n\n"
-                    risk_types = {
-                        'self_risk': ('🔴', '自我风险'),
-                        'relation_risk': ('🟡', '关联风险'),
-                        'self_notice': ('ℹ️', '自身重要信息'),
-                        'relation_notice': ('📢', '关联重要信息')
-                    }
-                    
-                    for risk_type, (emoji, label) in risk_types.items():
-                        if risk_type in result and result[risk_type].get('total', 0) > 0:
-                            risk_data = result[risk_type]
-                            formatted_output += f"{emoji} **{label}**: `{risk_data['total']}` 条记录\n"
-                    formatted_output += "\n"
-            
-            # 对于科创评分的特殊处理
-            elif function_name == 'get_stie_score':
-                if isinstance(result, dict):
-                    formatted_output += f"🧬 **企业科创能力评估**:\n\n"
-                    if 'company_name' in result:
-                        formatted_output += f"🏢 **企业名称**: `{result['company_name']}`\n"
-                    if 'score' in result:
-                        formatted_output += f"📊 **科创评分**: `{result['score']}`\n"
-                    if 'level' in result:
-                        formatted_output += f"🏆 **科创等级**: `{result['level']}`\n"
-                    formatted_output += "\n"
-            
-            # 对于通用查询结果的处理
-            else:
-                if isinstance(result, dict):
-                    # 显示状态信息
-                    if 'statusCode' in result:
-                        status_emoji = "✅" if result['statusCode'] == 1 else "❌"
-                        status_text = "成功" if result['statusCode'] == 1 else "失败"
-                        formatted_output += f"{status_emoji} **查询状态**: `{status_text}`\n"
+                if 'data_list' in data and isinstance(data['data_list'], list):
+                    formatted_output += f"📋 **企业列表** (显示前 {min(len(data['data_list']), 10)} 条):\n\n"
+                    for i, company in enumerate(data['data_list'][:10], 1):
+                        formatted_output += f"**{i}. {company.get('companyName', '未知企业')}**\n"
+                        for field, (emoji, label) in COMPANY_LIST_FIELDS.items():
+                            if field in company:
+                                formatted_output += f"   {emoji} {label}: `{company[field]}`\n"
+                        formatted_output += "\n"
                     
-                    if 'statusMessage' in result:
-                        formatted_output += f"📝 **状态信息**: `{result['statusMessage']}`\n\n"
-            
-            # 总是在最后显示美观的完整 JSON 数据
-            formatted_output += f"🔍 **完整数据**:\n```json\n{json.dumps(result, ensure_ascii=False, indent=2)}\n```\n\n"
+                    if len(data['data_list']) > 10:
+                        formatted_output += f"*... 还有 {len(data['data_list']) - 10:,} 条记录*\n\n"
             
-        except Exception as e:
-            # 如果格式化失败，回退到原始 JSON 显示
-            formatted_output = f"⚠️ **数据格式化失败**: `{str(e)}`\n\n"
-            formatted_output += f"📄 **原始数据**:\n```json\n{json.dumps(result, ensure_ascii=False, indent=2)}\n```\n\n"
+            # 显示分页信息
+            if isinstance(result, dict) and 'data' in result:
+                data = result['data']
+                if 'current_page' in data and 'total_page' in data:
+                    formatted_output += f"📄 **分页信息**: 第 {data['current_page']} 页，共 {data['total_page']:,} 页\n\n"
+        
+        # 对于企业基本信息查询的特殊处理
+        elif function_name == 'get_company_info':
+            if isinstance(result, dict):
+                formatted_output += f"🏢 **企业基本信息**:\n\n"
+                for field, (emoji, label) in COMPANY_INFO_FIELDS.items():
+                    if field in result and result[field]:
+                        value = result[field]
+                        if field == 'BusinessScope' and len(value) > 200:
+                            value = value[:200] + "..."
+                        formatted_output += f"{emoji} **{label}**: `{value}`\n"
+                formatted_output += "\n"
+        
+        # 对于风险查询的特殊处理
+        elif function_name == 'search_company_risk':
+            if isinstance(result, dict):
+                formatted_output += f"⚠️ **企业风险信息**:\n\n"
+                for risk_type, (emoji, label) in RISK_TYPES.items():
+                    if risk_type in result and result[risk_type].get('total', 0) > 0:
+                        risk_data = result[risk_type]
+                        formatted_output += f"{emoji} **{label}**: `{risk_data['total']}` 条记录\n"
+                formatted_output += "\n"
+        
+        # 对于科创评分的特殊处理
+        elif function_name == 'get_stie_score':
+            if isinstance(result, dict):
+                formatted_output += f"🧬 **企业科创能力评估**:\n\n"
+                for field, (emoji, label) in STIE_SCORE_FIELDS.items():
+                    if field in result:
+                        formatted_output += f"{emoji} **{label}**: `{result[field]}`\n"
+                formatted_output += "\n"
+        
+        # 对于通用查询结果的处理
+        else:
+            if isinstance(result, dict):
+                # 显示状态信息
+                if 'statusCode' in result:
+                    status_emoji = "✅" if result['statusCode'] == 1 else "❌"
+                    status_text = "成功" if result['statusCode'] == 1 else "失败"
+                    formatted_output += f"{status_emoji} **查询状态**: `{status_text}`\n"
+                
+                if 'statusMessage' in result:
+                    formatted_output += f"📝 **状态信息**: `{result['statusMessage']}`\n\n"
         
         return formatted_output
     
     async def _call_mcp_function(self, function_name: str, parameters: dict, selected_mcp: List[str], mcp_service) -> dict:
-        """在选中的MCP中查找并执行函数"""
-        for mcp_value in selected_mcp:
-            try:
-                # 获取该MCP的工具列表
-                tools = await mcp_service.get_mcp_tools(mcp_value)
-                
-                # 检查函数是否存在于该MCP中
-                function_exists = any(tool.get("name") == function_name for tool in tools)
-                
-                if function_exists:
-                    # 执行MCP函数调用
-                    result = await mcp_service.execute_mcp_function(mcp_value, function_name, parameters)
-                    return result
-            
-            except Exception as e:
-                print(f"MCP {mcp_value} 执行函数 {function_name} 失败: {e}")
-                continue
+        """通过工具路由索引在选中的MCP中查找并执行函数，未找到时返回 None"""
+        route = await mcp_service.resolve_tool(function_name, selected_mcp)
+        if route is None:
+            return None
         
-        return None
+        mcp_value, _ = route
+        # 执行MCP函数调用（参数校验在 execute_mcp_function 中完成）
+        return await mcp_service.execute_mcp_function(mcp_value, function_name, parameters)
     
-    async def _enhance_messages_with_mcp(self, messages: List[Dict], selected_mcp: List[str] = None) -> List[Dict]:
-        """使用MCP增强消息"""
-        if not selected_mcp:
-            return messages
-        
+    async def prepare_messages(self, messages: List[Dict], selected_mcp: List[str] = None,
+                               model: Optional[str] = None) -> Tuple[List[Dict], Optional[List[Dict]], Dict[str, Dict[str, Any]]]:
+        """构建发送给模型的流式请求消息，返回 (消息列表, 原生工具定义, 各MCP工具目录加载情况)；
+        model 使用原生工具调用时系统提示中不列出工具，工具定义与系统提示来自同一次目录加载，否则为 None"""
+        model_config = self.config.get_model_config(model) if model else None
+        native_tools = model_config is not None and self._uses_native_tools(model_config)
+        return await self._enhance_messages_with_mcp(messages, selected_mcp, native_tools)
+    
+    async def _enhance_messages_with_mcp(self, messages: List[Dict], selected_mcp: List[str] = None,
+                                         native_tools: bool = False) -> Tuple[List[Dict], Optional[List[Dict]], Dict[str, Dict[str, Any]]]:
+        """使用MCP增强消息，返回 (消息列表, 原生工具定义, 各MCP加载情况)；原生工具定义仅在 native_tools 时返回；
+        未选择MCP时同样转换为字典列表，提供商和限速估算只处理字典"""
         # 确保 messages 是字典列表格式
         enhanced_messages = []
         for msg in messages:
@@ -399,10 +714,141 @@ class AIService:
             elif hasattr(msg, 'dict'):  # 旧版 Pydantic
                 enhanced_messages.append(msg.dict())
             else:  # 已经是字典
-                enhanced_messages.append(msg)
+                enhanced_messages.append(dict(msg))
+        if not selected_mcp:
+            return enhanced_messages, None, {}
+        
+        with span("mcp.context", selected_mcp=list(selected_mcp)) as context_span:
+            mcp_context, tools, mcp_timings = await self._get_mcp_context(selected_mcp, native_tools)
+            context_span.set_attribute("context_tokens", estimate_tokens(mcp_context))
+        
+        # 如果第一条消息是系统消息，则追加MCP上下文
+        if enhanced_messages and enhanced_messages[0].get("role") == "system":
+            enhanced_messages[0]["content"] += f"\n\n{mcp_context}"
+        else:
+            # 否则在开头插入系统消息
+            enhanced_messages.insert(0, {
+                "role": "system",
+                "content": mcp_context
+            })
+        
+        return enhanced_messages, (tools if native_tools else None), mcp_timings
+    
+    async def _gather_mcp_tools(self, mcp_configs: list) -> Tuple[list, Dict[str, Dict[str, Any]]]:
+        """并发获取多个MCP的工具目录，整体不超过截止时间；超时的MCP以提示代替"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        timings = {}
+        
+        async def load(mcp_config):
+            with span("mcp.tools", mcp_value=mcp_config.value):
+                try:
+                    tools = await self.mcp_service.get_mcp_tools(mcp_config.value)
+                    timings[mcp_config.value] = {"status": "ok", "tool_count": len(tools)}
+                    return tools
+                except Exception as e:
+                    timings[mcp_config.value] = {"status": "error", "error": str(e)}
+                    raise
+                finally:
+                    timings.setdefault(mcp_config.value, {})["latency_ms"] = round((loop.time() - started) * 1000)
+        
+        tasks = [asyncio.create_task(load(mcp_config)) for mcp_config in mcp_configs]
+        timeout = self.config.get_mcp_catalog_timeout()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        
+        sections = []
+        for mcp_config, task in zip(mcp_configs, tasks):
+            if not task.done():
+                # 共享的目录加载任务不受影响，后续请求可直接命中缓存
+                task.cancel()
+                timings[mcp_config.value] = {"status": "timeout", "latency_ms": round(timeout * 1000)}
+                sections.append((mcp_config, None, "工具加载超时，请稍后重试"))
+            elif task.exception() is not None:
+                sections.append((mcp_config, None, f"工具加载失败: {str(task.exception())}"))
+            else:
+                sections.append((mcp_config, task.result(), None))
+        return sections, timings
+    
+    async def _get_mcp_context(self, selected_mcp: List[str],
+                               native_tools: bool = False) -> Tuple[str, List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        """获取MCP工具上下文，返回 (系统提示, 原生工具定义, 各MCP加载情况)；
+        按 (调用模式, 排序后的MCP选择, 工具目录版本) 缓存渲染结果"""
+        mcp_configs = []
+        for mcp_value in sorted(set(selected_mcp)):
+            mcp_config = self.config.get_mcp_config(mcp_value)
+            if mcp_config:
+                mcp_configs.append(mcp_config)
+        
+        sections, timings = await self._gather_mcp_tools(mcp_configs)
+        cacheable = all(tools for _, tools, _ in sections)
+        
+        versions = tuple(
+            (mcp_config.value, self.mcp_service.get_catalog_version(mcp_config.value))
+            for mcp_config, _, _ in sections
+        )
+        cache_key = ("native" if native_tools else "marker", versions)
+        if cacheable and all(version for _, version in versions):
+            cached = self._mcp_context_cache.get(cache_key)
+            if cached is not None:
+                self._mcp_context_cache.move_to_end(cache_key)
+                return cached[0], cached[1], timings
+            rendered = self._render_context_and_tools(sections, native_tools)
+            self._mcp_context_cache[cache_key] = rendered
+            while len(self._mcp_context_cache) > MCP_CONTEXT_CACHE_SIZE:
+                self._mcp_context_cache.popitem(last=False)
+            return rendered[0], rendered[1], timings
         
-        # 构建详细的MCP工具上下文
-        mcp_context = """你现在可以使用以下MCP工具来帮助用户。当需要调用工具时，请使用以下格式：
+        # 含有加载失败或超时的上下文不缓存，下次请求重新渲染
+        mcp_context, tools = self._render_context_and_tools(sections, native_tools)
+        return mcp_context, tools, timings
+    
+    def _render_context_and_tools(self, sections: list, native_tools: bool) -> Tuple[str, List[Dict[str, Any]]]:
+        if not native_tools:
+            return self._render_mcp_context(sections), []
+        return self._render_native_mcp_context(sections), self._build_tool_definitions(sections)
+    
+    def _build_tool_definitions(self, sections: list) -> List[Dict[str, Any]]:
+        """原生工具定义（name / description / parameters），同名工具以先出现的MCP为准"""
+        definitions = {}
+        for _, tools, _ in sections:
+            for tool in tools or []:
+                tool_name = tool.get('name')
+                if not tool_name or tool_name in definitions:
+                    continue
+                parameters = tool.get('parameters')
+                if not isinstance(parameters, dict) or parameters.get('type') != 'object':
+                    parameters = {"type": "object", "properties": {}}
+                definitions[tool_name] = {
+                    "name": tool_name,
+                    "description": tool.get('description') or '',
+                    "parameters": parameters
+                }
+        return list(definitions.values())
+    
+    def _render_native_mcp_context(self, sections: list) -> str:
+        """原生工具调用模式的MCP上下文：只说明可用的MCP，工具定义随请求传给提供商"""
+        parts = ["你现在可以通过工具调用使用以下MCP服务来帮助用户：\n\n"]
+        for mcp_config, tools, error in sections:
+            parts.append(f"## {mcp_config.label} ({mcp_config.value})\n")
+            parts.append(f"描述: {mcp_config.description}\n\n")
+            if error:
+                parts.append(f"{error}\n\n")
+            elif not tools:
+                parts.append("工具加载中，请稍后...\n\n")
+        
+        parts.append("""
+重要提示：
+1. 当用户询问需要查询数据时，请根据用户的具体需求选择合适的工具
+2. 调用工具前，请确保参数正确且完整
+3. 必需参数不能为空，可选参数可以省略
+4. 调用工具后，系统会执行工具并基于返回的结果向用户提供信息
+""")
+        return "".join(parts)
+    
+    def _render_mcp_context(self, sections: list) -> str:
+        """渲染MCP工具上下文"""
+        parts = ["""你现在可以使用以下MCP工具来帮助用户。当需要调用工具时，请使用以下格式：
 
 <|FunctionCallBegin|>
 [{"name": "工具名称", "parameters": {"参数名": "参数值"}}]
@@ -410,71 +856,79 @@ class AIService:
 
 可用的MCP工具：
 
-"""
+"""]
         
-        for mcp_value in selected_mcp:
-            mcp_config = self.config.get_mcp_config(mcp_value)
-            if mcp_config:
-                mcp_context += f"## {mcp_config.label} ({mcp_value})\n"
-                mcp_context += f"描述: {mcp_config.description}\n\n"
+        for mcp_config, tools, error in sections:
+            parts.append(f"## {mcp_config.label} ({mcp_config.value})\n")
+            parts.append(f"描述: {mcp_config.description}\n\n")
+            
+            if error:
+                parts.append(f"{error}\n\n")
+                continue
+            if not tools:
+                parts.append("工具加载中，请稍后...\n\n")
+                continue
+            
+            for tool in tools:
+                tool_name = tool.get('name', 'unknown')
+                tool_desc = tool.get('description', '无描述')
+                tool_params = tool.get('parameters', {})
                 
-                # 获取详细的工具列表
-                try:
-                    tools = await asyncio.wait_for(
-                        self._get_mcp_tools_safe(mcp_config), 
-                        timeout=5.0  # 增加超时时间到5秒
-                    )
-                    if tools:
-                        for tool in tools:
-                            tool_name = tool.get('name', 'unknown')
-                            tool_desc = tool.get('description', '无描述')
-                            tool_params = tool.get('parameters', {})
-                            
-                            mcp_context += f"### {tool_name}\n"
-                            mcp_context += f"功能: {tool_desc}\n"
-                            
-                            # 添加参数信息
-                            if tool_params and isinstance(tool_params, dict):
-                                properties = tool_params.get('properties', {})
-                                required = tool_params.get('required', [])
-                                if properties:
-                                    mcp_context += "参数:\n"
-                                    for param_name, param_info in properties.items():
-                                        param_type = param_info.get('type', 'string')
-                                        param_desc = param_info.get('description', param_info.get('title', ''))
-                                        is_required = param_name in required
-                                        required_mark = " (必需)" if is_required else " (可选)"
-                                        mcp_context += f"  - {param_name} ({param_type}){required_mark}: {param_desc}\n"
-                            
-                            # 添加调用示例
-                            mcp_context += f"调用示例: <|FunctionCallBegin|>[{{\"name\": \"{tool_name}\", \"parameters\": {{}}}}]<|FunctionCallEnd|>\n\n"
-                    else:
-                        mcp_context += "工具加载中，请稍后...\n\n"
-                except asyncio.TimeoutError:
-                    mcp_context += "工具加载超时，请稍后重试\n\n"
-                except Exception as e:
-                    mcp_context += f"工具加载失败: {str(e)}\n\n"
+                parts.append(f"### {tool_name}\n")
+                parts.append(f"功能: {tool_desc}\n")
+                
+                # 添加参数信息
+                if tool_params and isinstance(tool_params, dict):
+                    properties = tool_params.get('properties', {})
+                    required = tool_params.get('required', [])
+                    if properties:
+                        parts.append("参数:\n")
+                        for param_name, param_info in properties.items():
+                            param_type = param_info.get('type', 'string')
+                            param_desc = param_info.get('description', param_info.get('title', ''))
+                            required_mark = " (必需)" if param_name in required else " (可选)"
+                            parts.append(f"  - {param_name} ({param_type}){required_mark}: {param_desc}\n")
+                
+                # 添加调用示例
+                parts.append(f"调用示例: <|FunctionCallBegin|>[{{\"name\": \"{tool_name}\", \"parameters\": {{}}}}]<|FunctionCallEnd|>\n\n")
         
-        mcp_context += """
+        parts.append("""
 重要提示：
 1. 当用户询问需要查询数据时，请根据用户的具体需求选择合适的工具
 2. 调用工具前，请确保参数正确且完整
 3. 必需参数不能为空，可选参数可以省略或设为null
 4. 每次只调用一个工具，等待结果后再决定是否需要调用其他工具
 5. 调用工具后，请根据返回的结果向用户提供有用的信息
-"""
-        
-        # 如果第一条消息是系统消息，则追加MCP上下文
-        if enhanced_messages and enhanced_messages[0].get("role") == "system":
-            enhanced_messages[0]["content"] += f"\n\n{mcp_context}"
-        else:
-            # 否则在开头插入系统消息
-            enhanced_messages.insert(0, {
-                "role": "system",
-                "content": mcp_context
-            })
-        
-        return enhanced_messages
+""")
+        return "".join(parts)
+    
+    def invalidate_models(self, model_configs: List[AIModelConfig]):
+        """丢弃指定模型的客户端，下次请求按新配置创建；进行中的流继续使用已拿到的旧客户端"""
+        for model_config in model_configs:
+            self._clients.pop(f"{model_config.provider}_{model_config.name}", None)
+    
+    def invalidate_mcp_context(self, mcp_value: Optional[str] = None):
+        """清除包含指定MCP（默认全部）的已渲染上下文"""
+        if mcp_value is None:
+            self._mcp_context_cache.clear()
+            return
+        for cache_key in list(self._mcp_context_cache):
+            if any(value == mcp_value for value, _ in cache_key[1]):
+                del self._mcp_context_cache[cache_key]
+    
+    def get_mcp_context_stats(self) -> List[Dict[str, Any]]:
+        """获取已缓存的MCP上下文大小"""
+        return [
+            {
+                "mode": mode,
+                "selected_mcp": [value for value, _ in versions],
+                "catalog_versions": {value: version for value, version in versions},
+                "bytes": len(mcp_context.encode("utf-8")),
+                "estimated_tokens": estimate_tokens(mcp_context),
+                "tool_definitions_tokens": estimate_tokens(json.dumps(tools, ensure_ascii=False)) if tools else 0
+            }
+            for (mode, versions), (mcp_context, tools) in self._mcp_context_cache.items()
+        ]
     
     async def _get_openai_response(self, model_config: AIModelConfig, messages: List[Dict]) -> str:
         """获取OpenAI响应"""
@@ -489,25 +943,54 @@ class AIService:
             )
             return response.choices[0].message.content
         except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=model_config.provider, mode="response")
             raise Exception(f"OpenAI API 调用失败: {str(e)}")
     
-    async def _get_openai_streaming_response(self, model_config: AIModelConfig, messages: List[Dict]) -> AsyncGenerator[str, None]:
-        """获取OpenAI流式响应"""
+    async def _get_openai_streaming_response(self, model_config: AIModelConfig, messages: List[Dict],
+                                             tools: Optional[List[Dict]] = None) -> AsyncGenerator[str, None]:
+        """获取OpenAI流式响应；传入 tools 时使用原生工具调用，每个调用的参数完整后立即输出为调用块"""
         client = self._get_client(model_config)
         
         try:
+            request = {}
+            if tools:
+                request["tools"] = [{"type": "function", "function": tool} for tool in tools]
             stream = await client.chat.completions.create(
                 model=model_config.model_id,
                 messages=messages,
                 max_tokens=model_config.max_tokens,
                 temperature=model_config.temperature,
-                stream=True
+                stream=True,
+                **request
             )
             
+            tool_calls = {}  # 调用序号 -> [函数名, 参数片段]
             async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    yield choice.delta.content
+                for tool_call in choice.delta.tool_calls or []:
+                    # 出现新的调用序号时，之前的调用参数已经完整
+                    for index in sorted(i for i in tool_calls if i < tool_call.index):
+                        name, arguments = tool_calls.pop(index)
+                        yield format_call_block(name, "".join(arguments))
+                    call = tool_calls.setdefault(tool_call.index, ["", []])
+                    if tool_call.function and tool_call.function.name:
+                        call[0] = tool_call.function.name
+                    if tool_call.function and tool_call.function.arguments:
+                        call[1].append(tool_call.function.arguments)
+                if choice.finish_reason:
+                    for index in sorted(tool_calls):
+                        name, arguments = tool_calls[index]
+                        yield format_call_block(name, "".join(arguments))
+                    tool_calls.clear()
+            for index in sorted(tool_calls):
+                name, arguments = tool_calls[index]
+                yield format_call_block(name, "".join(arguments))
         except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=model_config.provider, mode="stream")
             raise Exception(f"OpenAI Streaming API 调用失败: {str(e)}")
     
     async def _get_anthropic_response(self, model_config: AIModelConfig, messages: List[Dict]) -> str:
@@ -535,10 +1018,12 @@ class AIService:
             
             return response.content[0].text
         except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=model_config.provider, mode="response")
             raise Exception(f"Anthropic API 调用失败: {str(e)}")
     
-    async def _get_anthropic_streaming_response(self, model_config: AIModelConfig, messages: List[Dict]) -> AsyncGenerator[str, None]:
-        """获取Anthropic流式响应"""
+    async def _get_anthropic_streaming_response(self, model_config: AIModelConfig, messages: List[Dict],
+                                                tools: Optional[List[Dict]] = None) -> AsyncGenerator[str, None]:
+        """获取Anthropic流式响应；传入 tools 时使用原生工具调用，每个 tool_use 块结束后立即输出为调用块"""
         client = self._get_client(model_config)
         
         try:
@@ -552,16 +1037,39 @@ class AIService:
                 else:
                     user_messages.append(msg)
             
+            request = {}
+            if tools:
+                request["tools"] = [
+                    {"name": tool["name"], "description": tool["description"], "input_schema": tool["parameters"]}
+                    for tool in tools
+                ]
             async with client.messages.stream(
                 model=model_config.model_id,
                 max_tokens=model_config.max_tokens,
                 temperature=model_config.temperature,
                 system=system_message,
-                messages=user_messages
+                messages=user_messages,
+                **request
             ) as stream:
-                async for chunk in stream.text_stream:
-                    yield chunk
+                if not tools:
+                    async for chunk in stream.text_stream:
+                        yield chunk
+                    return
+                
+                tool_blocks = {}  # 内容块序号 -> [函数名, 参数片段]
+                async for event in stream:
+                    if event.type == "content_block_start" and event.content_block.type == "tool_use":
+                        tool_blocks[event.index] = [event.content_block.name, []]
+                    elif event.type == "content_block_delta":
+                        if event.delta.type == "text_delta":
+                            yield event.delta.text
+                        elif event.delta.type == "input_json_delta" and event.index in tool_blocks:
+                            tool_blocks[event.index][1].append(event.delta.partial_json)
+                    elif event.type == "content_block_stop" and event.index in tool_blocks:
+                        name, arguments = tool_blocks.pop(event.index)
+                        yield format_call_block(name, "".join(arguments))
         except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=model_config.provider, mode="stream")
             raise Exception(f"Anthropic Streaming API 调用失败: {str(e)}")
     
     async def _get_ollama_response(self, model_config: AIModelConfig, messages: List[Dict]) -> str:
@@ -569,7 +1077,7 @@ class AIService:
         client = self._get_client(model_config)
         
         try:
-            response = await client.post("/api/chat", json={
+            response = await client.post(self._ollama_url(model_config, "/api/chat"), json={
                 "model": model_config.model_id,
                 "messages": messages,
                 "stream": False,
@@ -581,6 +1089,7 @@ class AIService:
             response.raise_for_status()
             return response.json()["message"]["content"]
         except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=model_config.provider, mode="response")
             raise Exception(f"Ollama API 调用失败: {str(e)}")
     
     async def _get_ollama_streaming_response(self, model_config: AIModelConfig, messages: List[Dict]) -> AsyncGenerator[str, None]:
@@ -588,7 +1097,7 @@ class AIService:
         client = self._get_client(model_config)
         
         try:
-            async with client.stream("POST", "/api/chat", json={
+            async with client.stream("POST", self._ollama_url(model_config, "/api/chat"), json={
                 "model": model_config.model_id,
                 "messages": messages,
                 "stream": True,
@@ -604,17 +1113,9 @@ class AIService:
                         if "message" in data and "content" in data["message"]:
                             yield data["message"]["content"]
         except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=model_config.provider, mode="stream")
             raise Exception(f"Ollama Streaming API 调用失败: {str(e)}")
     
-    async def _get_mcp_tools_safe(self, mcp_config):
-        """安全获取 MCP 工具列表，不阻塞主流程"""
-        try:
-            from mcp_service import MCPService
-            mcp_service = MCPService(self.config)
-            return await mcp_service.get_mcp_tools(mcp_config.value)
-        except Exception:
-            return []
-    
     def is_healthy(self) -> bool:
         """检查服务健康状态"""
         try:
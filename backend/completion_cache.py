@@ -0,0 +1,72 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import AIModelConfig, Config
+
+
+def completion_key(model_config: AIModelConfig, messages: List[Dict], tools: Optional[List[Dict]] = None) -> str:
+    """(提供商, 模型, 生成参数, 消息列表[, 原生工具定义]) 的哈希"""
+    payload = {
+        "provider": model_config.provider,
+        "api_base": model_config.api_base,
+        "model_id": model_config.model_id,
+        "max_tokens": model_config.max_tokens,
+        "temperature": model_config.temperature,
+        "messages": messages
+    }
+    if tools:
+        payload["tools"] = tools
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """模型回复缓存（默认关闭）
+
+    以片段列表保存完整结束的回复，命中流式请求时按原片段回放，命中非流式请求时返回拼接后的文本。
+    超过 max_entry_chars 的回复不缓存；条目按 ttl 过期、按 max_entries 做 LRU 淘汰。
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[str, ...]]]" = OrderedDict()  # key -> (过期时间, 片段)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        return self.config.get_completion_cache_config()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.settings.get("enabled", False))
+
+    def get(self, key: str) -> Optional[Tuple[str, ...]]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[0]:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, chunks: List[str]):
+        settings = self.settings
+        if sum(len(chunk) for chunk in chunks) > settings.get("max_entry_chars", 20000):
+            return
+        self._entries[key] = (time.monotonic() + settings.get("ttl", 600), tuple(chunks))
+        self._entries.move_to_end(key)
+        max_entries = settings.get("max_entries", 256)
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "entries": len(self._entries), "hits": self.hits, "misses": self.misses}
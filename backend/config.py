@@ -1,10 +1,15 @@
 import os
+import copy
 import json
-from typing import List, Dict, Any, Optional
+import logging
+from types import MappingProxyType
+from typing import List, Dict, Any, Mapping, Optional
 from dataclasses import dataclass
 import yaml
 
-@dataclass
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
 class AIModelConfig:
     name: str
     provider: str  # openai, anthropic, ollama, etc.
@@ -13,8 +18,14 @@ class AIModelConfig:
     model_id: str = ""
     max_tokens: int = 2048
     temperature: float = 0.7
+    context_window: int = 32768  # 模型上下文长度（token），用于限制分析提示中 MCP 结果的大小
+    tool_calling: str = "marker"  # marker：文本标记协议；native：使用提供商原生工具调用（volcengine / anthropic，ollama 始终为 marker）
+    max_concurrency: Optional[int] = None  # 同时进行的调用数上限，None 使用 admission.model_max_concurrency，0 表示不限制
+    max_queue: Optional[int] = None  # 等待名额的最大请求数，None 使用 admission.model_max_queue
+    rpm: Optional[float] = None  # 每分钟请求数上限，None 使用 rate_limit.model_rpm，0 表示不限制
+    tpm: Optional[float] = None  # 每分钟 token 数上限（提示估算 + max_tokens），None 使用 rate_limit.model_tpm
 
-@dataclass
+@dataclass(frozen=True)
 class MCPConfig:
     label: str
     value: str
@@ -22,14 +33,116 @@ class MCPConfig:
     enabled: bool = True
     mcp_url: Optional[str] = None  # 外部 MCP URL
     tools: List[Dict[str, Any]] = None  # MCP 支持的工具列表
+    max_sessions: int = 2  # 每个 MCP 服务最多保持的并发会话数
+    health_check_interval: float = 30.0  # 空闲会话 ping 间隔（秒），0 表示不检查
+    tools_ttl: float = 300.0  # 工具目录缓存有效期（秒），过期后后台刷新，0 表示永不过期
+    result_ttl: Optional[float] = None  # 函数调用结果缓存有效期（秒），None 使用 mcp_result_cache.default_ttl，0 表示不缓存
+    tool_result_ttl: Dict[str, float] = None  # 按函数名覆盖 result_ttl，0 表示该函数不缓存
+    max_concurrency: Optional[int] = None  # 同时进行的函数调用数上限，None 使用 admission.mcp_max_concurrency，0 表示不限制
+    max_queue: Optional[int] = None  # 等待名额的最大调用数，None 使用 admission.mcp_max_queue
+    rpm: Optional[float] = None  # 每分钟函数调用数上限，None 使用 rate_limit.mcp_rpm，0 表示不限制
+
+def _freeze(value: Any) -> Any:
+    """递归转换为只读视图：dict -> MappingProxyType，list -> tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+class ConfigSnapshot:
+    """某一时刻配置的只读快照
+
+    加载时一次性解析模型和 MCP 配置、解析环境变量中的 API 密钥，并建立按名称/值的索引；
+    重新加载时整体替换快照，正在处理的请求继续使用它已拿到的旧快照。
+    data 是深度只读的视图，修改配置需要构造新的快照。
+    """
+    __slots__ = ("data", "_raw", "models", "available_models", "mcp_configs", "mcp_options")
+
+    def __init__(self, data: Dict[str, Any], get_api_key):
+        # 复制一份，调用方之后修改传入的字典不影响快照
+        data = copy.deepcopy(data)
+        models: Dict[str, AIModelConfig] = {}
+        available_models = []
+        for model in data.get("ai_models") or []:
+            # 从环境变量获取API密钥
+            api_key = model.get("api_key") or get_api_key(model.get("provider") or "")
+            model_config = AIModelConfig(
+                name=model.get("name"),
+                provider=model.get("provider"),
+                api_key=api_key,
+                api_base=model.get("api_base"),
+                model_id=model.get("model_id"),
+                max_tokens=model.get("max_tokens", 2048),
+                temperature=model.get("temperature", 0.7),
+                context_window=model.get("context_window", 32768),
+                tool_calling=model.get("tool_calling", "marker"),
+                max_concurrency=model.get("max_concurrency"),
+                max_queue=model.get("max_queue"),
+                rpm=model.get("rpm"),
+                tpm=model.get("tpm")
+            )
+            # 同名模型以第一个为准
+            models.setdefault(model_config.name, model_config)
+            available_models.append({
+                "name": model_config.name,
+                "provider": model_config.provider,
+                "model_id": model_config.model_id,
+                "available": api_key is not None or model_config.provider == "ollama"
+            })
+
+        mcp_configs: Dict[str, MCPConfig] = {}
+        for mcp in data.get("mcp_options") or []:
+            mcp_configs.setdefault(mcp.get("value"), MCPConfig(
+                label=mcp.get("label"),
+                value=mcp.get("value"),
+                description=mcp.get("description"),
+                enabled=mcp.get("enabled", True),
+                mcp_url=mcp.get("mcp_url"),
+                tools=mcp.get("tools", []),
+                max_sessions=mcp.get("max_sessions", 2),
+                health_check_interval=mcp.get("health_check_interval", 30.0),
+                tools_ttl=mcp.get("tools_ttl", 300.0),
+                result_ttl=mcp.get("result_ttl"),
+                tool_result_ttl=mcp.get("tool_result_ttl") or {},
+                max_concurrency=mcp.get("max_concurrency"),
+                max_queue=mcp.get("max_queue"),
+                rpm=mcp.get("rpm")
+            ))
+
+        object.__setattr__(self, "data", _freeze(data))
+        object.__setattr__(self, "_raw", data)
+        object.__setattr__(self, "models", models)
+        object.__setattr__(self, "available_models", tuple(available_models))
+        object.__setattr__(self, "mcp_configs", mcp_configs)
+        object.__setattr__(self, "mcp_options", tuple(
+            mcp for mcp in data.get("mcp_options") or [] if mcp.get("enabled", True)
+        ))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ConfigSnapshot 是只读的")
+
+    def to_dict(self) -> Dict[str, Any]:
+        """返回配置数据的可修改副本"""
+        return copy.deepcopy(self._raw)
 
 class Config:
     def __init__(self, config_file: str = "config.yaml"):
         self.config_file = config_file
-        self.config_data = self._load_config()
+        self._snapshot = ConfigSnapshot(self._load_config(), self._get_api_key)
+        self._mtime = self._get_mtime()
+    
+    @property
+    def config_data(self) -> Mapping[str, Any]:
+        """当前快照的原始配置数据（只读视图）"""
+        return self._snapshot.data
+    
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        return self._snapshot
         
-    def _load_config(self) -> Dict[str, Any]:
-        """加载配置文件"""
+    def _load_config(self, strict: bool = False) -> Dict[str, Any]:
+        """加载配置文件；strict 为 True 时读取失败直接抛出异常，而不是回退到默认配置"""
         # 默认配置
         default_config = {
             "ai_models": [
@@ -44,6 +157,11 @@ class Config:
                 }
             ],
             "default_model": "doubao",
+            "planning_model": None,  # 请求未指定模型时规划（工具调用）阶段使用的模型，可为列表，依次回退，最后为 default_model
+            "analysis_model": None,  # 工具调用后分析结果使用的模型，可为列表，依次回退，然后为规划模型、default_model
+            "mcp_catalog_timeout": 5.0,
+            "function_call_concurrency": 4,
+            "config_watch_interval": 2.0,
             "mcp_options": [
                 {
                     "label": "数据查询",
@@ -86,6 +204,84 @@ class Config:
                     "tools": []
                 }
             ],
+            "streaming": {
+                "mode": "coalesced",  # raw: 逐片段转发; coalesced: 合并后发送; paced: 逐片段限速发送
+                "flush_chars": 256,
+                "flush_interval_ms": 30,
+                "pace_interval_ms": 20,
+                "disconnect_poll_ms": 500  # 检查客户端是否断开的间隔，断开后取消上游模型流和 MCP 调用
+            },
+            "http": {  # 连接池配置修改后需要重启服务才会生效
+                "max_connections": 100,
+                "max_keepalive_connections": 20,
+                "keepalive_expiry": 30.0,
+                "connect_timeout": 5.0,
+                "read_timeout": 60.0,
+                "write_timeout": 10.0,
+                "pool_timeout": 10.0,
+                "http2": True,  # 依赖 h2（已在 requirements.txt 中），未安装时回退到 HTTP/1.1 并记录警告
+                "hosts": {}  # 按主机名覆盖以上配置
+            },
+            "admission": {
+                "model_max_concurrency": 8,  # 每个模型同时进行的调用数，ai_models 中可按模型覆盖，0 表示不限制
+                "model_max_queue": 32,  # 名额占满后最多排队的请求数，队列已满时返回 429
+                "mcp_max_concurrency": 8,  # 每个 MCP 同时进行的函数调用数，mcp_options 中可按 MCP 覆盖
+                "mcp_max_queue": 64,
+                "queue_timeout": 30.0  # 排队最长等待时间（秒），超时返回 503
+            },
+            "rate_limit": {
+                "model_rpm": 0,  # 每个模型每分钟请求数，ai_models 中可按模型用 rpm 覆盖，0 表示不限制
+                "model_tpm": 0,  # 每个模型每分钟 token 数（提示估算 + max_tokens），可用 tpm 覆盖
+                "mcp_rpm": 0,  # 每个 MCP 每分钟函数调用数，mcp_options 中可用 rpm 覆盖
+                "burst_seconds": 5.0,  # 令牌桶容量，按多少秒的配额计算，越小发送越平滑
+                "max_wait": 30.0  # 需要等待超过该时长（秒）时直接返回 429
+            },
+            "mcp_result_cache": {
+                "max_entries": 1000,  # 函数调用结果缓存最多条目数，超出后按最近最少使用淘汰
+                "default_ttl": 0  # 默认不缓存；只对结果确定的 MCP / 函数在 mcp_options 中用 result_ttl / tool_result_ttl 开启
+            },
+            "analysis_prompt": {
+                "max_result_tokens": 6000,  # 分析提示中所有 MCP 结果的 token 上限（还受模型 context_window 限制）
+                "max_list_items": 10,  # 列表最多保留的条目数，其余以计数代替
+                "max_string_chars": 500  # 单个字符串最多保留的字符数
+            },
+            "result_format": {
+                "raw_mode": "full",  # 完整数据的展示方式：full 全部输出 / capped 截断 / omit 省略 / link 以链接代替
+                "max_raw_chars": 20000,  # capped 模式下最多输出的字符数，超出部分以链接代替
+                "chunk_chars": 4096,  # 完整数据分块输出的块大小
+                "base_url": "",  # 结果链接的前缀，为空时使用相对路径 /results/{id}
+                "link_ttl": 3600.0,  # 链接有效期（秒）
+                "max_stored_results": 200  # 内存中最多保存的结果数
+            },
+            "completion_cache": {
+                "enabled": False,  # 相同模型、参数和消息的回复直接从缓存返回
+                "ttl": 600.0,
+                "max_entries": 256,
+                "max_entry_chars": 20000  # 超过该长度的回复不缓存
+            },
+            "disk_cache": {
+                "enabled": False,  # 开启后工具目录和函数调用结果同时写入本地 SQLite，多个 worker 共享
+                "path": "mcp_cache.sqlite3",
+                "compress_level": 6,
+                "max_size_mb": 512,
+                "compaction_interval": 300.0  # 删除过期条目、回收空间的间隔（秒）
+            },
+            "logging": {
+                "level": "INFO",
+                "format": "text",  # text 或 json
+                "max_payload_chars": 2000,  # 工具目录、MCP 原始结果等大对象的截断长度
+                "payload_sample_rate": 1.0,  # 大对象日志的采样率
+                "queue_size": 10000,  # 日志队列满时丢弃新日志，不阻塞请求
+                "loggers": {}  # 按模块设置级别，如 mcp_service: DEBUG
+            },
+            "tracing": {
+                "enabled": False,
+                "exporter": "jsonl",  # jsonl: 写入 path 文件; otlp: 发送到 otlp_endpoint
+                "path": "traces.jsonl",
+                "otlp_endpoint": "http://localhost:4318/v1/traces",
+                "service_name": "ai-chat-backend",
+                "flush_interval": 1.0
+            },
             "server": {
                 "host": "0.0.0.0",
                 "port": 8000,
@@ -105,7 +301,9 @@ class Config:
                 # 合并配置
                 return self._merge_config(default_config, file_config)
             except Exception as e:
-                print(f"配置文件加载失败，使用默认配置: {e}")
+                if strict:
+                    raise
+                logger.warning("配置文件加载失败，使用默认配置: %s", e)
                 return default_config
         else:
             # 创建默认配置文件
@@ -131,66 +329,47 @@ class Config:
                 else:
                     json.dump(config, f, indent=2, ensure_ascii=False)
         except Exception as e:
-            print(f"配置文件保存失败: {e}")
+            logger.error("配置文件保存失败: %s", e)
     
     def get_available_models(self) -> List[Dict[str, Any]]:
         """获取可用的AI模型列表"""
-        models = []
-        for model_config in self.config_data.get("ai_models", []):
-            # 检查API密钥是否配置（从环境变量或配置文件）
-            api_key = model_config.get("api_key") or self._get_api_key(model_config.get("provider"))
-            models.append({
-                "name": model_config.get("name"),
-                "provider": model_config.get("provider"),
-                "model_id": model_config.get("model_id"),
-                "available": api_key is not None or model_config.get("provider") == "ollama"
-            })
-        return models
+        return [dict(model) for model in self._snapshot.available_models]
     
     def get_default_model(self) -> str:
         """获取默认模型"""
         return self.config_data.get("default_model", "GPT-3.5 Turbo")
     
+    def get_stage_models(self, stage: str, fallback: Optional[str] = None) -> List[str]:
+        """获取某个阶段（planning / analysis）的候选模型：依次为 {stage}_model 配置、fallback、default_model，
+        去重且只保留已配置的模型"""
+        configured = self.config_data.get(f"{stage}_model") or []
+        if isinstance(configured, str):
+            configured = [configured]
+        candidates = []
+        for name in [*configured, fallback, self.get_default_model()]:
+            if name and name not in candidates and self.get_model_config(name):
+                candidates.append(name)
+        return candidates
+    
+    def get_mcp_catalog_timeout(self) -> float:
+        """获取加载所选MCP工具目录的总时间预算（秒）"""
+        return float(self.config_data.get("mcp_catalog_timeout", 5.0))
+    
+    def get_function_call_concurrency(self) -> int:
+        """获取单个请求内并发执行的MCP函数调用数上限"""
+        return max(1, int(self.config_data.get("function_call_concurrency", 4)))
+    
     def get_model_config(self, model_name: str) -> Optional[AIModelConfig]:
         """获取指定模型的配置"""
-
-        print(444,self.config_data.get("ai_models"))
-
-        for model in self.config_data.get("ai_models", []):
-            if model.get("name") == model_name:
-                # 从环境变量获取API密钥
-                api_key = model.get("api_key") or self._get_api_key(model.get("provider"))
-                return AIModelConfig(
-                    name=model.get("name"),
-                    provider=model.get("provider"),
-                    api_key=api_key,
-                    api_base=model.get("api_base"),
-                    model_id=model.get("model_id"),
-                    max_tokens=model.get("max_tokens", 2048),
-                    temperature=model.get("temperature", 0.7)
-                )
-        return None
+        return self._snapshot.models.get(model_name)
     
     def get_mcp_options(self) -> List[Dict[str, Any]]:
         """获取MCP选项列表"""
-        return [
-            mcp for mcp in self.config_data.get("mcp_options", [])
-            if mcp.get("enabled", True)
-        ]
+        return [dict(mcp) for mcp in self._snapshot.mcp_options]
     
     def get_mcp_config(self, mcp_value: str) -> Optional[MCPConfig]:
         """获取指定MCP的配置"""
-        for mcp in self.config_data.get("mcp_options", []):
-            if mcp.get("value") == mcp_value:
-                return MCPConfig(
-                    label=mcp.get("label"),
-                    value=mcp.get("value"),
-                    description=mcp.get("description"),
-                    enabled=mcp.get("enabled", True),
-                    mcp_url=mcp.get("mcp_url"),
-                    tools=mcp.get("tools", [])
-                )
-        return None
+        return self._snapshot.mcp_configs.get(mcp_value)
     
     def _get_api_key(self, provider: str) -> Optional[str]:
         """从环境变量获取API密钥"""
@@ -202,6 +381,50 @@ class Config:
         }
         return os.getenv(env_keys.get(provider, f"{provider.upper()}_API_KEY"))
     
+    def get_streaming_config(self) -> Dict[str, Any]:
+        """获取流式输出配置"""
+        return self.config_data.get("streaming", {})
+    
+    def get_http_config(self) -> Dict[str, Any]:
+        """获取上游 HTTP 连接池配置"""
+        return self.config_data.get("http", {})
+    
+    def get_admission_config(self) -> Dict[str, Any]:
+        """获取模型 / MCP 并发准入配置"""
+        return self.config_data.get("admission", {})
+    
+    def get_rate_limit_config(self) -> Dict[str, Any]:
+        """获取模型 / MCP 令牌桶限速配置"""
+        return self.config_data.get("rate_limit", {})
+    
+    def get_result_cache_config(self) -> Dict[str, Any]:
+        """获取 MCP 函数调用结果缓存配置"""
+        return self.config_data.get("mcp_result_cache", {})
+    
+    def get_analysis_prompt_config(self) -> Dict[str, Any]:
+        """获取分析提示中 MCP 结果的裁剪配置"""
+        return self.config_data.get("analysis_prompt", {})
+    
+    def get_result_format_config(self) -> Dict[str, Any]:
+        """获取函数调用结果展示配置"""
+        return self.config_data.get("result_format", {})
+    
+    def get_completion_cache_config(self) -> Dict[str, Any]:
+        """获取模型回复缓存配置"""
+        return self.config_data.get("completion_cache", {})
+    
+    def get_disk_cache_config(self) -> Dict[str, Any]:
+        """获取磁盘二级缓存配置"""
+        return self.config_data.get("disk_cache", {})
+    
+    def get_logging_config(self) -> Dict[str, Any]:
+        """获取日志配置"""
+        return self.config_data.get("logging", {})
+    
+    def get_tracing_config(self) -> Dict[str, Any]:
+        """获取请求追踪配置"""
+        return self.config_data.get("tracing", {})
+    
     def get_server_config(self) -> Dict[str, Any]:
         """获取服务器配置"""
         return self.config_data.get("server", {
@@ -211,10 +434,64 @@ class Config:
         })
     
     def update_config(self, new_config: Dict[str, Any]):
-        """更新配置"""
-        self.config_data = self._merge_config(self.config_data, new_config)
-        self._save_config(self.config_data)
+        """更新配置：基于当前快照合并出新配置，整体替换快照"""
+        config_data = self._merge_config(self._snapshot.to_dict(), new_config)
+        self._snapshot = ConfigSnapshot(config_data, self._get_api_key)
+        self._save_config(config_data)
+        self._mtime = self._get_mtime()
     
     def reload_config(self):
         """重新加载配置"""
-        self.config_data = self._load_config() 
\ No newline at end of file
+        self._snapshot = ConfigSnapshot(self._load_config(), self._get_api_key)
+        self._mtime = self._get_mtime()
+    
+    def _get_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+    
+    def reload_if_changed(self) -> Optional["ConfigDiff"]:
+        """配置文件修改时间变化时重新加载，返回与旧快照的差异；未变化或无实际差异时返回 None
+
+        新文件解析失败时保留当前快照，等文件下次修改后再试。
+        """
+        mtime = self._get_mtime()
+        if mtime is None or mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        
+        try:
+            snapshot = ConfigSnapshot(self._load_config(strict=True), self._get_api_key)
+        except Exception as e:
+            logger.error("配置文件重新加载失败，继续使用当前配置: %s", e)
+            return None
+        
+        old_snapshot, self._snapshot = self._snapshot, snapshot
+        diff = ConfigDiff(old_snapshot, snapshot)
+        return diff if diff else None
+
+class ConfigDiff:
+    """两个配置快照之间发生变化的模型和 MCP"""
+    __slots__ = ("old", "new", "models", "mcp_values", "settings")
+
+    def __init__(self, old: ConfigSnapshot, new: ConfigSnapshot):
+        self.old = old
+        self.new = new
+        # 新增、删除或任一字段变化的模型名 / MCP value
+        self.models = {
+            name for name in old.models.keys() | new.models.keys()
+            if old.models.get(name) != new.models.get(name)
+        }
+        self.mcp_values = {
+            value for value in old.mcp_configs.keys() | new.mcp_configs.keys()
+            if old.mcp_configs.get(value) != new.mcp_configs.get(value)
+        }
+        # 其余顶层配置项
+        self.settings = {
+            key for key in old.data.keys() | new.data.keys()
+            if key not in ("ai_models", "mcp_options") and old.data.get(key) != new.data.get(key)
+        }
+
+    def __bool__(self) -> bool:
+        return bool(self.models or self.mcp_values or self.settings) 
\ No newline at end of file
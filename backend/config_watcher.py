@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from typing import Optional
+
+from config import Config, ConfigDiff
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigWatcher:
+    """轮询配置文件修改时间，变化时热加载配置并只失效受影响的客户端和缓存"""
+
+    def __init__(self, config: Config, ai_service, mcp_service):
+        self.config = config
+        self.ai_service = ai_service
+        self.mcp_service = mcp_service
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        interval = float(self.config.config_data.get("config_watch_interval", 2.0))
+        if interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                diff = await asyncio.to_thread(self.config.reload_if_changed)
+                if diff:
+                    await self.apply(diff)
+            except Exception as e:
+                logger.error("配置热加载失败: %s", e)
+
+    async def apply(self, diff: ConfigDiff):
+        logger.info(
+            "🔄 配置已重新加载",
+            extra={"models": sorted(diff.models), "mcp_values": sorted(diff.mcp_values), "settings": sorted(diff.settings)}
+        )
+        if "logging" in diff.settings:
+            setup_logging(self.config)
+        if "http" in diff.settings:
+            # 模型客户端和 MCP 备选调用持有已建立的连接池，不在运行中替换
+            logger.warning("http 连接池配置已修改，需要重启服务才会生效")
+
+        # 旧快照中的模型客户端按旧的 provider/name 定位
+        self.ai_service.invalidate_models([
+            diff.old.models[name] for name in diff.models if name in diff.old.models
+        ])
+
+        for mcp_value in diff.mcp_values:
+            self.ai_service.invalidate_mcp_context(mcp_value)
+        if diff.mcp_values:
+            await self.mcp_service.apply_config_changes(diff.mcp_values)
+        if "mcp_result_cache" in diff.settings:
+            self.mcp_service.configure_result_cache()
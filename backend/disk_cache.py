@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStore:
+    """MCP 工具目录和函数调用结果的磁盘二级缓存
+
+    同一主机上的多个 uvicorn worker 共用一个 WAL 模式的 SQLite 文件：进程重启后直接从磁盘预热，
+    一个 worker 取到的结果其他 worker 也能命中。值以 JSON 序列化后 zlib 压缩存储，
+    过期条目在读取时忽略，由后台整理任务定期删除并回收空间。
+    """
+
+    def __init__(self, path: str, compress_level: int = 6, max_size_mb: float = 512,
+                 compaction_interval: float = 300.0):
+        self.path = path
+        self.compress_level = compress_level
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.compaction_interval = compaction_interval
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._compaction_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> Optional["SQLiteStore"]:
+        """disk_cache.enabled 为 false 时返回 None"""
+        disk_config = config.get_disk_cache_config()
+        if not disk_config.get("enabled", False):
+            return None
+        path = disk_config.get("path", "mcp_cache.sqlite3")
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        return cls(
+            path,
+            compress_level=disk_config.get("compress_level", 6),
+            max_size_mb=disk_config.get("max_size_mb", 512),
+            compaction_interval=disk_config.get("compaction_interval", 300.0)
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")  # 只对新建的数据库文件生效
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL, expires_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+            self._conn = conn
+        return self._conn
+
+    # 以下 _xxx_sync 方法在线程池中执行，避免磁盘 IO 阻塞事件循环
+
+    def _get_sync(self, key: str) -> Optional[Tuple[Any, float, Optional[float]]]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value, created_at, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (row[2] is not None and row[2] <= time.time()):
+            return None
+        return json.loads(zlib.decompress(row[0])), row[1], row[2]
+
+    def _set_sync(self, key: str, blob: bytes, ttl: Optional[float]):
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, blob, now, now + ttl if ttl else None)
+            )
+
+    def _delete_sync(self, key: str):
+        with self._lock:
+            self._connect().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _delete_prefix_sync(self, prefix: str):
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock:
+            self._connect().execute("DELETE FROM entries WHERE key LIKE ? ESCAPE '\\'", (escaped + "%",))
+
+    def _compact_sync(self) -> int:
+        with self._lock:
+            conn = self._connect()
+            removed = conn.execute(
+                "DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+            ).rowcount
+            # 超过容量上限时按写入时间从旧到新淘汰
+            size = conn.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+            if size > self.max_size_bytes:
+                target = self.max_size_bytes * 0.8
+                rows = conn.execute("SELECT key, LENGTH(value) FROM entries ORDER BY created_at").fetchall()
+                evict = []
+                for key, length in rows:
+                    if size <= target:
+                        break
+                    evict.append((key,))
+                    size -= length
+                conn.executemany("DELETE FROM entries WHERE key = ?", evict)
+                removed += len(evict)
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float, Optional[float]]]:
+        """返回 (值, 写入时间, 过期时间)，不存在、已过期或读取失败时返回 None"""
+        try:
+            entry = await asyncio.to_thread(self._get_sync, key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("读取磁盘缓存失败 %s: %s", key, e)
+            return None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """写入缓存，ttl 为空或 0 表示不过期；值无法序列化为 JSON 时跳过"""
+        try:
+            blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), self.compress_level)
+        except (TypeError, ValueError):
+            return False
+        try:
+            await asyncio.to_thread(self._set_sync, key, blob, ttl)
+            return True
+        except Exception as e:
+            self.errors += 1
+            logger.warning("写入磁盘缓存失败 %s: %s", key, e)
+            return False
+
+    async def delete(self, key: str):
+        try:
+            await asyncio.to_thread(self._delete_sync, key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("清除磁盘缓存失败 %s: %s", key, e)
+
+    async def delete_prefix(self, prefix: str):
+        try:
+            await asyncio.to_thread(self._delete_prefix_sync, prefix)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("清除磁盘缓存失败 %s: %s", prefix, e)
+
+    async def compact(self) -> int:
+        removed = await asyncio.to_thread(self._compact_sync)
+        if removed:
+            logger.info("磁盘缓存整理完成，删除 %d 条", removed)
+        return removed
+
+    def start(self):
+        if self.compaction_interval > 0 and self._compaction_task is None:
+            self._compaction_task = asyncio.create_task(self._compaction_loop())
+
+    async def _compaction_loop(self):
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.warning("磁盘缓存整理失败: %s", e)
+
+    async def close(self):
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            try:
+                await self._compaction_task
+            except asyncio.CancelledError:
+                pass
+            self._compaction_task = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        return {"path": self.path, "file_bytes": size, "hits": self.hits, "misses": self.misses, "errors": self.errors}
@@ -0,0 +1,77 @@
+import json
+from typing import List, Tuple
+
+FUNCTION_CALL_BEGIN = "<|FunctionCallBegin|>"
+FUNCTION_CALL_END = "<|FunctionCallEnd|>"
+
+
+def format_call_block(name: str, arguments: str) -> str:
+    """把原生工具调用（函数名 + JSON 参数文本）转换为标记协议的调用块，与文本协议共用解析和执行流程"""
+    return f'{FUNCTION_CALL_BEGIN}[{{"name": {json.dumps(name, ensure_ascii=False)}, "parameters": {arguments.strip() or "{}"}}}]{FUNCTION_CALL_END}'
+
+
+def _partial_marker_length(text: str, marker: str) -> int:
+    """text 结尾与 marker 开头重合的最大长度（不含完整标记）"""
+    for length in range(min(len(text), len(marker) - 1), 0, -1):
+        if text.endswith(marker[:length]):
+            return length
+    return 0
+
+
+class FunctionCallStreamParser:
+    """增量识别模型输出中的 <|FunctionCallBegin|>...<|FunctionCallEnd|> 调用块
+
+    feed() 每次接收一个流式片段，返回事件列表：
+    - ("text", 文本): 调用块之外、可以直接发给用户的文本
+    - ("call", 调用内容): 一个完整调用块的内容（不含标记）
+    跨片段被截断的标记会暂存到下一个片段再判断，标记本身不会出现在文本事件中。
+    """
+
+    def __init__(self):
+        self._tail = ""  # 可能是标记前缀的未决尾部
+        self._call_parts: List[str] = []
+        self._in_call = False
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        events = []
+        data = self._tail + chunk
+        self._tail = ""
+
+        while data:
+            marker = FUNCTION_CALL_END if self._in_call else FUNCTION_CALL_BEGIN
+            index = data.find(marker)
+            if index >= 0:
+                before, data = data[:index], data[index + len(marker):]
+                if self._in_call:
+                    self._call_parts.append(before)
+                    events.append(("call", "".join(self._call_parts)))
+                    self._call_parts = []
+                    self._in_call = False
+                else:
+                    if before:
+                        events.append(("text", before))
+                    self._in_call = True
+                continue
+
+            keep = _partial_marker_length(data, marker)
+            body = data[:len(data) - keep]
+            self._tail = data[len(data) - keep:]
+            if body:
+                if self._in_call:
+                    self._call_parts.append(body)
+                else:
+                    events.append(("text", body))
+            break
+
+        return events
+
+    def flush(self) -> List[Tuple[str, str]]:
+        """流结束时调用：未闭合的调用块按原文作为文本返回"""
+        if self._in_call:
+            text = FUNCTION_CALL_BEGIN + "".join(self._call_parts) + self._tail
+        else:
+            text = self._tail
+        self._tail = ""
+        self._call_parts = []
+        self._in_call = False
+        return [("text", text)] if text else []
@@ -0,0 +1,153 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from config import Config
+from tracing import current_request_id
+
+# LogRecord 自带的属性，其余属性视为通过 extra 传入的结构化字段
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+# 大对象日志的截断长度和采样率，由 setup_logging 根据配置更新
+_payload_settings = {"max_chars": 2000, "sample_rate": 1.0}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional["DroppingQueueHandler"] = None
+
+
+def truncate(text: str, limit: Optional[int] = None) -> str:
+    """超过 limit 个字符时截断，并注明原始长度"""
+    limit = _payload_settings["max_chars"] if limit is None else limit
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(共 {len(text)} 字符，已截断)"
+
+
+def log_payload(logger: logging.Logger, level: int, message: str, payload: Any, **fields):
+    """记录大对象（工具目录、MCP 原始结果等）
+
+    级别未开启时不做任何序列化；开启时按 payload_sample_rate 采样，并截断到 max_payload_chars。
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if random.random() >= _payload_settings["sample_rate"]:
+        return
+    if isinstance(payload, str):
+        text = payload
+    else:
+        try:
+            text = json.dumps(payload, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            text = repr(payload)
+    logger.log(level, "%s: %s", message, truncate(text), extra=fields)
+
+
+class RequestContextFilter(logging.Filter):
+    """在产生日志的协程中取出当前请求 id"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id()
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """输出 JSON 行或 key=value 形式的文本，extra 字段和请求 id 作为结构化字段"""
+
+    def __init__(self, fmt: str = "text"):
+        super().__init__()
+        self.fmt = fmt
+
+    @staticmethod
+    def _fields(record: logging.LogRecord) -> Dict[str, Any]:
+        return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds")
+        message = record.getMessage()
+        fields = self._fields(record)
+        request_id = getattr(record, "request_id", None)
+        exc_text = self.formatException(record.exc_info) if record.exc_info else None
+
+        if self.fmt == "json":
+            entry = {"ts": timestamp, "level": record.levelname, "logger": record.name, "msg": message}
+            if request_id:
+                entry["request_id"] = request_id
+            entry.update(fields)
+            if exc_text:
+                entry["exc"] = exc_text
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        parts = [timestamp, record.levelname, record.name]
+        if request_id:
+            parts.append(f"[{request_id}]")
+        parts.append(message)
+        parts.extend(f"{key}={value}" for key, value in fields.items())
+        line = " ".join(parts)
+        return f"{line}\n{exc_text}" if exc_text else line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """把日志放入有界队列，由后台线程写出；队列满时丢弃而不是阻塞调用方"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(config: Config):
+    """按 config.yaml 的 logging 配置初始化日志：根日志器只挂一个队列 handler，输出在后台线程完成"""
+    global _listener, _queue_handler
+    logging_config = config.get_logging_config()
+
+    _payload_settings["max_chars"] = int(logging_config.get("max_payload_chars", 2000))
+    _payload_settings["sample_rate"] = float(logging_config.get("payload_sample_rate", 1.0))
+
+    root = logging.getLogger()
+    root.setLevel(str(logging_config.get("level", "INFO")).upper())
+    for name, level in (logging_config.get("loggers") or {}).items():
+        logging.getLogger(name).setLevel(str(level).upper())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(logging_config.get("format", "text")))
+
+    if _listener is not None:
+        # 重新配置（如热加载）：只替换输出 handler，队列和后台线程保持不变
+        _listener.handlers = (stream_handler,)
+        return
+
+    log_queue = queue.Queue(maxsize=int(logging_config.get("queue_size", 10000)))
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(RequestContextFilter())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止后台线程并写出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logging_stats() -> Dict[str, Any]:
+    if _queue_handler is None:
+        return {}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
@@ -1,31 +1,64 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import json
 import asyncio
+import logging
 import time
 from datetime import datetime
 from contextlib import asynccontextmanager
 
+from admission import AdmissionController, AdmissionRejected
 from config import Config
-from ai_service import AIService
+from config_watcher import ConfigWatcher
+from disk_cache import SQLiteStore
+from ai_service import AIService, estimate_tokens
 from mcp_service import MCPService
+from metrics import (
+    CHAT_STREAM_CHUNKS_PER_SECOND, CHAT_STREAM_DURATION, CHAT_STREAM_TOKENS_PER_SECOND,
+    CHAT_STREAMS_ABANDONED, CHAT_STREAMS_IN_FLIGHT, CHAT_TIME_TO_FIRST_TOKEN, REGISTRY
+)
+from streaming import STREAM_MODES, ClientDisconnected, cancel_on_disconnect, shape_stream
+from logging_setup import get_logging_stats, setup_logging
+from tracing import get_tracer, start_trace
+from transport import HTTPTransport
+
+logger = logging.getLogger(__name__)
+
+# 启动时预连接 MCP 和预热工具目录的时限（秒），超时后在后台继续
+MCP_STARTUP_TIMEOUT = 10.0
 
 # 应用生命周期管理
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动时的初始化
-    print("🚀 AI Chat Backend 启动中...")
+    logger.info("🚀 AI Chat Backend 启动中...")
+    if disk_store:
+        disk_store.start()
+    # 预先建立 MCP 长连接会话并预热工具目录，避免首个请求承担握手开销；
+    # 两者并发进行、共用同一启动时限，无法连接的 MCP 不会阻塞启动
+    await asyncio.gather(
+        mcp_service.connect_all_clients(timeout=MCP_STARTUP_TIMEOUT),
+        mcp_service.warm_up_tools(timeout=MCP_STARTUP_TIMEOUT)
+    )
+    # 监听配置文件变化，热加载时只失效受影响的客户端和缓存
+    config_watcher.start()
+    tracer.start()
     yield
     # 关闭时的清理
-    print("🔄 AI Chat Backend 关闭中，清理 MCP 连接...")
+    logger.info("🔄 AI Chat Backend 关闭中，清理 MCP 连接...")
+    await config_watcher.stop()
     try:
         await mcp_service.disconnect_all_clients()
-        print("✅ MCP 客户端连接已清理")
+        logger.info("✅ MCP 客户端连接已清理")
     except Exception as e:
-        print(f"❌ 清理 MCP 连接时出错: {e}")
+        logger.error("❌ 清理 MCP 连接时出错: %s", e)
+    await tracer.close()
+    if disk_store:
+        await disk_store.close()
+    await http_transport.close()
 
 app = FastAPI(
     title="AI Chat Backend", 
@@ -40,12 +73,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Request-ID"],
 )
 
 # 初始化服务
 config = Config()
-ai_service = AIService(config)
-mcp_service = MCPService(config)
+setup_logging(config)
+http_transport = HTTPTransport(config)
+disk_store = SQLiteStore.from_config(config)
+admission = AdmissionController(config)
+mcp_service = MCPService(config, http_transport, disk_store, admission)
+ai_service = AIService(config, mcp_service, http_transport, admission)
+config_watcher = ConfigWatcher(config, ai_service, mcp_service)
+tracer = get_tracer()
+tracer.configure(config, http_transport)
 
 class ChatMessage(BaseModel):
     role: str
@@ -55,6 +96,7 @@ class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     selected_mcp: List[str] = []
     model: Optional[str] = None
+    stream_mode: Optional[str] = None  # raw / coalesced / paced，默认取 config.yaml 中的 streaming.mode
 
 class MCPOption(BaseModel):
     label: str
@@ -104,6 +146,7 @@ async def refresh_mcp_tools(mcp_value: str):
     """刷新指定MCP的工具缓存"""
     try:
         await mcp_service.refresh_mcp_tools(mcp_value)
+        ai_service.invalidate_mcp_context(mcp_value)
         tools = await mcp_service.get_mcp_tools(mcp_value)
         return {
             "message": f"MCP {mcp_value} 工具缓存已刷新",
@@ -112,6 +155,11 @@ async def refresh_mcp_tools(mcp_value: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/mcp/context")
+async def get_mcp_context_stats():
+    """获取已缓存的MCP工具上下文大小"""
+    return {"contexts": ai_service.get_mcp_context_stats()}
+
 @app.post("/mcp/{mcp_value}/call")
 async def call_mcp_function(mcp_value: str, request: dict):
     """调用指定MCP的函数"""
@@ -132,55 +180,163 @@ async def call_mcp_function(mcp_value: str, request: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def use_completion_cache(cache_bypass: Optional[str], cache_control: Optional[str]) -> bool:
+    """请求头 X-Cache-Bypass: 1 或 Cache-Control: no-cache 时跳过模型回复缓存"""
+    if cache_bypass and cache_bypass.strip().lower() not in ("0", "false", "no"):
+        return False
+    if cache_control and "no-cache" in cache_control.lower():
+        return False
+    return True
+
+def resolve_model(requested: Optional[str]) -> str:
+    """请求未指定模型时使用 planning_model（依次回退到 default_model）"""
+    if requested:
+        return requested
+    candidates = config.get_stage_models("planning")
+    return candidates[0] if candidates else config.get_default_model()
+
+def admission_error(error: AdmissionRejected) -> HTTPException:
+    """排队已满或超出速率限制返回 429，排队超时返回 503"""
+    return HTTPException(
+        status_code=error.status_code, detail=str(error),
+        headers={"Retry-After": str(max(1, round(error.retry_after)))}
+    )
+
 @app.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, x_cache_bypass: Optional[str] = Header(None),
+               cache_control: Optional[str] = Header(None)):
     """普通聊天接口（非流式）"""
     try:
         # 使用指定模型或默认模型
-        model = request.model or config.get_default_model()
+        model = resolve_model(request.model)
         
         # 获取AI响应
-        response = await ai_service.get_response(
-            messages=request.messages,
-            model=model,
-            selected_mcp=request.selected_mcp
-        )
+        with start_trace("chat", model=model) as trace:
+            response = await ai_service.get_response(
+                messages=request.messages,
+                model=model,
+                selected_mcp=request.selected_mcp,
+                use_cache=use_completion_cache(x_cache_bypass, cache_control)
+            )
         
         return {
             "message": response,
             "model_used": model,
             "selected_mcp": request.selected_mcp,
+            "request_id": trace.trace_id,
             "timestamp": datetime.now().isoformat()
         }
+    except AdmissionRejected as e:
+        raise admission_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def observe_stream(chunks, model: str, started: float):
+    """记录首个片段耗时和输出速率，片段原样透传"""
+    first_at = None
+    chunk_count = 0
+    token_count = 0
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if first_at is None:
+                first_at = time.perf_counter()
+                CHAT_TIME_TO_FIRST_TOKEN.observe(first_at - started, model=model)
+            chunk_count += 1
+            token_count += estimate_tokens(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+        if first_at is not None:
+            elapsed = time.perf_counter() - first_at
+            if elapsed > 0:
+                CHAT_STREAM_CHUNKS_PER_SECOND.observe(chunk_count / elapsed, model=model)
+                CHAT_STREAM_TOKENS_PER_SECOND.observe(token_count / elapsed, model=model)
+
 @app.post("/chat/stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, http_request: Request, x_cache_bypass: Optional[str] = Header(None),
+                      cache_control: Optional[str] = Header(None)):
     """流式聊天接口（支持打字机效果）"""
     try:
         # 使用指定模型或默认模型
-        model = request.model or config.get_default_model()
+        model = resolve_model(request.model)
+        streaming_config = config.get_streaming_config()
+        stream_mode = request.stream_mode or streaming_config.get("mode", "coalesced")
+        if stream_mode not in STREAM_MODES:
+            raise HTTPException(status_code=400, detail=f"不支持的 stream_mode: {stream_mode}")
+        
+        # 模型名额和等待队列都已占满时直接拒绝，不建立流
+        admission.check("model", model)
+        
+        trace = start_trace("chat.stream", model=model, stream_mode=stream_mode)
+        request_id = trace.trace_id
         
         async def generate_response():
             """生成流式响应"""
             # try:
-            # 发送开始信号
-            yield f"data: {json.dumps({'type': 'start', 'model': model, 'selected_mcp': request.selected_mcp})}\n\n"
-            
-            # 获取AI流式响应
-            async for chunk in ai_service.get_streaming_response(
-                messages=request.messages,
-                model=model,
-                selected_mcp=request.selected_mcp
-            ):
-                if chunk:
-                    yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
-                    # 添加小延迟以模拟打字机效果
-                    await asyncio.sleep(0.02)
-            
-            # 发送结束信号
-            yield f"data: {json.dumps({'type': 'end', 'timestamp': datetime.now().isoformat()})}\n\n"
+            started = time.perf_counter()
+            abandoned = False
+            lease = None
+            CHAT_STREAMS_IN_FLIGHT.inc(model=model)
+            try:
+                with trace:
+                    # 并发加载所选MCP的工具目录，各MCP耗时随开始信号返回；这期间不占用也不排队等待模型名额
+                    prepared_messages, prepared_tools, mcp_timings = await ai_service.prepare_messages(
+                        request.messages, request.selected_mcp, model
+                    )
+                
+                    # 发送开始信号
+                    yield f"data: {json.dumps({'type': 'start', 'request_id': request_id, 'model': model, 'selected_mcp': request.selected_mcp, 'mcp_timings': mcp_timings})}\n\n"
+                
+                    # 模型流开始前等待模型名额，需要排队时先通知客户端
+                    lease = admission.lease("model", model)
+                    if lease is not None and lease.queued:
+                        yield f"data: {json.dumps({'type': 'queued', 'request_id': request_id, 'model': model, 'position': lease.position})}\n\n"
+                
+                    # 获取AI流式响应，按输出策略合并或限速；stage_models 记录各阶段实际使用的模型
+                    stage_models = {}
+                    chunks = ai_service.get_streaming_response(
+                        messages=request.messages,
+                        model=model,
+                        selected_mcp=request.selected_mcp,
+                        prepared_messages=prepared_messages,
+                        prepared_tools=prepared_tools,
+                        use_cache=use_completion_cache(x_cache_bypass, cache_control),
+                        stage_models=stage_models,
+                        lease=lease
+                    )
+                    shaped = shape_stream(observe_stream(chunks, model, started), stream_mode, streaming_config)
+                    poll_interval = streaming_config.get("disconnect_poll_ms", 500) / 1000
+                    try:
+                        async for chunk in cancel_on_disconnect(shaped, http_request.is_disconnected, poll_interval):
+                            if chunk:
+                                yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
+                    except ClientDisconnected:
+                        # 上游模型流和未完成的 MCP 调用已取消，不再发送结束信号
+                        abandoned = True
+                        trace.set_attribute("abandoned", True)
+                        return
+                    except AdmissionRejected as e:
+                        # 模型名额排队已满或超时，或需要等待的速率配额超过 rate_limit.max_wait
+                        trace.set_attribute("rejected", e.reason)
+                        yield f"data: {json.dumps({'type': 'error', 'request_id': request_id, 'status': e.status_code, 'content': str(e)})}\n\n"
+                        yield f"data: {json.dumps({'type': 'end', 'request_id': request_id, 'models': stage_models, 'timestamp': datetime.now().isoformat()})}\n\n"
+                        return
+                
+                    # 发送结束信号
+                    yield f"data: {json.dumps({'type': 'end', 'request_id': request_id, 'models': stage_models, 'timestamp': datetime.now().isoformat()})}\n\n"
+            except (asyncio.CancelledError, GeneratorExit):
+                # 服务器在发送失败或检测到断开时关闭了生成器
+                abandoned = True
+                raise
+            finally:
+                if lease is not None:
+                    lease.release()
+                if abandoned:
+                    CHAT_STREAMS_ABANDONED.inc(model=model)
+                CHAT_STREAMS_IN_FLIGHT.dec(model=model)
+                CHAT_STREAM_DURATION.observe(time.perf_counter() - started, model=model)
             
             # except Exception as stream_error:
             #     # 如果流式响应出错，发送错误信息而不是中断
@@ -197,11 +353,24 @@ async def chat_stream(request: ChatRequest):
                 "Connection": "keep-alive",
                 "Access-Control-Allow-Origin": "*",
                 "Access-Control-Allow-Headers": "*",
+                "X-Request-ID": request_id,
             }
         )
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise admission_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/results/{result_id}")
+async def get_result(result_id: str):
+    """获取函数调用的完整结果（result_format.raw_mode 为 capped / link 时生成的链接）"""
+    found, result = await ai_service.get_raw_result(result_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="结果不存在或已过期")
+    return result
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
@@ -211,9 +380,26 @@ async def health_check():
         "services": {
             "ai_service": ai_service.is_healthy(),
             "mcp_service": mcp_service.is_healthy()
-        }
+        },
+        "mcp_pools": mcp_service.get_pool_stats(),
+        "tool_cache": mcp_service.get_cache_stats(),
+        "result_cache": mcp_service.get_result_cache_stats(),
+        "disk_cache": disk_store.stats() if disk_store else None,
+        "completion_cache": ai_service.completion_cache.stats(),
+        "admission": admission.stats(),
+        "http_pools": http_transport.stats(),
+        "logging": get_logging_stats()
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 文本格式的运行指标"""
+    mcp_service.collect_metrics()
+    http_transport.collect_metrics()
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000,reload=True) 
\ No newline at end of file
+    # config.yaml 的修改由 ConfigWatcher 热加载；代码自动重载会重启进程、丢弃所有流和缓存，仅在调试时开启
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=os.getenv("DEBUG", "False").lower() == "true") 
\ No newline at end of file
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Optional, Set, Tuple
+
+try:
+    from fastmcp import Client
+    from fastmcp.exceptions import ToolError
+    from mcp.shared import exceptions as _mcp_exceptions
+    # 服务端正常返回的错误（工具报错、方法不存在等），说明会话本身仍然可用
+    PROTOCOL_ERRORS = (ToolError, getattr(_mcp_exceptions, "McpError", None) or _mcp_exceptions.MCPError)
+except ImportError:
+    Client = None
+    PROTOCOL_ERRORS = ()
+
+from config import MCPConfig
+
+logger = logging.getLogger(__name__)
+
+
+class MCPSessionPool:
+    """单个 MCP 服务的长连接会话池
+
+    每个会话是一个已完成握手（initialize / 能力协商）的 fastmcp 客户端，
+    在请求之间复用；并发会话数受 max_sessions 限制，空闲会话定期 ping 检查，
+    失效会话自动丢弃并在下次使用时重建。
+    """
+
+    def __init__(self, mcp_config: MCPConfig):
+        self.mcp_config = mcp_config
+        self.max_sessions = max(1, mcp_config.max_sessions)
+        self.health_check_interval = mcp_config.health_check_interval
+        self._semaphore = asyncio.Semaphore(self.max_sessions)
+        self._idle: Deque[Any] = deque()
+        self._sessions: Set[Any] = set()
+        self._health_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def start(self):
+        """预先建立一个会话并启动健康检查任务"""
+        async with self._semaphore:
+            if not self._sessions:
+                await self._checkin(await self._open())
+        if self.health_check_interval and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_check_loop())
+
+    async def _open(self) -> Any:
+        client = Client(self.mcp_config.mcp_url)
+        await client.__aenter__()
+        self._sessions.add(client)
+        logger.info("MCP 会话已建立: %s (%d/%d)", self.mcp_config.value, len(self._sessions), self.max_sessions)
+        return client
+
+    async def _discard(self, client: Any):
+        self._sessions.discard(client)
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning("关闭 MCP 会话失败 %s: %s", self.mcp_config.value, e)
+
+    async def _checkin(self, client: Any):
+        """归还会话；会话池已关闭（如刷新或配置重载期间）时直接关闭，避免泄漏连接和子进程"""
+        if self._closed:
+            await self._discard(client)
+        else:
+            self._idle.append(client)
+
+    async def _checkout(self) -> Tuple[Any, bool]:
+        """取出一个可用会话，返回 (client, 是否为复用会话)"""
+        while self._idle:
+            client = self._idle.pop()
+            if client.is_connected():
+                return client, True
+            await self._discard(client)
+        return await self._open(), False
+
+    async def run(self, operation: Callable[[Any], Awaitable[Any]]) -> Any:
+        """在池中会话上执行操作；复用的会话失效时自动重连并重试一次"""
+        if self._closed:
+            raise RuntimeError(f"MCP 会话池已关闭: {self.mcp_config.value}")
+        async with self._semaphore:
+            for attempt in range(2):
+                client, reused = await self._checkout()
+                try:
+                    result = await operation(client)
+                except PROTOCOL_ERRORS:
+                    await self._checkin(client)
+                    raise
+                except Exception as e:
+                    await self._discard(client)
+                    if not reused or attempt:
+                        raise
+                    logger.warning("MCP 会话失效，重新连接 %s: %s", self.mcp_config.value, e)
+                    continue
+                except BaseException:
+                    await self._discard(client)
+                    raise
+                await self._checkin(client)
+                return result
+
+    async def _health_check_loop(self):
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            await self.health_check()
+
+    async def health_check(self) -> bool:
+        """ping 所有空闲会话，丢弃无响应的会话"""
+        healthy = True
+        for _ in range(len(self._idle)):
+            async with self._semaphore:
+                if not self._idle:
+                    break
+                client = self._idle.popleft()
+                try:
+                    await asyncio.wait_for(client.ping(), timeout=5.0)
+                except PROTOCOL_ERRORS:
+                    await self._checkin(client)
+                except Exception as e:
+                    healthy = False
+                    logger.warning("MCP 会话健康检查失败 %s: %s", self.mcp_config.value, e)
+                    await self._discard(client)
+                else:
+                    await self._checkin(client)
+        return healthy
+
+    async def close(self, graceful: bool = False):
+        """停止健康检查并关闭会话；graceful 时只关闭空闲会话，使用中的会话在归还时关闭"""
+        self._closed = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._health_task = None
+        idle, self._idle = list(self._idle), deque()
+        for client in idle if graceful else list(self._sessions):
+            await self._discard(client)
+
+    def stats(self) -> dict:
+        return {
+            "mcp_url": self.mcp_config.mcp_url,
+            "sessions": len(self._sessions),
+            "idle": len(self._idle),
+            "max_sessions": self.max_sessions,
+        }
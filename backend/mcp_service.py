@@ -1,28 +1,109 @@
 import asyncio
+import hashlib
 import json
-import httpx
-from typing import List, Dict, Any, Optional
+import logging
+import time
+from typing import List, Dict, Any, Optional, Set, Tuple
 from dataclasses import asdict
 
+from admission import AdmissionController
+from config import Config, MCPConfig
+from disk_cache import SQLiteStore
+from logging_setup import log_payload
+
+logger = logging.getLogger(__name__)
+
 try:
     from fastmcp import Client
 except ImportError:
-    print("警告: fastmcp 未安装，将使用 HTTP 客户端作为备选方案")
+    logger.warning("fastmcp 未安装，将使用 HTTP 客户端作为备选方案")
     Client = None
 
-from config import Config, MCPConfig
+from mcp_pool import MCPSessionPool
+from metrics import (
+    MCP_CALL_TOOL_LATENCY, MCP_CATALOG_CACHE, MCP_LIST_TOOLS_LATENCY, MCP_RESULT_CACHE, MCP_SESSION_POOL
+)
+from result_cache import ResultCache, make_result_key
+from tracing import span
+from transport import HTTPTransport
+
+# 后台刷新失败后，旧目录继续使用的最短时间（秒）
+REFRESH_RETRY_DELAY = 30.0
+
+# JSON Schema 基本类型对应的 Python 类型
+_SCHEMA_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list, tuple),
+    "object": (dict,),
+}
+
+def _matches_schema_type(value: Any, schema_type: str) -> bool:
+    if schema_type == "null":
+        return value is None
+    if schema_type not in _SCHEMA_TYPES:
+        return True
+    if schema_type in ("integer", "number") and isinstance(value, bool):
+        return False
+    return isinstance(value, _SCHEMA_TYPES[schema_type])
+
+def validate_tool_parameters(schema: Dict[str, Any], parameters: Dict[str, Any]) -> List[str]:
+    """按工具的 inputSchema 做轻量参数校验：必需参数、未知参数、基本类型和枚举值"""
+    if not isinstance(schema, dict):
+        return []
+    if not isinstance(parameters, dict):
+        return ["参数必须是 JSON 对象"]
+    
+    errors = []
+    properties = schema.get("properties") or {}
+    required = schema.get("required") or []
+    
+    for name in required:
+        if parameters.get(name) is None:
+            errors.append(f"缺少必需参数 {name}")
+    
+    if properties and schema.get("additionalProperties") is False:
+        for name in parameters:
+            if name not in properties:
+                errors.append(f"未知参数 {name}")
+    
+    for name, value in parameters.items():
+        param_schema = properties.get(name)
+        if not isinstance(param_schema, dict) or value is None:
+            continue
+        expected = param_schema.get("type")
+        expected_types = expected if isinstance(expected, list) else [expected] if expected else []
+        if expected_types and not any(_matches_schema_type(value, t) for t in expected_types):
+            errors.append(f"参数 {name} 类型应为 {'/'.join(expected_types)}")
+            continue
+        if "enum" in param_schema and value not in param_schema["enum"]:
+            errors.append(f"参数 {name} 取值应为 {param_schema['enum']} 之一")
+    
+    return errors
 
 class MCPService:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, transport: Optional[HTTPTransport] = None,
+                 store: Optional[SQLiteStore] = None, admission: Optional[AdmissionController] = None):
         self.config = config
-        self._external_mcp_cache = {}
-        self._mcp_clients = {}  # 缓存 fastmcp 客户端
+        self.transport = transport or HTTPTransport(config)  # HTTP 备选调用使用的共享连接池
+        self.store = store  # 可选的磁盘二级缓存，多个 worker 共享
+        self.admission = admission or AdmissionController(config)  # 每个 MCP 的并发上限和等待队列
+        self._external_mcp_cache = {}  # cache_key -> (加载时间, 工具列表)
+        self._catalog_versions: Dict[str, str] = {}  # mcp_value -> 工具目录内容哈希
+        self._tool_index: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}  # 工具名 -> [(mcp_value, 工具定义)]，按配置顺序排列
+        self._refresh_tasks: Dict[str, asyncio.Task] = {}  # 进行中的加载任务，同一 MCP 只保留一个
+        self._connect_tasks: Set[asyncio.Task] = set()  # 启动时超时后仍在后台进行的预连接
+        self._cache_hits = 0
+        self._cache_stale_hits = 0
+        self._cache_misses = 0
+        self._session_pools: Dict[str, MCPSessionPool] = {}  # 每个 MCP 一个长连接会话池
+        self._result_cache = ResultCache(config.get_result_cache_config().get("max_entries", 1000))
     
     async def get_mcp_tools(self, mcp_value: str) -> List[Dict[str, Any]]:
         """获取MCP支持的工具列表"""
         mcp_config = self.config.get_mcp_config(mcp_value)
-
-        print("mcp_config", mcp_config)
         if not mcp_config:
             return []
         
@@ -30,104 +111,252 @@ class MCPService:
         if mcp_config.mcp_url:
             return await self._get_external_mcp_tools(mcp_config)
         else:
-            print(f"警告: MCP {mcp_value} 没有配置 mcp_url")
+            logger.warning("MCP %s 没有配置 mcp_url", mcp_value)
             return []
     
-    async def _get_fastmcp_client(self, mcp_config: MCPConfig) -> Optional[Client]:
-        """获取或创建 fastmcp 客户端"""
+    def _get_session_pool(self, mcp_config: MCPConfig) -> Optional[MCPSessionPool]:
+        """获取或创建该 MCP 的长连接会话池"""
         if Client is None:
             return None
-            
-        client_key = f"client_{mcp_config.value}"
-        
-        if client_key not in self._mcp_clients:
+
+        pool = self._session_pools.get(mcp_config.value)
+        if pool is None:
+            pool = MCPSessionPool(mcp_config)
+            self._session_pools[mcp_config.value] = pool
+        return pool
+
+    async def connect_all_clients(self, timeout: float = 10.0):
+        """启动时为所有启用的 MCP 预先建立会话，超时后连接继续在后台完成（或在首次使用时建立），不阻塞启动"""
+        async def connect(mcp_value: str):
+            mcp_config = self.config.get_mcp_config(mcp_value)
+            if not mcp_config or not mcp_config.mcp_url:
+                return
+            pool = self._get_session_pool(mcp_config)
+            if pool is None:
+                return
             try:
-                # 创建 fastmcp 客户端，直接使用 URL
-                client = Client(mcp_config.mcp_url)
-                self._mcp_clients[client_key] = client
-                print(f"创建 FastMCP 客户端成功: {mcp_config.mcp_url}")
-                return client
+                await pool.start()
             except Exception as e:
-                print(f"创建 FastMCP 客户端失败 {mcp_config.mcp_url}: {e}")
-                return None
+                logger.warning("预连接 MCP %s 失败，将在首次使用时重试: %s", mcp_value, e)
+
+        tasks = [asyncio.create_task(connect(option.get("value"))) for option in self.config.get_mcp_options()]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning("%d 个 MCP 预连接未在 %ss 内完成，将在后台继续", len(pending), timeout)
+            for task in pending:
+                self._connect_tasks.add(task)
+                task.add_done_callback(self._connect_tasks.discard)
+
+    async def warm_up_tools(self, timeout: float = 10.0):
+        """启动时预加载所有启用 MCP 的工具目录，超时后加载继续在后台完成"""
+        tasks = []
+        for option in self.config.get_mcp_options():
+            mcp_config = self.config.get_mcp_config(option.get("value"))
+            if mcp_config and mcp_config.mcp_url:
+                tasks.append(self._schedule_refresh(mcp_config))
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning("%d 个 MCP 工具目录预加载未在 %ss 内完成，将在后台继续", len(pending), timeout)
+
+    async def _get_external_mcp_tools(self, mcp_config: MCPConfig) -> List[Dict[str, Any]]:
+        """从缓存获取工具目录：过期时立即返回旧目录并在后台刷新，未命中时单飞加载"""
+        cache_key = f"tools_{mcp_config.value}"
         
-        return self._mcp_clients.get(client_key)
+        entry = self._external_mcp_cache.get(cache_key)
+        if entry is not None:
+            loaded_at, tools = entry
+            if mcp_config.tools_ttl and time.monotonic() - loaded_at > mcp_config.tools_ttl:
+                self._cache_stale_hits += 1
+                MCP_CATALOG_CACHE.inc(mcp_value=mcp_config.value, result="stale")
+                self._schedule_refresh(mcp_config)
+            else:
+                self._cache_hits += 1
+                MCP_CATALOG_CACHE.inc(mcp_value=mcp_config.value, result="hit")
+            return tools
+        
+        self._cache_misses += 1
+        MCP_CATALOG_CACHE.inc(mcp_value=mcp_config.value, result="miss")
+        return await self._load_tools_once(mcp_config)
     
-    async def _get_external_mcp_tools(self, mcp_config: MCPConfig) -> List[Dict[str, Any]]:
-        """使用 fastmcp 客户端从外部 MCP 获取工具列表"""
+    def _schedule_refresh(self, mcp_config: MCPConfig) -> asyncio.Task:
+        """启动（或复用进行中的）工具目录加载任务"""
+        cache_key = f"tools_{mcp_config.value}"
+        task = self._refresh_tasks.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(self._refresh_external_mcp_tools(mcp_config))
+            self._refresh_tasks[cache_key] = task
+            task.add_done_callback(lambda _: self._refresh_tasks.pop(cache_key, None))
+        return task
+    
+    async def _load_tools_once(self, mcp_config: MCPConfig) -> List[Dict[str, Any]]:
+        """等待加载任务完成；调用方超时取消不会中断共享的加载任务"""
+        return await asyncio.shield(self._schedule_refresh(mcp_config))
+    
+    async def _refresh_external_mcp_tools(self, mcp_config: MCPConfig) -> List[Dict[str, Any]]:
+        """加载工具目录并写入缓存；失败时保留旧目录"""
         cache_key = f"tools_{mcp_config.value}"
+        stored = await self._load_stored_catalog(mcp_config)
+        if stored is not None:
+            # 其他 worker 刚加载过（或进程重启前的目录仍然有效），直接使用磁盘缓存
+            loaded_at, tools = stored
+        else:
+            started = time.perf_counter()
+            with span("mcp.list_tools", mcp_value=mcp_config.value) as list_span:
+                tools = await self._fetch_external_mcp_tools(mcp_config)
+                list_span.set_attribute("tool_count", len(tools) if tools is not None else None)
+            MCP_LIST_TOOLS_LATENCY.observe(
+                time.perf_counter() - started,
+                mcp_value=mcp_config.value, status="ok" if tools is not None else "error"
+            )
+            loaded_at = time.monotonic()
+            if tools is not None and self.store:
+                await self.store.set(f"catalog|{mcp_config.value}", tools, mcp_config.tools_ttl)
+        if tools is not None:
+            self._external_mcp_cache[cache_key] = (loaded_at, tools)
+            catalog = json.dumps(tools, ensure_ascii=False, sort_keys=True, default=str)
+            self._catalog_versions[mcp_config.value] = hashlib.sha1(catalog.encode("utf-8")).hexdigest()[:12]
+            self._rebuild_tool_index()
+            return tools
         
-        # 使用缓存避免频繁请求
-        if cache_key in self._external_mcp_cache:
-            return self._external_mcp_cache[cache_key]
+        entry = self._external_mcp_cache.get(cache_key)
+        if entry is None:
+            return []
+        if mcp_config.tools_ttl:
+            # 推迟下一次后台刷新，避免每个请求都触发一次失败的重试
+            retry_at = time.monotonic() - mcp_config.tools_ttl + min(mcp_config.tools_ttl, REFRESH_RETRY_DELAY)
+            self._external_mcp_cache[cache_key] = (retry_at, entry[1])
+        return entry[1]
+    
+    async def _load_stored_catalog(self, mcp_config: MCPConfig) -> Optional[Tuple[float, List[Dict[str, Any]]]]:
+        """从磁盘缓存读取比内存中更新、且未过期的工具目录，返回 (按本进程单调时钟换算的加载时间, 目录)"""
+        if not self.store:
+            return None
+        entry = await self.store.get(f"catalog|{mcp_config.value}")
+        if entry is None:
+            return None
+        tools, created_at, _ = entry
+        age = max(0.0, time.time() - created_at)
+        if mcp_config.tools_ttl and age >= mcp_config.tools_ttl:
+            return None
+        loaded_at = time.monotonic() - age
+        current = self._external_mcp_cache.get(f"tools_{mcp_config.value}")
+        if current is not None and current[0] >= loaded_at:
+            return None
+        return loaded_at, tools
+    
+    def _rebuild_tool_index(self):
+        """根据已缓存的工具目录重建工具名路由索引
 
-        print("mcp_config.mcp_url111", mcp_config.mcp_url)
+        同名工具出现在多个 MCP 中时，按 mcp_options 中的配置顺序排列（未配置的按 value 排在最后），
+        路由时取所选 MCP 中排在最前的一个。
+        """
+        order = {option.get("value"): i for i, option in enumerate(self.config.get_mcp_options())}
+        mcp_values = sorted(
+            (cache_key[len("tools_"):] for cache_key in self._external_mcp_cache),
+            key=lambda value: (order.get(value, len(order)), value)
+        )
+        
+        index: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        for mcp_value in mcp_values:
+            _, tools = self._external_mcp_cache[f"tools_{mcp_value}"]
+            for tool in tools:
+                name = tool.get("name")
+                if name:
+                    index.setdefault(name, []).append((mcp_value, tool))
+        
+        for name, owners in index.items():
+            if len(owners) > 1:
+                logger.warning("工具 %s 同时存在于 %s，优先使用 %s", name, [value for value, _ in owners], owners[0][0])
+        self._tool_index = index
+    
+    def _lookup_tool(self, function_name: str, selected_mcp: List[str]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        for mcp_value, tool in self._tool_index.get(function_name, ()):
+            if mcp_value in selected_mcp:
+                return mcp_value, tool
+        return None
+    
+    async def resolve_tool(self, function_name: str, selected_mcp: List[str]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """在所选 MCP 中查找工具，返回 (mcp_value, 工具定义)；未找到返回 None"""
+        route = self._lookup_tool(function_name, selected_mcp)
+        if route is not None:
+            return route
+        
+        # 所选 MCP 中还有工具目录未加载的，加载后再查一次
+        missing = [mcp_value for mcp_value in selected_mcp if mcp_value not in self._catalog_versions]
+        if missing:
+            await asyncio.gather(*(self.get_mcp_tools(mcp_value) for mcp_value in missing), return_exceptions=True)
+            return self._lookup_tool(function_name, selected_mcp)
+        return None
+    
+    def get_catalog_version(self, mcp_value: str) -> Optional[str]:
+        """获取工具目录版本（内容哈希），未加载时返回 None"""
+        return self._catalog_versions.get(mcp_value)
+    
+    async def _fetch_external_mcp_tools(self, mcp_config: MCPConfig) -> Optional[List[Dict[str, Any]]]:
+        """使用 fastmcp 客户端从外部 MCP 获取工具列表，失败返回 None"""
+        logger.debug("加载 MCP 工具目录 %s", mcp_config.mcp_url, extra={"mcp_value": mcp_config.value})
 
-        # 尝试使用 fastmcp 客户端
-        client = await self._get_fastmcp_client(mcp_config)
-        if client:
+        # 尝试使用 fastmcp 会话池
+        pool = self._get_session_pool(mcp_config)
+        if pool:
             try:
-                # 使用 fastmcp 的上下文管理器和 list_tools 方法
-                async with client:
-                    tools_response = await client.list_tools()
-                    
-                    # 提取工具列表
-                    tools = tools_response.tools if hasattr(tools_response, 'tools') else tools_response
-                    
-                    # 转换为标准格式
-                    formatted_tools = []
-                    for tool in tools:
-                        # 处理不同类型的工具对象
-                        if hasattr(tool, 'name'):
-                            # FastMCP Tool 对象
-                            formatted_tool = {
-                                "name": tool.name,
-                                "description": tool.description or "",
-                                "parameters": tool.inputSchema or {}
-                            }
-                        elif isinstance(tool, dict):
-                            # 字典格式
-                            formatted_tool = {
-                                "name": tool.get("name", ""),
-                                "description": tool.get("description", ""),
-                                "parameters": tool.get("inputSchema", tool.get("input_schema", {}))
-                            }
-                        else:
-                            # 其他格式，尝试转换
-                            formatted_tool = {
-                                "name": str(getattr(tool, 'name', 'unknown')),
-                                "description": str(getattr(tool, 'description', '')),
-                                "parameters": getattr(tool, 'inputSchema', getattr(tool, 'input_schema', {}))
-                            }
-                        
-                        formatted_tools.append(formatted_tool)
+                # 复用池中已握手的会话调用 list_tools
+                tools_response = await pool.run(lambda client: client.list_tools())
+                # 提取工具列表
+                tools = tools_response.tools if hasattr(tools_response, 'tools') else tools_response
+                
+                # 转换为标准格式
+                formatted_tools = []
+                for tool in tools:
+                    # 处理不同类型的工具对象
+                    if hasattr(tool, 'name'):
+                        # FastMCP Tool 对象
+                        formatted_tool = {
+                            "name": tool.name,
+                            "description": tool.description or "",
+                            "parameters": tool.inputSchema or {}
+                        }
+                    elif isinstance(tool, dict):
+                        # 字典格式
+                        formatted_tool = {
+                            "name": tool.get("name", ""),
+                            "description": tool.get("description", ""),
+                            "parameters": tool.get("inputSchema", tool.get("input_schema", {}))
+                        }
+                    else:
+                        # 其他格式，尝试转换
+                        formatted_tool = {
+                            "name": str(getattr(tool, 'name', 'unknown')),
+                            "description": str(getattr(tool, 'description', '')),
+                            "parameters": getattr(tool, 'inputSchema', getattr(tool, 'input_schema', {}))
+                        }
                     
-                    print("formatted tools:", formatted_tools)
-                    self._external_mcp_cache[cache_key] = formatted_tools
-                    return formatted_tools
+                    formatted_tools.append(formatted_tool)
+                
+                log_payload(logger, logging.DEBUG, "MCP 工具目录", formatted_tools, mcp_value=mcp_config.value)
+                return formatted_tools
             except Exception as e:
-                print(f"FastMCP 获取工具失败: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.warning("FastMCP 获取工具失败 %s: %s", mcp_config.value, e, exc_info=True)
         
         # 备选方案：使用 HTTP 客户端
-        return await self._get_external_mcp_tools_http(mcp_config, cache_key)
+        return await self._get_external_mcp_tools_http(mcp_config)
     
-    async def _get_external_mcp_tools_http(self, mcp_config: MCPConfig, cache_key: str) -> List[Dict[str, Any]]:
+    async def _get_external_mcp_tools_http(self, mcp_config: MCPConfig) -> Optional[List[Dict[str, Any]]]:
         """HTTP 备选方案获取工具列表"""
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                # 标准 MCP 工具发现接口
-                response = await client.get(f"{mcp_config.mcp_url}/tools")
-                if response.status_code == 200:
-                    tools = response.json().get("tools", [])
-                    self._external_mcp_cache[cache_key] = tools
-                    return tools
+            client = self.transport.get_client(mcp_config.mcp_url)
+            # 标准 MCP 工具发现接口
+            response = await client.get(f"{mcp_config.mcp_url}/tools", timeout=10.0)
+            if response.status_code == 200:
+                return response.json().get("tools", [])
         except Exception as e:
-            
-            print(f"HTTP 获取外部 MCP 工具失败 {mcp_config.mcp_url}: {e}")
+            logger.warning("HTTP 获取外部 MCP 工具失败 %s: %s", mcp_config.mcp_url, e)
         
-        return []
+        return None
     
     async def execute_mcp_function(self, mcp_value: str, function_name: str, parameters: Dict[str, Any]) -> Any:
         """使用 fastmcp 执行MCP函数"""
@@ -135,47 +364,99 @@ class MCPService:
         if not mcp_config:
             raise ValueError(f"未找到MCP模块: {mcp_value}")
         
-        if mcp_config.mcp_url:
-            return await self._call_external_mcp(mcp_config, function_name, parameters)
-        else:
+        if not mcp_config.mcp_url:
             raise ValueError(f"MCP {mcp_value} 没有配置 mcp_url，无法执行函数调用")
+        
+        # 工具已在目录中时，调用前先校验参数
+        route = self._lookup_tool(function_name, [mcp_value])
+        if route is not None:
+            errors = validate_tool_parameters(route[1].get("parameters"), parameters)
+            if errors:
+                raise ValueError(f"参数校验失败: {'; '.join(errors)}")
+        
+        ttl = self._result_ttl(mcp_config, function_name)
+        if ttl <= 0:
+            return await self._timed_call(mcp_config, function_name, parameters)
+        
+        key = make_result_key(mcp_value, function_name, parameters)
+        source, result = await self._result_cache.get_or_call(
+            key, lambda: self._load_result(mcp_config, function_name, parameters, key, ttl)
+        )
+        MCP_RESULT_CACHE.inc(mcp_value=mcp_value, function=function_name, result=source)
+        return result
+    
+    async def _load_result(self, mcp_config: MCPConfig, function_name: str, parameters: Dict[str, Any],
+                           key: tuple, ttl: float) -> Tuple[Any, float]:
+        """内存缓存未命中时先查磁盘缓存，再调用远端 MCP 并写回磁盘；返回 (结果, 内存缓存有效期)"""
+        store_key = None
+        if self.store:
+            store_key = f"result|{mcp_config.value}|{function_name}|{hashlib.sha1(key[2].encode('utf-8')).hexdigest()}"
+            entry = await self.store.get(store_key)
+            if entry is not None:
+                result, _, expires_at = entry
+                MCP_RESULT_CACHE.inc(mcp_value=mcp_config.value, function=function_name, result="disk")
+                return result, (expires_at - time.time()) if expires_at else ttl
+        
+        result = await self._timed_call(mcp_config, function_name, parameters)
+        if store_key:
+            await self.store.set(store_key, result, ttl)
+        return result, ttl
+    
+    def _result_ttl(self, mcp_config: MCPConfig, function_name: str) -> float:
+        """函数调用结果的缓存有效期：函数级配置 > MCP 级配置 > 全局默认"""
+        if function_name in (mcp_config.tool_result_ttl or {}):
+            return float(mcp_config.tool_result_ttl[function_name] or 0)
+        if mcp_config.result_ttl is not None:
+            return float(mcp_config.result_ttl)
+        return float(self.config.get_result_cache_config().get("default_ttl", 0))
+    
+    async def _timed_call(self, mcp_config: MCPConfig, function_name: str, parameters: Dict[str, Any]) -> Any:
+        """在 MCP 并发名额和速率配额内调用外部 MCP 函数并记录耗时（不含排队和限速等待时间）"""
+        async with self.admission.slot("mcp", mcp_config.value):
+            await self.admission.throttle("mcp", mcp_config.value)
+            started = time.perf_counter()
+            status = "error"
+            try:
+                with span("mcp.call_tool", mcp_value=mcp_config.value, function=function_name):
+                    result = await self._call_external_mcp(mcp_config, function_name, parameters)
+                status = "ok"
+                return result
+            finally:
+                MCP_CALL_TOOL_LATENCY.observe(
+                    time.perf_counter() - started, mcp_value=mcp_config.value, function=function_name, status=status
+                )
     
     async def _call_external_mcp(self, mcp_config: MCPConfig, function_name: str, parameters: Dict[str, Any]) -> Any:
         """使用 fastmcp 客户端调用外部 MCP 函数"""
-        # 尝试使用 fastmcp 客户端
-        client = await self._get_fastmcp_client(mcp_config)
-        if client:
+        # 尝试使用 fastmcp 会话池
+        pool = self._get_session_pool(mcp_config)
+        if pool:
             try:
-                # 使用 fastmcp 的上下文管理器和 call_tool 方法
-                async with client:
-                    result = await client.call_tool(function_name, parameters)
-                    print(f"FastMCP 原始调用结果: {result}")
-                    
-                    # 处理返回结果
-                    if hasattr(result, 'content'):
-                        # 如果是 MCP 响应对象，提取内容
-                        content = result.content
-                        if len(content) > 0:
-                            text_content = content[0].text if hasattr(content[0], 'text') else str(content[0])
-                            print(f"提取的文本内容: {text_content}")
-                            
-                            # 尝试解析为 JSON
-                            try:
-                                import json
-                                parsed_result = json.loads(text_content)
-                                print(f"解析的 JSON 结果: {parsed_result}")
-                                return parsed_result
-                            except json.JSONDecodeError:
-                                # 如果不是 JSON，返回原始文本
-                                print("不是有效的 JSON，返回原始文本")
-                                return text_content
-                        return str(result)
-                    else:
-                        # 直接返回结果
-                        print(f"直接返回结果: {result}")
-                        return result
+                # 复用池中已握手的会话调用 call_tool
+                result = await pool.run(lambda client: client.call_tool(function_name, parameters))
+                log_payload(logger, logging.DEBUG, "FastMCP 原始调用结果", result,
+                            mcp_value=mcp_config.value, function=function_name)
+                
+                # 处理返回结果
+                if hasattr(result, 'content'):
+                    # 如果是 MCP 响应对象，提取内容
+                    content = result.content
+                    if len(content) > 0:
+                        text_content = content[0].text if hasattr(content[0], 'text') else str(content[0])
+                        
+                        # 尝试解析为 JSON
+                        try:
+                            return json.loads(text_content)
+                        except json.JSONDecodeError:
+                            # 如果不是 JSON，返回原始文本
+                            logger.debug("MCP 返回的不是有效的 JSON，返回原始文本", extra={"function": function_name})
+                            return text_content
+                    return str(result)
+                else:
+                    # 直接返回结果
+                    return result
             except Exception as e:
-                print(f"FastMCP 调用失败: {e}")
+                logger.warning("FastMCP 调用失败 %s.%s: %s", mcp_config.value, function_name, e)
         
         # 备选方案：使用 HTTP 调用
         return await self._call_external_mcp_http(mcp_config, function_name, parameters)
@@ -183,16 +464,16 @@ class MCPService:
     async def _call_external_mcp_http(self, mcp_config: MCPConfig, function_name: str, parameters: Dict[str, Any]) -> Any:
         """HTTP 备选方案调用外部 MCP 函数"""
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                payload = {
-                    "function": function_name,
-                    "parameters": parameters
-                }
-                response = await client.post(f"{mcp_config.mcp_url}/call", json=payload)
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    raise Exception(f"外部 MCP 调用失败: {response.status_code} - {response.text}")
+            client = self.transport.get_client(mcp_config.mcp_url)
+            payload = {
+                "function": function_name,
+                "parameters": parameters
+            }
+            response = await client.post(f"{mcp_config.mcp_url}/call", json=payload, timeout=30.0)
+            if response.status_code == 200:
+                return response.json()
+            else:
+                raise Exception(f"外部 MCP 调用失败: {response.status_code} - {response.text}")
         except Exception as e:
             raise Exception(f"外部 MCP 调用异常: {str(e)}")
     
@@ -201,27 +482,78 @@ class MCPService:
         cache_key = f"tools_{mcp_value}"
         if cache_key in self._external_mcp_cache:
             del self._external_mcp_cache[cache_key]
+        self._catalog_versions.pop(mcp_value, None)
+        self._rebuild_tool_index()
+        self._result_cache.invalidate(mcp_value)
+        if self.store:
+            await self.store.delete(f"catalog|{mcp_value}")
+            await self.store.delete_prefix(f"result|{mcp_value}|")
         
-        # 同时刷新客户端连接
-        client_key = f"client_{mcp_value}"
-        if client_key in self._mcp_clients:
+        # 同时重建会话池，下次使用时重新握手；正在进行的调用完成后其会话才关闭
+        pool = self._session_pools.pop(mcp_value, None)
+        if pool:
             try:
-                client = self._mcp_clients[client_key]
-                # fastmcp 客户端会在上下文管理器退出时自动关闭
-                print(f"刷新 FastMCP 客户端: {client_key}")
+                await pool.close(graceful=True)
+                logger.info("刷新 FastMCP 会话池: %s", mcp_value)
             except Exception as e:
-                print(f"刷新 FastMCP 客户端失败: {e}")
-            del self._mcp_clients[client_key]
+                logger.warning("刷新 FastMCP 会话池失败 %s: %s", mcp_value, e)
+    
+    async def apply_config_changes(self, mcp_values: set):
+        """配置热加载后，只重建发生变化的 MCP 的会话池和工具目录"""
+        for mcp_value in mcp_values:
+            await self.refresh_mcp_tools(mcp_value)
+            mcp_config = self.config.get_mcp_config(mcp_value)
+            if mcp_config and mcp_config.enabled and mcp_config.mcp_url:
+                self._schedule_refresh(mcp_config)
     
     async def disconnect_all_clients(self):
         """断开所有 MCP 客户端连接"""
-        for client_key, client in list(self._mcp_clients.items()):
+        for task in list(self._refresh_tasks.values()) + list(self._connect_tasks):
+            task.cancel()
+        for mcp_value, pool in list(self._session_pools.items()):
             try:
-                # fastmcp 客户端使用上下文管理器，不需要手动断开
-                print(f"清理 FastMCP 客户端: {client_key}")
+                await pool.close()
+                logger.info("清理 FastMCP 会话池: %s", mcp_value)
             except Exception as e:
-                print(f"清理 FastMCP 客户端失败 {client_key}: {e}")
-        self._mcp_clients.clear()
+                logger.warning("清理 FastMCP 会话池失败 %s: %s", mcp_value, e)
+        self._session_pools.clear()
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """获取工具缓存命中统计"""
+        hits = self._cache_hits + self._cache_stale_hits
+        total = hits + self._cache_misses
+        return {
+            "hits": hits,
+            "stale_hits": self._cache_stale_hits,
+            "misses": self._cache_misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "refreshing": len(self._refresh_tasks),
+            "cached_mcp": len(self._external_mcp_cache)
+        }
+    
+    def configure_result_cache(self):
+        """配置热加载后调整结果缓存容量"""
+        self._result_cache.resize(self.config.get_result_cache_config().get("max_entries", 1000))
+    
+    def invalidate_results(self, mcp_value: Optional[str] = None):
+        """清除函数调用结果缓存"""
+        self._result_cache.invalidate(mcp_value)
+    
+    def get_result_cache_stats(self) -> Dict[str, Any]:
+        """获取函数调用结果缓存统计"""
+        return self._result_cache.stats()
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """获取各 MCP 会话池状态"""
+        return {mcp_value: pool.stats() for mcp_value, pool in self._session_pools.items()}
+    
+    def collect_metrics(self):
+        """把会话池占用写入指标，在 /metrics 抓取时调用"""
+        MCP_SESSION_POOL.clear()
+        for mcp_value, stats in self.get_pool_stats().items():
+            MCP_SESSION_POOL.set(stats["idle"], mcp_value=mcp_value, state="idle")
+            MCP_SESSION_POOL.set(stats["sessions"] - stats["idle"], mcp_value=mcp_value, state="in_use")
+            MCP_SESSION_POOL.set(stats["max_sessions"], mcp_value=mcp_value, state="max")
     
     def is_healthy(self) -> bool:
         """检查MCP服务健康状态"""
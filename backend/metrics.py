@@ -0,0 +1,208 @@
+import bisect
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 秒级耗时默认分桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 吞吐（每秒 token / 片段数）分桶
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    """带标签的指标基类，按标签值分别记录"""
+
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各分桶计数..., 总和, 总数]
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class Registry:
+    """指标注册表，按 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标已注册: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 聊天流
+CHAT_STREAMS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "chat_streams_in_flight", "正在进行的流式聊天请求数", ["model"]))
+CHAT_TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "chat_time_to_first_token_seconds", "从收到请求到模型输出首个片段的耗时", ["model"]))
+CHAT_STREAM_DURATION = REGISTRY.register(Histogram(
+    "chat_stream_duration_seconds", "流式聊天请求总耗时", ["model"]))
+CHAT_STREAM_TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "chat_stream_tokens_per_second", "首个片段之后每秒输出的估算 token 数", ["model"], buckets=RATE_BUCKETS))
+CHAT_STREAM_CHUNKS_PER_SECOND = REGISTRY.register(Histogram(
+    "chat_stream_chunks_per_second", "首个片段之后每秒输出的片段数", ["model"], buckets=RATE_BUCKETS))
+CHAT_STREAMS_ABANDONED = REGISTRY.register(Counter(
+    "chat_streams_abandoned_total", "客户端在结束前断开、被提前取消的流式聊天请求数", ["model"]))
+
+# 上游模型
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "ai_upstream_errors_total", "模型提供商调用失败次数", ["provider", "mode"]))
+
+COMPLETION_CACHE = REGISTRY.register(Counter(
+    "ai_completion_cache_total", "模型回复缓存查询次数", ["stage", "result"]))
+
+# 准入控制（kind 为 model 或 mcp）
+ADMISSION_QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "admission_queue_seconds", "等待模型 / MCP 并发名额的耗时", ["kind", "name"]))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "admission_rejected_total", "因排队已满（queue_full）、排队超时（queue_timeout）或限速等待过长（rate_limited）被拒绝的请求数", ["kind", "name", "reason"]))
+ADMISSION_ACTIVE = REGISTRY.register(Gauge(
+    "admission_active", "占用并发名额的请求数", ["kind", "name"]))
+ADMISSION_QUEUED = REGISTRY.register(Gauge(
+    "admission_queued", "正在等待并发名额的请求数", ["kind", "name"]))
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "rate_limit_wait_seconds", "令牌桶限速等待的耗时（不限速时为 0）", ["kind", "name"]))
+RATE_LIMIT_TOKENS = REGISTRY.register(Counter(
+    "rate_limit_tokens_total", "经过令牌桶的预估 token 数（提示估算 + max_tokens）", ["kind", "name"]))
+
+# MCP
+MCP_LIST_TOOLS_LATENCY = REGISTRY.register(Histogram(
+    "mcp_list_tools_seconds", "MCP list_tools 调用耗时", ["mcp_value", "status"]))
+MCP_CALL_TOOL_LATENCY = REGISTRY.register(Histogram(
+    "mcp_call_tool_seconds", "MCP call_tool 调用耗时", ["mcp_value", "function", "status"]))
+MCP_CATALOG_CACHE = REGISTRY.register(Counter(
+    "mcp_tool_catalog_cache_total", "工具目录缓存查询次数", ["mcp_value", "result"]))
+MCP_RESULT_CACHE = REGISTRY.register(Counter(
+    "mcp_result_cache_total", "函数调用结果缓存查询次数（hit / coalesced / miss，disk 为 miss 中由磁盘缓存命中的次数）", ["mcp_value", "function", "result"]))
+
+# 连接池占用（抓取时刷新）
+MCP_SESSION_POOL = REGISTRY.register(Gauge(
+    "mcp_session_pool_sessions", "MCP 会话池中的会话数", ["mcp_value", "state"]))
+HTTP_POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    "http_pool_connections", "上游 HTTP 连接池连接数", ["host", "state"]))
+HTTP_POOL_REQUESTS = REGISTRY.register(Gauge(
+    "http_pool_requests", "上游 HTTP 连接池中进行中及等待连接的请求数", ["host"]))
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+ResultKey = Tuple[str, str, str]
+
+
+def make_result_key(mcp_value: str, function_name: str, parameters: Dict[str, Any]) -> ResultKey:
+    """(mcp_value, 函数名, 规范化参数)；参数按键排序后序列化，键顺序和空白不同的相同调用命中同一条缓存"""
+    canonical = json.dumps(parameters or {}, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return mcp_value, function_name, canonical
+
+
+class ResultCache:
+    """MCP 函数调用结果缓存：按 TTL 过期、按条目数 LRU 淘汰，相同调用并发时只执行一次
+
+    只缓存成功返回的结果；调用抛出异常时不写入缓存，等待同一调用的请求都会收到该异常。
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[ResultKey, Tuple[float, Any]]" = OrderedDict()  # key -> (过期时间, 结果)
+        self._inflight: Dict[ResultKey, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}  # 进行中的调用 -> 等待该调用的请求数
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: ResultKey) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def set(self, key: ResultKey, value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_call(self, key: ResultKey, call: Callable[[], Awaitable[Tuple[Any, float]]]) -> Tuple[str, Any]:
+        """返回 (来源, 结果)，来源为 hit / coalesced / miss；call 返回 (结果, 缓存有效期)"""
+        found, value = self.get(key)
+        if found:
+            self.hits += 1
+            return "hit", value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return "coalesced", await self._wait(key, task)
+
+        self.misses += 1
+
+        async def run():
+            result, ttl = await call()
+            if ttl > 0 and self._inflight.get(key) is task:
+                # 调用期间缓存被清除（如 MCP 刷新）时，不写入可能已过时的结果
+                self.set(key, result, ttl)
+            return result
+
+        task = asyncio.create_task(run())
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return "miss", await self._wait(key, task)
+
+    async def _wait(self, key: ResultKey, task: asyncio.Task) -> Any:
+        """等待共享的调用；单个等待方被取消时不中断调用，合并进来的请求仍能拿到结果，
+        所有等待方都已取消（如客户端全部断开）时取消调用本身"""
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+
+    def _finish(self, key: ResultKey, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # 所有等待方都已取消时，避免未读取异常的警告
+
+    def resize(self, max_entries: int):
+        self.max_entries = max_entries
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, mcp_value: Optional[str] = None):
+        """清除某个 MCP（不指定时为全部）的缓存结果"""
+        if mcp_value is None:
+            self._entries.clear()
+            self._inflight.clear()
+            return
+        for key in [key for key in self._entries if key[0] == mcp_value]:
+            del self._entries[key]
+        for key in [key for key in self._inflight if key[0] == mcp_value]:
+            del self._inflight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else None,
+            "inflight": len(self._inflight)
+        }
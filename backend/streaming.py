@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+from typing import AsyncGenerator, AsyncIterable, Awaitable, Callable, List
+
+STREAM_MODES = ("raw", "coalesced", "paced")
+
+
+class ClientDisconnected(Exception):
+    """客户端在流结束前断开连接"""
+
+
+async def _next(iterator):
+    return await iterator.__anext__()
+
+
+async def _wait_disconnected(is_disconnected: Callable[[], Awaitable[bool]], poll_interval: float):
+    while not await is_disconnected():
+        await asyncio.sleep(poll_interval)
+
+
+async def cancel_on_disconnect(source: AsyncIterable[str], is_disconnected: Callable[[], Awaitable[bool]],
+                               poll_interval: float = 0.5) -> AsyncGenerator[str, None]:
+    """转发上游片段，每 poll_interval 秒检查一次客户端连接
+
+    客户端断开时取消正在等待的片段（上游模型流和进行中的 MCP 调用随之取消）、关闭上游流并抛出 ClientDisconnected，
+    不必等到下一次写入失败才发现连接已断开。
+    """
+    loop = asyncio.get_running_loop()
+    # 与 coalesce_chunks 相同，所有 __anext__ 任务共用同一个上下文
+    context = contextvars.copy_context()
+    iterator = source.__aiter__()
+    watcher = loop.create_task(_wait_disconnected(is_disconnected, poll_interval))
+    pending = None
+
+    try:
+        while True:
+            pending = loop.create_task(_next(iterator), context=context)
+            done, _ = await asyncio.wait({pending, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if pending not in done:
+                raise ClientDisconnected()
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            yield chunk
+    finally:
+        watcher.cancel()
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+async def coalesce_chunks(source: AsyncIterable[str], flush_chars: int = 256,
+                          flush_interval: float = 0.03) -> AsyncGenerator[str, None]:
+    """合并上游增量：缓冲区达到 flush_chars 个字符，或首个缓冲片段等待超过 flush_interval 秒时输出"""
+    loop = asyncio.get_running_loop()
+    # 所有 __anext__ 任务共用同一个上下文，上游在迭代之间设置的 contextvars（如当前追踪 span）得以保留
+    context = contextvars.copy_context()
+    iterator = source.__aiter__()
+    buffer: List[str] = []
+    size = 0
+    deadline = None
+    pending = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = loop.create_task(_next(iterator), context=context)
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                # 时间窗口到期，上游仍未产出新片段
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # 上游出错时先输出已缓冲的内容，客户端不丢失出错前的输出
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, size, deadline = [], 0, None
+                raise
+            if not chunk:
+                continue
+
+            buffer.append(chunk)
+            size += len(chunk)
+            if deadline is None:
+                deadline = loop.time() + flush_interval
+            if size >= flush_chars:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+    finally:
+        # 下游提前关闭时，取消正在等待的片段并关闭上游流
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    if buffer:
+        yield "".join(buffer)
+
+
+async def pace_chunks(source: AsyncIterable[str], interval: float = 0.02) -> AsyncGenerator[str, None]:
+    """逐片段输出并在每个片段后等待 interval 秒（服务端打字机效果）"""
+    async for chunk in source:
+        if chunk:
+            yield chunk
+            await asyncio.sleep(interval)
+
+
+def shape_stream(source: AsyncIterable[str], mode: str, streaming_config: dict) -> AsyncIterable[str]:
+    """按输出策略包装上游流"""
+    if mode == "coalesced":
+        return coalesce_chunks(
+            source,
+            flush_chars=streaming_config.get("flush_chars", 256),
+            flush_interval=streaming_config.get("flush_interval_ms", 30) / 1000
+        )
+    if mode == "paced":
+        return pace_chunks(source, interval=streaming_config.get("pace_interval_ms", 20) / 1000)
+    return source
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+import admission
+from admission import AdmissionController, AdmissionRejected, ConcurrencyLimiter, Lease, RateLimiter, TokenBucket
+from config import Config, ConfigSnapshot
+
+
+def use_settings(config, **sections):
+    """构造替换了若干顶层配置项的新快照，不修改当前快照"""
+    config._snapshot = ConfigSnapshot({**config.snapshot.to_dict(), **sections}, config._get_api_key)
+
+
+class FakeClock:
+    """替代 admission 模块中的 time，手动推进单调时钟"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+def with_clock(test):
+    def run():
+        clock = FakeClock()
+        original, admission.time = admission.time, clock
+        try:
+            test(clock)
+        finally:
+            admission.time = original
+    run.__name__ = test.__name__
+    run.__doc__ = test.__doc__
+    return run
+
+
+@with_clock
+def test_token_bucket_charges_full_cost(clock):
+    """超过容量的请求在桶满时放行，但按实际数量扣除，欠额由后续请求补齐"""
+    bucket = TokenBucket(rate=10, capacity=50)  # tpm 600，burst 5 秒
+    assert bucket.delay(5000) == 0
+    bucket.reserve(5000)
+    assert bucket.tokens == -4950
+    assert bucket.delay(5000) == 500.0
+    clock.now += 500
+    assert bucket.delay(5000) == 0
+
+
+@with_clock
+def test_token_bucket_refund_is_capped(clock):
+    bucket = TokenBucket(rate=1, capacity=5)
+    bucket.reserve(3)
+    bucket.refund(10)
+    assert bucket.tokens == 5
+
+
+@with_clock
+def test_rate_limiter_rejects_over_max_wait(clock):
+    """三个 5000 token 的请求在 tpm 600 下：第一个放行，其余需要等待过长而被拒绝，且不扣除令牌"""
+    limiter = RateLimiter("model", "test", rpm=0, tpm=600, burst_seconds=5)
+    assert asyncio.run(limiter.throttle(5000, max_wait=30)) == 0
+    for _ in range(2):
+        try:
+            asyncio.run(limiter.throttle(5000, max_wait=30))
+            raise AssertionError("应当被拒绝")
+        except AdmissionRejected as e:
+            assert e.status_code == 429
+            assert e.reason == "rate_limited"
+            assert e.retry_after == 500.0
+    assert limiter.rejected == 2
+    assert limiter._tokens.tokens == -4950
+
+
+@with_clock
+def test_rate_limiter_checks_both_buckets(clock):
+    limiter = RateLimiter("model", "test", rpm=60, tpm=6000, burst_seconds=2)
+    assert asyncio.run(limiter.throttle(10, max_wait=0)) == 0
+    assert asyncio.run(limiter.throttle(10, max_wait=0)) == 0
+    # 请求桶（容量 2）已用完，token 桶还有余额
+    try:
+        asyncio.run(limiter.throttle(10, max_wait=0.5))
+        raise AssertionError("应当被拒绝")
+    except AdmissionRejected as e:
+        assert e.retry_after == 1.0
+
+
+def test_rate_limiter_spaces_waiting_requests():
+    """等待中的请求按到达顺序均匀放行"""
+    limiter = RateLimiter("model", "test", rpm=600, tpm=0, burst_seconds=0.1)  # 每 0.1 秒 1 个请求
+
+    async def run():
+        return await asyncio.gather(*(limiter.throttle(0, max_wait=5) for _ in range(4)))
+
+    waits = asyncio.run(run())
+    assert [round(wait, 1) for wait in waits] == [0.0, 0.1, 0.2, 0.3]
+
+
+def test_rate_limiter_refunds_cancelled_wait():
+    limiter = RateLimiter("model", "test", rpm=60, tpm=0, burst_seconds=1)
+
+    async def run():
+        await limiter.throttle(0, max_wait=5)
+        task = asyncio.create_task(limiter.throttle(0, max_wait=5))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert limiter.waiting == 0
+    assert -0.1 < limiter._requests.tokens <= 0.1
+
+
+def test_controller_uses_entry_and_default_rates():
+    config = Config()
+    model = config.get_default_model()
+    use_settings(config, rate_limit={"model_rpm": 0, "model_tpm": 0, "mcp_rpm": 0})
+    controller = AdmissionController(config)
+    assert controller.get_rate_limiter("model", model) is None
+    assert asyncio.run(controller.throttle("model", model, 100)) == 0.0
+
+    use_settings(config, rate_limit={"model_rpm": 30, "model_tpm": 0, "burst_seconds": 4})
+    limiter = controller.get_rate_limiter("model", model)
+    assert (limiter.rpm, limiter.tpm, limiter._requests.capacity) == (30.0, 0.0, 2.0)
+    assert controller.get_rate_limiter("model", model) is limiter
+
+    # 配置变化后重新创建
+    use_settings(config, rate_limit={"model_rpm": 60, "model_tpm": 0, "burst_seconds": 4})
+    assert controller.get_rate_limiter("model", model) is not limiter
+
+
+def test_lease_queue_accounting():
+    """只有正在等待名额的请求计入队列，创建 Lease 本身不占用名额也不排队"""
+    limiter = ConcurrencyLimiter("model", "test", max_concurrency=1, max_queue=1)
+
+    async def run():
+        first, second, third = Lease(limiter), Lease(limiter), Lease(limiter)
+        assert (first.queued, first.position) == (False, 0)
+        assert (limiter.active, limiter.waiting) == (0, 0)
+        assert not limiter.is_full()
+
+        await first.acquire(timeout=1)
+        assert (second.queued, second.position) == (True, 1)
+        waiter = asyncio.create_task(second.acquire(timeout=1))
+        await asyncio.sleep(0)
+        assert (limiter.active, limiter.waiting) == (1, 1)
+        assert limiter.is_full()
+        try:
+            await third.acquire(timeout=1)
+            raise AssertionError("队列已满时应当被拒绝")
+        except AdmissionRejected as e:
+            assert (e.reason, e.status_code) == ("queue_full", 429)
+
+        first.release()
+        first.release()  # 重复释放无影响
+        await waiter
+        assert (limiter.active, limiter.waiting) == (1, 0)
+        second.release()
+        assert (limiter.active, limiter.waiting) == (0, 0)
+
+    asyncio.run(run())
+    assert limiter.rejected == 1
+
+
+def test_unacquired_lease_holds_nothing():
+    limiter = ConcurrencyLimiter("model", "test", max_concurrency=1, max_queue=0)
+    leases = [Lease(limiter) for _ in range(3)]
+    assert not limiter.is_full() and not leases[0].queued
+    leases[0].release()
+    assert (limiter.active, limiter.waiting) == (0, 0)
+
+
+def test_lease_queue_timeout():
+    limiter = ConcurrencyLimiter("mcp", "test", max_concurrency=1, max_queue=1)
+
+    async def run():
+        holder = Lease(limiter)
+        await holder.acquire(timeout=1)
+        waiter = Lease(limiter)
+        try:
+            await waiter.acquire(timeout=0.01)
+            raise AssertionError("应当排队超时")
+        except AdmissionRejected as e:
+            assert (e.reason, e.status_code) == ("queue_timeout", 503)
+        assert (limiter.active, limiter.waiting) == (1, 0)
+        holder.release()
+
+    asyncio.run(run())
+
+
+def test_controller_slot_and_limits():
+    config = Config()
+    model = config.get_default_model()
+    use_settings(config, admission={"model_max_concurrency": 2, "model_max_queue": 3, "queue_timeout": 1})
+    controller = AdmissionController(config)
+    limiter = controller.get_limiter("model", model)
+    assert (limiter.max_concurrency, limiter.max_queue) == (2, 3)
+
+    async def run():
+        async with controller.slot("model", model):
+            assert controller.stats()[f"model:{model}"]["active"] == 1
+        assert controller.stats()[f"model:{model}"]["active"] == 0
+
+    asyncio.run(run())
+    use_settings(config, admission={"model_max_concurrency": 0, "model_max_queue": 3, "queue_timeout": 1})
+    assert controller.lease("model", model) is None
+    controller.check("model", model)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+
+import main
+from config import ConfigSnapshot
+
+MODEL = main.config.get_default_model()
+MCP_VALUE = "data_query"
+SEARCH_TOOL = {
+    "name": "search_companies",
+    "description": "按关键词查询企业",
+    "parameters": {"type": "object", "properties": {"keyword": {"type": "string"}}, "required": ["keyword"]}
+}
+CALL_BLOCK = '<|FunctionCallBegin|>[{"name": "search_companies", "parameters": {"keyword": "凭安"}}]<|FunctionCallEnd|>'
+
+
+async def fake_provider_stream(model_config, messages, tools=None):
+    """替代提供商流式接口：分析请求返回分析文本，其余请求原样回显最后一条消息"""
+    if messages and "数据分析助手" in str(messages[0].get("content")):
+        yield "分析完成"
+        return
+    if "查询" in messages[-1]["content"]:
+        # 调用块的标记拆在两个片段中
+        yield "正在查询" + CALL_BLOCK[:10]
+        yield CALL_BLOCK[10:]
+        return
+    yield "回复："
+    yield messages[-1]["content"]
+
+
+catalog_loads = []
+
+
+async def fake_fetch_tools(mcp_config):
+    # 记录加载工具目录时模型名额的占用和排队情况
+    stats = main.admission.stats().get(f"model:{MODEL}", {})
+    catalog_loads.append((stats.get("active", 0), stats.get("waiting", 0)))
+    return [SEARCH_TOOL]
+
+
+async def fake_call_tool(mcp_config, function_name, parameters):
+    return {"data": {"data_list": [{"companyName": f"{parameters['keyword']}征信有限公司"}], "num_found": 1}}
+
+
+def install_stubs():
+    for name in ("_get_openai_streaming_response", "_get_anthropic_streaming_response"):
+        setattr(main.ai_service, name, fake_provider_stream)
+    main.mcp_service._fetch_external_mcp_tools = fake_fetch_tools
+    main.mcp_service._call_external_mcp = fake_call_tool
+
+
+@contextmanager
+def use_settings(**sections):
+    """临时换上替换了若干顶层配置项的新快照，结束后恢复原快照"""
+    snapshot = main.config.snapshot
+    main.config._snapshot = ConfigSnapshot({**snapshot.to_dict(), **sections}, main.config._get_api_key)
+    try:
+        yield
+    finally:
+        main.config._snapshot = snapshot
+
+
+def read_events(response):
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+
+def post_stream(client, content, selected_mcp=None):
+    response = client.post("/chat/stream", headers={"X-Cache-Bypass": "1"}, json={
+        "messages": [{"role": "user", "content": content}],
+        "model": MODEL,
+        "selected_mcp": selected_mcp or [],
+        "stream_mode": "raw"
+    })
+    assert response.status_code == 200, response.text
+    return read_events(response)
+
+
+def test_stream_without_mcp():
+    """未选择MCP时消息为 ChatMessage 对象，提供商和限速估算都应收到字典"""
+    install_stubs()
+    events = post_stream(TestClient(main.app), "你好")
+    assert [event["type"] for event in events] == ["start", "chunk", "chunk", "end"]
+    assert "".join(event["content"] for event in events if event["type"] == "chunk") == "回复：你好"
+
+
+def test_stream_without_mcp_rate_limited():
+    install_stubs()
+    with use_settings(rate_limit={"model_rpm": 600, "model_tpm": 600000, "max_wait": 5}):
+        events = post_stream(TestClient(main.app), "你好")
+    assert events[-1]["type"] == "end"
+    assert main.admission.stats()[f"model:{MODEL}"]["rate_limit"]["tpm"] == 600000
+
+
+def test_stream_with_mcp_round_trip():
+    """模型输出调用块 -> 执行MCP函数 -> 分析模型生成回答；加载工具目录期间不占用也不排队等待模型名额"""
+    install_stubs()
+    catalog_loads.clear()
+    main.mcp_service._external_mcp_cache.clear()
+    events = post_stream(TestClient(main.app), "查询凭安", [MCP_VALUE])
+    types = [event["type"] for event in events]
+    assert types[0] == "start" and types[-1] == "end", types
+    assert events[0]["mcp_timings"][MCP_VALUE]["status"] == "ok"
+    content = "".join(event["content"] for event in events if event["type"] == "chunk")
+    assert content.startswith("正在查询")
+    assert "FunctionCall" not in content
+    assert "凭安征信有限公司" in content
+    assert content.endswith("分析完成")
+    assert events[-1]["models"] == {"planning": MODEL, "analysis": MODEL}
+    assert catalog_loads == [(0, 0)]
+    assert main.admission.stats()[f"model:{MODEL}"]["active"] == 0
+
+
+def test_native_tools_gather_catalogs_once():
+    """原生工具调用模式下系统提示和工具定义来自同一次目录加载"""
+    install_stubs()
+    gathers = []
+    provider_tools = []
+    gather_mcp_tools = main.ai_service._gather_mcp_tools
+
+    async def counting_gather(mcp_configs):
+        gathers.append([mcp_config.value for mcp_config in mcp_configs])
+        return await gather_mcp_tools(mcp_configs)
+
+    async def recording_stream(model_config, messages, tools=None):
+        provider_tools.append(tools)
+        yield "好的"
+
+    main.ai_service._gather_mcp_tools = counting_gather
+    main.ai_service._uses_native_tools = lambda model_config: True
+    main.ai_service._get_openai_streaming_response = recording_stream
+    try:
+        events = post_stream(TestClient(main.app), "你好", [MCP_VALUE])
+    finally:
+        del main.ai_service._gather_mcp_tools
+        del main.ai_service._uses_native_tools
+    assert events[-1]["type"] == "end"
+    assert gathers == [[MCP_VALUE]]
+    assert [tool["name"] for tool in provider_tools[0]] == ["search_companies"]
+
+
+def test_stream_rejected_when_queue_full():
+    install_stubs()
+    with use_settings(admission={"model_max_concurrency": 1, "model_max_queue": 0, "queue_timeout": 1}):
+        lease = main.admission.lease("model", MODEL)
+        asyncio.run(lease.acquire(timeout=1))  # 有空闲名额时立即取得
+        try:
+            response = TestClient(main.app).post("/chat/stream", json={
+                "messages": [{"role": "user", "content": "你好"}], "model": MODEL
+            })
+        finally:
+            lease.release()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+
+if __name__ == "__main__":
+    test_stream_without_mcp()
+    test_stream_without_mcp_rate_limited()
+    test_stream_with_mcp_round_trip()
+    test_native_tools_gather_catalogs_once()
+    test_stream_rejected_when_queue_full()
+    print("✅ /chat/stream 测试通过")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+import yaml
+
+from config import Config, ConfigDiff, ConfigSnapshot
+
+BASE = {
+    "ai_models": [
+        {"name": "doubao", "provider": "volcengine", "model_id": "ep-1", "api_key": "k"},
+        {"name": "deepseek-v3", "provider": "volcengine", "model_id": "ep-2", "api_key": "k"}
+    ],
+    "mcp_options": [
+        {"label": "企业数据查询", "value": "data_query", "mcp_url": "http://data.example/mcp/"},
+        {"label": "企业风险查询", "value": "risk", "mcp_url": "http://risk.example/mcp/"}
+    ],
+    "default_model": "doubao"
+}
+
+
+def snapshot(data):
+    return ConfigSnapshot(data, lambda provider: None)
+
+
+def changed(**updates):
+    data = yaml.safe_load(yaml.safe_dump(BASE, allow_unicode=True))
+    for key, value in updates.items():
+        data[key] = value
+    return data
+
+
+def test_identical_snapshots_have_no_diff():
+    assert not ConfigDiff(snapshot(BASE), snapshot(changed()))
+
+
+def test_diff_reports_changed_entries_only():
+    data = changed()
+    data["ai_models"][1]["max_tokens"] = 4096
+    data["mcp_options"].append({"label": "新", "value": "new", "mcp_url": "http://new.example/mcp/"})
+    data["streaming"] = {"mode": "raw"}
+    diff = ConfigDiff(snapshot(BASE), snapshot(data))
+    assert diff.models == {"deepseek-v3"}
+    assert diff.mcp_values == {"new"}
+    assert diff.settings == {"streaming"}
+
+
+def test_removed_entries_are_reported():
+    data = changed(ai_models=BASE["ai_models"][:1], mcp_options=BASE["mcp_options"][1:])
+    diff = ConfigDiff(snapshot(BASE), snapshot(data))
+    assert diff.models == {"deepseek-v3"}
+    assert diff.mcp_values == {"data_query"}
+    assert not diff.settings
+
+
+def test_snapshot_is_read_only():
+    try:
+        snapshot(BASE).models = {}
+        raise AssertionError("快照应当只读")
+    except AttributeError:
+        pass
+
+
+def test_snapshot_data_is_frozen():
+    data = changed(streaming={"mode": "raw"})
+    frozen = snapshot(data)
+    data["streaming"]["mode"] = "coalesced"
+    assert frozen.data["streaming"]["mode"] == "raw"
+    for target, key in ((frozen.data, "default_model"), (frozen.data["streaming"], "mode")):
+        try:
+            target[key] = "x"
+            raise AssertionError("快照数据应当只读")
+        except TypeError:
+            pass
+    assert isinstance(frozen.data["ai_models"], tuple)
+    copied = frozen.to_dict()
+    copied["streaming"]["mode"] = "x"
+    assert frozen.data["streaming"]["mode"] == "raw"
+
+
+def test_reload_if_changed():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "config.yaml")
+        with open(path, "w", encoding="utf-8") as f:
+            yaml.safe_dump(BASE, f, allow_unicode=True)
+        config = Config(path)
+        assert config.reload_if_changed() is None
+
+        data = changed()
+        data["mcp_options"][0]["result_ttl"] = 0
+        with open(path, "w", encoding="utf-8") as f:
+            yaml.safe_dump(data, f, allow_unicode=True)
+        os.utime(path, (1, 1))
+        diff = config.reload_if_changed()
+        assert diff is not None and diff.mcp_values == {"data_query"}
+        assert config.get_mcp_config("data_query").result_ttl == 0
+
+        # 解析失败时保留当前快照
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("ai_models: [")
+        os.utime(path, (2, 2))
+        assert config.reload_if_changed() is None
+        assert config.get_mcp_config("data_query").result_ttl == 0
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")
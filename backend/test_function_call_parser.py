@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import json
+
+from function_call_parser import FUNCTION_CALL_BEGIN, FUNCTION_CALL_END, FunctionCallStreamParser, format_call_block
+
+CALL = '[{"name": "search_companies", "parameters": {"keyword": "凭安"}}]'
+OUTPUT = f"先查询一下{FUNCTION_CALL_BEGIN}{CALL}{FUNCTION_CALL_END}请稍候"
+
+
+def feed_all(chunks):
+    parser = FunctionCallStreamParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.flush())
+    return events
+
+
+def merge_text(events):
+    """合并相邻的文本事件，便于比较不同切分方式的结果"""
+    merged = []
+    for kind, text in events:
+        if kind == "text" and merged and merged[-1][0] == "text":
+            merged[-1] = ("text", merged[-1][1] + text)
+        else:
+            merged.append((kind, text))
+    return merged
+
+
+def test_single_chunk():
+    assert feed_all([OUTPUT]) == [("text", "先查询一下"), ("call", CALL), ("text", "请稍候")]
+
+
+def test_every_split_point():
+    """标记在任意位置被切开时结果都相同，标记本身不会出现在文本中"""
+    expected = [("text", "先查询一下"), ("call", CALL), ("text", "请稍候")]
+    for index in range(1, len(OUTPUT)):
+        assert merge_text(feed_all([OUTPUT[:index], OUTPUT[index:]])) == expected, index
+
+
+def test_char_by_char():
+    expected = [("text", "先查询一下"), ("call", CALL), ("text", "请稍候")]
+    assert merge_text(feed_all(list(OUTPUT))) == expected
+
+
+def test_text_is_emitted_before_call_completes():
+    parser = FunctionCallStreamParser()
+    assert parser.feed("你好<|Func") == [("text", "你好")]
+    assert parser.feed("tionCallBegin|>[") == []
+    assert parser.feed("]<|FunctionCallEnd|>") == [("call", "[]")]
+
+
+def test_multiple_calls():
+    output = f"{FUNCTION_CALL_BEGIN}[1]{FUNCTION_CALL_END}和{FUNCTION_CALL_BEGIN}[2]{FUNCTION_CALL_END}"
+    assert feed_all([output]) == [("call", "[1]"), ("text", "和"), ("call", "[2]")]
+
+
+def test_unclosed_call_flushed_as_text():
+    assert merge_text(feed_all(["前文", FUNCTION_CALL_BEGIN, '[{"name"'])) == [
+        ("text", "前文" + FUNCTION_CALL_BEGIN + '[{"name"')
+    ]
+
+
+def test_partial_marker_at_end_flushed_as_text():
+    assert merge_text(feed_all(["结尾<|Function"])) == [("text", "结尾<|Function")]
+
+
+def test_format_call_block_round_trip():
+    block = format_call_block("search_companies", '{"keyword": "凭安"}')
+    events = feed_all([block])
+    assert len(events) == 1 and events[0][0] == "call"
+    assert json.loads(events[0][1]) == [{"name": "search_companies", "parameters": {"keyword": "凭安"}}]
+    # 没有参数的原生工具调用
+    assert json.loads(feed_all([format_call_block("list_all", "")])[0][1]) == [{"name": "list_all", "parameters": {}}]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")
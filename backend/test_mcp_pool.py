@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+import mcp_pool
+from config import Config, MCPConfig
+from mcp_service import MCPService
+from mcp_pool import MCPSessionPool
+
+
+class FakeClient:
+    """替代 fastmcp.Client，记录会话是否已关闭"""
+
+    instances = []
+
+    def __init__(self, url):
+        self.url = url
+        self.connected = False
+        self.exited = False
+        self.ping_delay = 0.0
+        FakeClient.instances.append(self)
+
+    async def __aenter__(self):
+        self.connected = True
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.connected = False
+        self.exited = True
+
+    def is_connected(self):
+        return self.connected
+
+    async def ping(self):
+        await asyncio.sleep(self.ping_delay)
+
+
+def with_fake_client(test):
+    def run():
+        FakeClient.instances = []
+        original, mcp_pool.Client = mcp_pool.Client, FakeClient
+        try:
+            test()
+        finally:
+            mcp_pool.Client = original
+    run.__name__ = test.__name__
+    run.__doc__ = test.__doc__
+    return run
+
+
+def make_pool():
+    return MCPSessionPool(MCPConfig(label="测试", value="test", mcp_url="http://test/mcp/", health_check_interval=0))
+
+
+def run_during_close(pool, operation):
+    """operation 执行期间平滑关闭会话池"""
+    async def run():
+        started = asyncio.Event()
+
+        async def slow(client):
+            started.set()
+            await asyncio.sleep(0.01)
+            return await operation(client)
+
+        task = asyncio.create_task(pool.run(slow))
+        await started.wait()
+        await pool.close(graceful=True)
+        return await asyncio.gather(task, return_exceptions=True)
+
+    return asyncio.run(run())
+
+
+@with_fake_client
+def test_session_reused_between_calls():
+    pool = make_pool()
+
+    async def run():
+        for _ in range(3):
+            await pool.run(lambda client: asyncio.sleep(0, result=client.url))
+
+    asyncio.run(run())
+    assert len(FakeClient.instances) == 1
+    assert pool.stats()["idle"] == 1
+
+
+@with_fake_client
+def test_close_during_call_discards_session():
+    pool = make_pool()
+
+    async def ok(client):
+        return "ok"
+
+    assert run_during_close(pool, ok) == ["ok"]
+    assert FakeClient.instances[0].exited
+    assert pool.stats()["idle"] == 0 and pool.stats()["sessions"] == 0
+
+
+@with_fake_client
+def test_close_during_protocol_error_discards_session():
+    pool = make_pool()
+
+    async def tool_error(client):
+        raise mcp_pool.PROTOCOL_ERRORS[0]("工具报错")
+
+    results = run_during_close(pool, tool_error)
+    assert isinstance(results[0], mcp_pool.PROTOCOL_ERRORS[0])
+    assert FakeClient.instances[0].exited
+    assert pool.stats()["idle"] == 0
+
+
+@with_fake_client
+def test_close_during_health_check_discards_session():
+    pool = make_pool()
+
+    async def run():
+        await pool.run(lambda client: asyncio.sleep(0))
+        FakeClient.instances[0].ping_delay = 0.02
+        check = asyncio.create_task(pool.health_check())
+        await asyncio.sleep(0.005)
+        await pool.close(graceful=True)
+        await check
+
+    asyncio.run(run())
+    assert FakeClient.instances[0].exited
+    assert pool.stats()["idle"] == 0 and pool.stats()["sessions"] == 0
+
+
+def test_connect_all_clients_is_bounded():
+    """无法连接的 MCP 不阻塞启动，超时后预连接在后台继续，关闭时取消"""
+    class HangingPool:
+        async def start(self):
+            await asyncio.sleep(10)
+
+        async def close(self, graceful=False):
+            pass
+
+    service = MCPService(Config())
+    service._get_session_pool = lambda mcp_config: HangingPool()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await service.connect_all_clients(timeout=0.05)
+        assert loop.time() - started < 1
+        assert service._connect_tasks
+        await service.disconnect_all_clients()
+        await asyncio.sleep(0.01)
+        assert not service._connect_tasks
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+from config import Config
+from mcp_service import MCPService
+from result_cache import ResultCache, make_result_key
+
+
+def test_make_result_key_is_canonical():
+    assert make_result_key("data", "search", {"a": 1, "b": "凭安"}) == make_result_key("data", "search", {"b": "凭安", "a": 1})
+    assert make_result_key("data", "search", None) == make_result_key("data", "search", {})
+
+
+def test_single_flight():
+    """相同调用并发时只执行一次，成功结果按 TTL 写入缓存"""
+    cache = ResultCache()
+    key = make_result_key("data", "search", {"keyword": "凭安"})
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"ok": True}, 60
+
+    async def run():
+        results = await asyncio.gather(*(cache.get_or_call(key, call) for _ in range(5)))
+        assert sorted(source for source, _ in results) == ["coalesced"] * 4 + ["miss"]
+        assert all(value == {"ok": True} for _, value in results)
+        assert await cache.get_or_call(key, call) == ("hit", {"ok": True})
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert cache.stats()["inflight"] == 0
+
+
+def test_errors_are_shared_and_not_cached():
+    cache = ResultCache()
+    key = make_result_key("data", "search", {})
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("上游错误")
+
+    async def run():
+        results = await asyncio.gather(*(cache.get_or_call(key, call) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert cache.get(key) == (False, None)
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_lru_and_invalidate():
+    cache = ResultCache(max_entries=2)
+    first, second, third = (make_result_key("data", "f", {"i": i}) for i in range(3))
+    cache.set(first, 1, 60)
+    cache.set(second, 2, 60)
+    assert cache.get(first) == (True, 1)  # first 成为最近使用
+    cache.set(third, 3, 60)
+    assert cache.get(second) == (False, None)
+    cache.set(make_result_key("other", "f", {}), 4, 60)
+    cache.invalidate("data")
+    assert cache.stats()["entries"] == 1
+
+
+def test_call_cancelled_only_when_all_waiters_leave():
+    """单个等待方被取消不影响其他等待方，所有等待方都取消时取消调用本身"""
+    cache = ResultCache()
+    key = make_result_key("data", "search", {})
+    state = {"cancelled": False}
+
+    async def call():
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+        return "结果", 60
+
+    async def run():
+        first = asyncio.create_task(cache.get_or_call(key, call))
+        second = asyncio.create_task(cache.get_or_call(key, call))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == ("coalesced", "结果")
+        assert not state["cancelled"]
+
+        cache.invalidate()
+        waiters = [asyncio.create_task(cache.get_or_call(key, call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert state["cancelled"]
+        assert cache.stats()["inflight"] == 0
+
+    asyncio.run(run())
+
+
+def test_result_caching_is_opt_in():
+    """未配置 result_ttl 的 MCP 默认不缓存"""
+    config = Config()
+    service = MCPService(config)
+    assert config.get_result_cache_config()["default_ttl"] == 0
+    assert service._result_ttl(config.get_mcp_config("file_processing"), "any_tool") == 0
+    assert service._result_ttl(config.get_mcp_config("data_query"), "search_companies") == 300
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")
@@ -41,7 +41,7 @@ async def test_beautiful_formatting():
     
     print("🎨 测试美观的企业查询结果格式化...")
     print("="*80)
-    formatted = await ai_service._format_mcp_result(mock_search_result, "search_companies")
+    formatted = "".join([part async for part in ai_service._format_mcp_result(mock_search_result, "search_companies")])
     print(formatted)
     
     # 测试企业基本信息格式化
@@ -60,7 +60,7 @@ async def test_beautiful_formatting():
     print("\n" + "="*80)
     print("🏢 测试企业信息格式化...")
     print("="*80)
-    formatted = await ai_service._format_mcp_result(mock_info_result, "get_company_info")
+    formatted = "".join([part async for part in ai_service._format_mcp_result(mock_info_result, "get_company_info")])
     print(formatted)
     
     # 测试科创评分格式化
@@ -76,7 +76,7 @@ async def test_beautiful_formatting():
     print("\n" + "="*80)
     print("🧬 测试科创评分格式化...")
     print("="*80)
-    formatted = await ai_service._format_mcp_result(mock_score_result, "get_stie_score")
+    formatted = "".join([part async for part in ai_service._format_mcp_result(mock_score_result, "get_stie_score")])
     print(formatted)
 
 async def test_parameters_formatting():
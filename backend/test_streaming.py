@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+from streaming import ClientDisconnected, cancel_on_disconnect, coalesce_chunks
+
+
+async def produce(chunks, delay=0.0, closed=None):
+    try:
+        for chunk in chunks:
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_coalesce_by_size():
+    chunks = asyncio.run(collect(coalesce_chunks(produce(["ab", "cd", "ef", "g"]), flush_chars=4, flush_interval=10)))
+    assert chunks == ["abcd", "efg"]
+
+
+def test_coalesce_by_interval():
+    """上游停顿超过 flush_interval 时先输出已缓冲的内容"""
+    async def source():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.1)
+        yield "c"
+
+    chunks = asyncio.run(collect(coalesce_chunks(source(), flush_chars=100, flush_interval=0.02)))
+    assert chunks == ["ab", "c"]
+
+
+def test_coalesce_skips_empty_chunks():
+    chunks = asyncio.run(collect(coalesce_chunks(produce(["", "a", "", "b"]), flush_chars=2, flush_interval=10)))
+    assert chunks == ["ab"]
+
+
+def test_coalesce_flushes_buffer_before_upstream_error():
+    async def source():
+        yield "已输出"
+        yield "的内容"
+        raise RuntimeError("上游中断")
+
+    async def run():
+        received = []
+        try:
+            async for chunk in coalesce_chunks(source(), flush_chars=100, flush_interval=10):
+                received.append(chunk)
+            raise AssertionError("应当抛出上游异常")
+        except RuntimeError as e:
+            assert str(e) == "上游中断"
+        return received
+
+    assert asyncio.run(run()) == ["已输出的内容"]
+
+
+def test_coalesce_closes_source_when_closed_early():
+    closed = []
+
+    async def run():
+        stream = coalesce_chunks(produce(["a"] * 10, delay=0.01, closed=closed), flush_chars=1, flush_interval=10)
+        assert await stream.__anext__() == "a"
+        await stream.aclose()
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_cancel_on_disconnect_passes_through():
+    async def connected():
+        return False
+
+    chunks = asyncio.run(collect(cancel_on_disconnect(produce(["a", "b", "c"]), connected, poll_interval=0.01)))
+    assert chunks == ["a", "b", "c"]
+
+
+def test_cancel_on_disconnect_cancels_upstream():
+    """客户端断开时取消正在等待的片段并关闭上游流，不必等到上游产出下一个片段"""
+    state = {"disconnected": False, "cancelled": False, "closed": False}
+
+    async def is_disconnected():
+        return state["disconnected"]
+
+    async def source():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+        finally:
+            state["closed"] = True
+
+    async def run():
+        received = []
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            async for chunk in cancel_on_disconnect(source(), is_disconnected, poll_interval=0.01):
+                received.append(chunk)
+                state["disconnected"] = True
+            raise AssertionError("应当抛出 ClientDisconnected")
+        except ClientDisconnected:
+            pass
+        assert received == ["a"]
+        assert loop.time() - started < 1
+
+    asyncio.run(run())
+    assert state["cancelled"] and state["closed"]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✅ {name}")
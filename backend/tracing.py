@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from transport import HTTPTransport
+
+logger = logging.getLogger(__name__)
+
+# 当前请求 id（即 trace id）和当前 span，随 asyncio 任务上下文自动传递
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def current_request_id() -> Optional[str]:
+    """当前请求的 id，不在请求内时返回 None"""
+    return _request_id.get()
+
+
+class Span:
+    """一段带耗时的处理过程
+
+    作为上下文管理器使用，进入时成为当前 span，退出时记录耗时并交给导出器。
+    退出时直接把当前 span 恢复为父 span 而不是重置 token，因此可以跨异步生成器的多次迭代使用。
+    """
+
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"] = None, **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attributes: Dict[str, Any] = attributes
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        if self.parent is None:
+            _request_id.set(self.trace_id)
+        _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        if exc is not None and not isinstance(exc, (GeneratorExit, asyncio.CancelledError)):
+            self.error = f"{exc_type.__name__}: {exc}"
+        elif exc is not None:
+            self.attributes["cancelled"] = True
+        _current_span.set(self.parent)
+        _tracer.export(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "name": self.name,
+            "start": self.start_time,
+            "duration_ms": round(self.duration * 1000, 2) if self.duration is not None else None,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+def start_trace(name: str, **attributes) -> Span:
+    """创建一个请求的根 span，其 trace id 即请求 id，进入后在当前上下文中生效"""
+    return Span(name, uuid.uuid4().hex, **attributes)
+
+
+def span(name: str, **attributes) -> Span:
+    """在当前 span 下开始一个子 span；不在请求内时单独成为一个 trace"""
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent else (_request_id.get() or uuid.uuid4().hex)
+    return Span(name, trace_id, parent, **attributes)
+
+
+class JsonLinesExporter:
+    """每个 span 以一行 JSON 追加到文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, spans: List[Span]):
+        lines = "".join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in spans)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class OTLPExporter:
+    """以 OTLP/HTTP JSON 格式把 span 批量发送到本地 collector"""
+
+    def __init__(self, endpoint: str, service_name: str):
+        self.endpoint = endpoint
+        self.service_name = service_name
+
+    @staticmethod
+    def _attribute(key: str, value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False, default=str)
+        return {"key": key, "value": {"stringValue": value}}
+
+    def _encode(self, span: Span) -> Dict[str, Any]:
+        start_ns = int(span.start_time * 1e9)
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int((span.duration or 0) * 1e9)),
+            "attributes": [self._attribute(k, v) for k, v in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+        }
+        if span.parent:
+            encoded["parentSpanId"] = span.parent.span_id
+        return encoded
+
+    def payload(self, spans: List[Span]) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+                "scopeSpans": [{
+                    "scope": {"name": "ai-chat-backend"},
+                    "spans": [self._encode(s) for s in spans]
+                }]
+            }]
+        }
+
+
+class Tracer:
+    """收集结束的 span 并定期批量导出
+
+    tracing.enabled 为 false 时 span 照常计时（请求 id 仍会生成），但不会缓冲或导出。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.flush_interval = 1.0
+        self.max_buffer = 10000
+        self._exporter = None
+        self._buffer: List[Span] = []
+        self._dropped = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._transport: Optional[HTTPTransport] = None
+
+    def configure(self, config: Config, transport: Optional[HTTPTransport] = None):
+        """根据 config.yaml 的 tracing 配置选择导出器"""
+        tracing_config = config.get_tracing_config()
+        self.enabled = bool(tracing_config.get("enabled", False))
+        self.flush_interval = float(tracing_config.get("flush_interval", 1.0))
+        self.max_buffer = int(tracing_config.get("max_buffer", 10000))
+        self._transport = transport or HTTPTransport(config)
+        exporter = tracing_config.get("exporter", "jsonl")
+        if exporter == "otlp":
+            self._exporter = OTLPExporter(
+                tracing_config.get("otlp_endpoint", "http://localhost:4318/v1/traces"),
+                tracing_config.get("service_name", "ai-chat-backend")
+            )
+        else:
+            self._exporter = JsonLinesExporter(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), tracing_config.get("path", "traces.jsonl"))
+            )
+
+    def export(self, span: Span):
+        if not self.enabled:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            self._dropped += 1
+            return
+        self._buffer.append(span)
+
+    def start(self):
+        if self.enabled and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        spans, self._buffer = self._buffer, []
+        if not spans or self._exporter is None:
+            return
+        try:
+            if isinstance(self._exporter, OTLPExporter):
+                client = self._transport.get_client(self._exporter.endpoint)
+                response = await client.post(self._exporter.endpoint, json=self._exporter.payload(spans), timeout=5.0)
+                response.raise_for_status()
+            else:
+                await asyncio.to_thread(self._exporter.export, spans)
+        except Exception as e:
+            logger.warning("导出 trace 失败，丢弃 %d 个 span: %s", len(spans), e)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        if isinstance(self._exporter, JsonLinesExporter):
+            self._exporter.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "buffered": len(self._buffer), "dropped": self._dropped}
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
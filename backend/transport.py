@@ -0,0 +1,106 @@
+import importlib.util
+import logging
+from typing import Any, Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from config import Config
+from metrics import HTTP_POOL_CONNECTIONS, HTTP_POOL_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# 安装了 h2 时才能启用 HTTP/2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class HTTPTransport:
+    """按上游主机共享的 httpx 连接池
+
+    AI 提供商 SDK、Ollama 和 MCP HTTP 备选调用都从这里取客户端，同一主机的请求复用
+    keep-alive 连接和 TLS 会话。连接数、keep-alive 和超时取自 config.yaml 的 http 配置，
+    hosts 下可以按主机名覆盖。
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _settings_for(self, host: str) -> Dict[str, Any]:
+        http_config = self.config.get_http_config()
+        settings = {key: value for key, value in http_config.items() if key != "hosts"}
+        settings.update((http_config.get("hosts") or {}).get(urlsplit(host).hostname or "", {}))
+        return settings
+
+    def get_timeout(self, url: str) -> httpx.Timeout:
+        settings = self._settings_for(self._host_key(url))
+        return httpx.Timeout(
+            connect=settings.get("connect_timeout", 5.0),
+            read=settings.get("read_timeout", 60.0),
+            write=settings.get("write_timeout", 10.0),
+            pool=settings.get("pool_timeout", 10.0)
+        )
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        """获取 url 所在主机的共享客户端，请求时需使用完整 URL"""
+        host = self._host_key(url)
+        client = self._clients.get(host)
+        if client is None or client.is_closed:
+            settings = self._settings_for(host)
+            http2 = bool(settings.get("http2", True))
+            if http2 and not HTTP2_AVAILABLE:
+                logger.warning("配置启用了 HTTP/2 但未安装 h2，%s 使用 HTTP/1.1", host)
+                http2 = False
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings.get("max_connections", 100),
+                    max_keepalive_connections=settings.get("max_keepalive_connections", 20),
+                    keepalive_expiry=settings.get("keepalive_expiry", 30.0)
+                ),
+                timeout=self.get_timeout(host),
+                http2=http2
+            )
+            self._clients[host] = client
+        return client
+
+    async def close(self):
+        """关闭所有连接池"""
+        for host, client in list(self._clients.items()):
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning("关闭 HTTP 连接池失败 %s: %s", host, e)
+        self._clients.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """各主机连接池占用情况"""
+        result = {}
+        for host, client in self._clients.items():
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []) or [])
+            idle = sum(1 for connection in connections if connection.is_idle())
+            result[host] = {
+                "connections": len(connections),
+                "active": len(connections) - idle,
+                "idle": idle,
+                "requests": len(getattr(pool, "_requests", []) or []),  # 进行中及等待连接的请求
+                "max_connections": getattr(pool, "_max_connections", None),
+                "http2": getattr(pool, "_http2", False)
+            }
+        return result
+
+    def collect_metrics(self):
+        """把连接池占用写入指标，在 /metrics 抓取时调用"""
+        HTTP_POOL_CONNECTIONS.clear()
+        HTTP_POOL_REQUESTS.clear()
+        for host, stats in self.stats().items():
+            HTTP_POOL_CONNECTIONS.set(stats["active"], host=host, state="active")
+            HTTP_POOL_CONNECTIONS.set(stats["idle"], host=host, state="idle")
+            if stats["max_connections"] is not None:
+                HTTP_POOL_CONNECTIONS.set(stats["max_connections"], host=host, state="max")
+            HTTP_POOL_REQUESTS.set(stats["requests"], host=host)